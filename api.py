@@ -4,12 +4,98 @@ API endpoints for the medical reference app
 This module provides RESTful API endpoints for accessing and searching medical data.
 """
 from flask import Blueprint, request, jsonify
-from models import db, Condition, Medication, Specialty, Reference, Guideline
-from sqlalchemy import or_
+from models import db, Condition, Medication, Specialty, Reference, Guideline, term_record_ids
+from cache import collection_validator, conditional_response, record_validator
+from pagination import DEFAULT_PER_PAGE, MAX_PER_PAGE, InvalidCursor, decode_cursor, encode_cursor, keyset_paginate
+import search as search_index
+import symptoms as symptom_matching
 import json
+import math
 
 api = Blueprint('api', __name__)
 
+@api.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    """Handle malformed pagination cursors"""
+    return jsonify({'error': str(e)}), 400
+
+# List endpoint parameters that look up JSON list items in the term tables: parameter -> column
+TERM_FILTERS = {
+    'condition': {'symptom': 'symptoms', 'treatment': 'treatments'},
+    'medication': {'use': 'uses', 'side_effect': 'side_effects', 'contraindication': 'contraindications'}
+}
+
+def filter_terms(model, filters):
+    """
+    Query the records matching every term filter in the request
+    
+    Args:
+        model: Condition or Medication
+        filters: Query parameter -> JSON list column
+    
+    Returns:
+        Query: Query over model
+    """
+    query = model.query
+    for parameter, field in filters.items():
+        for value in request.args.getlist(parameter):
+            prefix = value.endswith('*')
+            query = query.filter(model.id.in_(term_record_ids(model, field, value.rstrip('*'), prefix=prefix)))
+    return query
+
+def list_page(query, sort_column, id_column):
+    """
+    Fetch the records of a list endpoint, a page at a time if the request asks
+    
+    Query parameters:
+    - limit: Page size (at most 100); without limit or cursor every record is returned
+    - cursor: next_cursor or prev_cursor of a previous page
+    - include_total: Also count the records across all pages (true/false)
+    
+    Args:
+        query: Query with any filters applied
+        sort_column: Column pages are ordered by
+        id_column: Unique column that breaks ties
+    
+    Returns:
+        tuple: (records, dict of paging fields to add to the response)
+    """
+    cursor = request.args.get('cursor')
+    if not cursor and 'limit' not in request.args:
+        return query.all(), {}
+    
+    limit = min(max(request.args.get('limit', DEFAULT_PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    with_total = request.args.get('include_total', '').lower() in ('1', 'true', 'yes')
+    page = keyset_paginate(query, sort_column, id_column, limit, cursor, with_total)
+    
+    paging = {'next_cursor': page.next_cursor, 'prev_cursor': page.prev_cursor}
+    if with_total:
+        paging['total'] = page.total
+    return page.items, paging
+
+def hit_payload(entity_type, entity_id, query, snippets=False):
+    """
+    Get the API representation of a search hit from the in-memory index
+    
+    Args:
+        entity_type: Entity type name
+        entity_id: Record ID
+        query: Search text the hit was found with
+        snippets: Replace the record's long text columns with snippets of
+            their matches (see InvertedIndex.snippets)
+    
+    Returns:
+        dict: The payload, or None if the record was removed since the search ran
+    """
+    payload = search_index.memory_index.payload(entity_type, entity_id)
+    if payload is None or not snippets:
+        return payload
+    
+    columns = search_index.SNIPPET_COLUMNS[entity_type]
+    payload = {column: value for column, value in payload.items() if column not in columns}
+    payload['snippets'] = search_index.memory_index.snippets(entity_type, entity_id, query)
+    return payload
+
 @api.route('/api/search', methods=['GET'])
 def search():
     """
@@ -19,171 +105,234 @@ def search():
     - q: Search query
     - type: Type of data to search (condition, medication, specialty, reference, guideline, all)
     - specialty: Filter by specialty
-    - limit: Maximum number of results to return (default: 20)
+    - limit: Maximum number of results to return (default: 20, at most 100)
     - offset: Offset for pagination (default: 0)
+    - cursor: next_cursor of the previous page, to page without an offset
+    - snippets: Return snippets of the matches in place of the long text
+      columns (true/false)
     
     Returns:
-        JSON response with search results
+        JSON response with the matching records of each type, the same page as a
+        single list ordered by relevance, and the total number of matches; a
+        search that finds nothing is retried with misspelled words corrected
+        (corrected_query). Facets count every match by entity type, specialty,
+        medication class and guideline organization.
     """
     query = request.args.get('q', '')
     data_type = request.args.get('type', 'all')
     specialty = request.args.get('specialty', '')
-    limit = int(request.args.get('limit', 20))
-    offset = int(request.args.get('offset', 0))
-    
-    results = {
-        'conditions': [],
-        'medications': [],
-        'specialties': [],
-        'references': [],
-        'guidelines': []
-    }
-    
-    # Search conditions
-    if data_type in ['condition', 'all']:
-        conditions_query = Condition.query.filter(
-            or_(
-                Condition.name.ilike(f'%{query}%'),
-                Condition.description.ilike(f'%{query}%')
-            )
-        )
-        
-        if specialty:
-            conditions_query = conditions_query.join(Specialty).filter(Specialty.name == specialty)
-            
-        conditions = conditions_query.limit(limit).offset(offset).all()
-        results['conditions'] = [
-            {
-                'id': c.id,
-                'name': c.name,
-                'description': c.description,
-                'symptoms': c.symptoms,
-                'treatments': c.treatments,
-                'specialty': c.specialty.name if c.specialty else None
-            }
-            for c in conditions
-        ]
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', type=int)
+    if ('limit' in request.args and limit is None) or ('offset' in request.args and (offset is None or offset < 0)):
+        return jsonify({'error': 'limit must be an integer and offset a non-negative integer'}), 400
+    limit = min(max(20 if limit is None else limit, 1), MAX_PER_PAGE)
+    offset = offset or 0
+    cursor = request.args.get('cursor')
+    snippets = request.args.get('snippets', '').lower() in ('1', 'true', 'yes')
     
-    # Search medications
-    if data_type in ['medication', 'all']:
-        medications_query = Medication.query.filter(
-            or_(
-                Medication.name.ilike(f'%{query}%'),
-                Medication.description.ilike(f'%{query}%'),
-                Medication.class_name.ilike(f'%{query}%')
-            )
-        )
-        
-        if specialty:
-            medications_query = medications_query.join(Specialty).filter(Specialty.name == specialty)
-            
-        medications = medications_query.limit(limit).offset(offset).all()
-        results['medications'] = [
-            {
-                'id': m.id,
-                'name': m.name,
-                'class_name': m.class_name,
-                'uses': m.uses,
-                'side_effects': m.side_effects,
-                'dosing': m.dosing,
-                'contraindications': m.contraindications,
-                'specialty': m.specialty.name if m.specialty else None
-            }
-            for m in medications
-        ]
+    # A cursor is the (type, id, score) of the last hit of the previous page
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if (len(after) != 3 or after[0] not in search_index.SEARCH_TYPES
+                or isinstance(after[1], bool) or not isinstance(after[1], int)
+                or isinstance(after[2], bool) or not isinstance(after[2], (int, float))
+                or not math.isfinite(after[2])):
+            raise InvalidCursor(f"Invalid cursor: {cursor}")
+        offset = 0
     
-    # Search specialties
-    if data_type in ['specialty', 'all']:
-        specialties_query = Specialty.query.filter(
-            or_(
-                Specialty.name.ilike(f'%{query}%'),
-                Specialty.description.ilike(f'%{query}%')
-            )
-        )
-        
-        specialties = specialties_query.limit(limit).offset(offset).all()
-        results['specialties'] = [
-            {
-                'id': s.id,
-                'name': s.name,
-                'description': s.description
-            }
-            for s in specialties
-        ]
+    # Answered from the in-memory index, without touching the database. Results
+    # of every type are ranked together, so a page is taken from one stream; one
+    # extra hit tells whether there is a next page.
+    categories = {'condition': 'conditions', 'medication': 'medications', 'specialty': 'specialties',
+                  'reference': 'references', 'guideline': 'guidelines'}
+    searched = [entity_type for entity_type in categories if data_type in [entity_type, 'all']]
+    total_results, hits, facets = search_index.memory_index.top(
+        query, searched, specialty=specialty or None, limit=limit + 1, offset=offset, with_facets=True, after=after
+    )
     
-    # Search references
-    if data_type in ['reference', 'all']:
-        references_query = Reference.query.filter(
-            or_(
-                Reference.title.ilike(f'%{query}%'),
-                Reference.authors.ilike(f'%{query}%'),
-                Reference.publication.ilike(f'%{query}%')
-            )
+    # Retry misspelled searches with the closest condition and medication name words
+    corrected_query = search_index.correct_query(query) if not total_results else None
+    if corrected_query:
+        total_results, hits, facets = search_index.memory_index.top(
+            corrected_query, searched, specialty=specialty or None, limit=limit + 1, offset=offset,
+            with_facets=True, after=after
         )
-        
-        references = references_query.limit(limit).offset(offset).all()
-        results['references'] = [
-            {
-                'id': r.id,
-                'title': r.title,
-                'url': r.url,
-                'authors': r.authors,
-                'publication': r.publication,
-                'year': r.year,
-                'doi': r.doi
-            }
-            for r in references
-        ]
     
-    # Search guidelines
-    if data_type in ['guideline', 'all']:
-        guidelines_query = Guideline.query.filter(
-            or_(
-                Guideline.title.ilike(f'%{query}%'),
-                Guideline.organization.ilike(f'%{query}%'),
-                Guideline.summary.ilike(f'%{query}%')
-            )
-        )
-        
-        if specialty:
-            guidelines_query = guidelines_query.join(Specialty).filter(Specialty.name == specialty)
-            
-        guidelines = guidelines_query.limit(limit).offset(offset).all()
-        results['guidelines'] = [
-            {
-                'id': g.id,
-                'title': g.title,
-                'organization': g.organization,
-                'publication_year': g.publication_year,
-                'summary': g.summary,
-                'url': g.url,
-                'specialty': g.specialty.name if g.specialty else None
-            }
-            for g in guidelines
-        ]
+    next_cursor = encode_cursor(list(hits[limit - 1])) if len(hits) > limit else None
+    hits = hits[:limit]
     
-    # Count total results
-    total_results = sum(len(results[key]) for key in results)
+    results = {category: [] for category in categories.values()}
+    ranked = []
+    for entity_type, entity_id, score in hits:
+        payload = hit_payload(entity_type, entity_id, corrected_query or query, snippets)
+        # Skip records removed since the search ran
+        if payload is None:
+            continue
+        results[categories[entity_type]].append(payload)
+        ranked.append(dict(payload, type=entity_type, score=round(score, 4)))
     
     return jsonify({
         'query': query,
+        'corrected_query': corrected_query,
         'type': data_type,
         'specialty': specialty,
         'limit': limit,
         'offset': offset,
+        'next_cursor': next_cursor,
         'total_results': total_results,
-        'results': results
+        'results': results,
+        'ranked': ranked,
+        'facets': {
+            facet: [{'value': value, 'count': count} for value, count in values]
+            for facet, values in facets.items()
+        }
+    })
+
+# Maximum number of searches in one /api/search/batch request
+MAX_BATCH_SEARCHES = 100
+
+@api.route('/api/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Run many searches in one request
+    
+    JSON body:
+    - queries: List of searches, each an object with
+      - q: Search query
+      - type: Type of data to search (condition, medication, specialty,
+        reference, guideline, all; default: all)
+      - specialty: Filter by specialty
+      - limit: Maximum number of results to return (default: 20)
+    - snippets: Return snippets of the matches in place of the long text
+      columns (default: false)
+    
+    Returns:
+        JSON response with, for each search in the order given, its total number
+        of matches and the best matches ordered by relevance (see search for
+        corrected_query)
+    """
+    body = request.get_json(silent=True)
+    searches = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(searches, list) or not searches:
+        return jsonify({'error': 'A non-empty list of queries is required'}), 400
+    if len(searches) > MAX_BATCH_SEARCHES:
+        return jsonify({'error': f"At most {MAX_BATCH_SEARCHES} queries are allowed per request"}), 400
+    snippets = body.get('snippets', False) is True
+    
+    parsed = []
+    for position, item in enumerate(searches):
+        if not isinstance(item, dict) or not isinstance(item.get('q', ''), str):
+            return jsonify({'error': f"Query {position} must be an object with a string q"}), 400
+        data_type = item.get('type', 'all')
+        if data_type != 'all' and data_type not in search_index.SEARCH_TYPES:
+            return jsonify({'error': f"Query {position} has an unknown type: {data_type}"}), 400
+        limit = item.get('limit', 20)
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            return jsonify({'error': f"Query {position} must have a positive integer limit"}), 400
+        specialty = item.get('specialty') or ''
+        if not isinstance(specialty, str):
+            return jsonify({'error': f"Query {position} must have a string specialty"}), 400
+        parsed.append({
+            'query': item.get('q', ''),
+            'type': data_type,
+            'specialty': specialty,
+            'searched': list(search_index.SEARCH_TYPES) if data_type == 'all' else [data_type],
+            'limit': limit
+        })
+    
+    # Answered from the in-memory index in one pass; searches sharing words share their scores
+    found = dict(enumerate(search_index.memory_index.top_many([
+        (search['query'], search['searched'], search['specialty'] or None, search['limit']) for search in parsed
+    ])))
+    
+    # Retry the searches that found nothing with misspelled words corrected, again in one pass
+    corrections = {}
+    corrected_queries = {}
+    for position, search in enumerate(parsed):
+        if not found[position][0]:
+            if search['query'] not in corrections:
+                corrections[search['query']] = search_index.correct_query(search['query'])
+            if corrections[search['query']]:
+                corrected_queries[position] = corrections[search['query']]
+    if corrected_queries:
+        found.update(zip(corrected_queries, search_index.memory_index.top_many([
+            (corrected, parsed[position]['searched'], parsed[position]['specialty'] or None,
+             parsed[position]['limit'])
+            for position, corrected in corrected_queries.items()
+        ])))
+    
+    results = []
+    for position, search in enumerate(parsed):
+        total_results, hits = found[position]
+        ranked = []
+        for entity_type, entity_id, score in hits:
+            payload = hit_payload(
+                entity_type, entity_id, corrected_queries.get(position, search['query']), snippets
+            )
+            # Skip records removed since the search ran
+            if payload is not None:
+                ranked.append(dict(payload, type=entity_type, score=round(score, 4)))
+        results.append({
+            'query': search['query'],
+            'corrected_query': corrected_queries.get(position),
+            'type': search['type'],
+            'specialty': search['specialty'],
+            'limit': search['limit'],
+            'total_results': total_results,
+            'results': ranked
+        })
+    
+    return jsonify({'count': len(results), 'results': results})
+
+@api.route('/api/autocomplete', methods=['GET'])
+def autocomplete():
+    """
+    Suggest condition, medication, specialty and guideline names, and medication
+    classes, as a search is typed
+    
+    Query parameters:
+    - q: Typed text
+    - limit: Maximum number of suggestions (default: 10, at most 25)
+    
+    Returns:
+        JSON response with the suggestions: the name (label), its type and the
+        record ID (null for medication classes)
+    """
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', search_index.DEFAULT_SUGGESTIONS, type=int), search_index.MAX_SUGGESTIONS)
+    
+    suggestions = search_index.name_index.suggest(query, max(limit, 0))
+    return jsonify({
+        'query': query,
+        'suggestions': [
+            {
+                'label': suggestion.label,
+                'type': suggestion.kind,
+                'id': None if suggestion.kind == 'medication_class' else suggestion.entity_id
+            }
+            for suggestion in suggestions
+        ]
     })
 
 @api.route('/api/conditions', methods=['GET'])
+@conditional_response(collection_validator(Condition, Specialty))
 def get_conditions():
-    """Get all conditions or filter by specialty"""
+    """
+    Get all conditions or filter by specialty, symptom or treatment
+    
+    Query parameters:
+    - specialty: Specialty name
+    - symptom, treatment: Item of the condition's list (case-insensitive; end
+      with * to match items starting with the text); may be repeated
+    - limit, cursor, include_total: See list_page
+    """
     specialty = request.args.get('specialty', '')
     
+    query = filter_terms(Condition, TERM_FILTERS['condition'])
     if specialty:
-        conditions = Condition.query.join(Specialty).filter(Specialty.name == specialty).all()
-    else:
-        conditions = Condition.query.all()
+        query = query.join(Specialty).filter(Specialty.name == specialty)
+    conditions, paging = list_page(query, Condition.name, Condition.id)
     
     return jsonify({
         'count': len(conditions),
@@ -197,10 +346,12 @@ def get_conditions():
                 'specialty': c.specialty.name if c.specialty else None
             }
             for c in conditions
-        ]
+        ],
+        **paging
     })
 
 @api.route('/api/conditions/<int:condition_id>', methods=['GET'])
+@conditional_response(record_validator(Condition, 'condition_id', related=('specialty', 'references')))
 def get_condition(condition_id):
     """Get a specific condition by ID"""
     condition = Condition.query.get_or_404(condition_id)
@@ -222,15 +373,71 @@ def get_condition(condition_id):
         ] if condition.references else []
     })
 
+@api.route('/api/conditions/by-symptoms', methods=['GET'])
+def match_symptoms():
+    """
+    Rank conditions by the number of given symptoms they share
+    
+    Query parameters:
+    - symptoms: Comma-separated symptom names (or repeat the symptom parameter)
+    - specialty_id: Only rank conditions of this specialty
+    - limit: Maximum number of conditions to return (default: 20, at most 100)
+    
+    Returns:
+        JSON response with the conditions matching any symptom, most matched
+        first, and the given symptoms that no condition lists
+    """
+    symptoms = request.args.getlist('symptom') + [
+        symptom for value in request.args.getlist('symptoms') for symptom in value.split(',')
+    ]
+    symptoms = [symptom.strip() for symptom in symptoms if symptom.strip()]
+    if not symptoms:
+        return jsonify({'error': 'At least one symptom is required'}), 400
+    
+    specialty_id = request.args.get('specialty_id', type=int)
+    limit = min(request.args.get('limit', symptom_matching.DEFAULT_MATCHES, type=int), symptom_matching.MAX_MATCHES)
+    
+    # Answered from the in-memory symptom index, without touching the database
+    total, matches = symptom_matching.symptom_index.match(symptoms, specialty_id=specialty_id, limit=max(limit, 0))
+    distinct = len({symptom_matching.normalise_symptom(symptom) for symptom in symptoms})
+    
+    return jsonify({
+        'symptoms': symptoms,
+        'unknown_symptoms': [symptom for symptom in symptoms if not symptom_matching.symptom_index.known(symptom)],
+        'specialty_id': specialty_id,
+        'count': total,
+        'conditions': [
+            {
+                'id': match.condition_id,
+                'name': match.name,
+                'specialty_id': match.specialty_id,
+                'matched': match.matched,
+                'matched_symptoms': match.matched_symptoms,
+                'score': round(match.matched / distinct, 4)
+            }
+            for match in matches
+        ]
+    })
+
 @api.route('/api/medications', methods=['GET'])
+@conditional_response(collection_validator(Medication, Specialty))
 def get_medications():
-    """Get all medications or filter by specialty"""
+    """
+    Get all medications or filter by specialty, use, side effect or contraindication
+    
+    Query parameters:
+    - specialty: Specialty name
+    - use, side_effect, contraindication: Item of the medication's list
+      (case-insensitive; end with * to match items starting with the text);
+      may be repeated
+    - limit, cursor, include_total: See list_page
+    """
     specialty = request.args.get('specialty', '')
     
+    query = filter_terms(Medication, TERM_FILTERS['medication'])
     if specialty:
-        medications = Medication.query.join(Specialty).filter(Specialty.name == specialty).all()
-    else:
-        medications = Medication.query.all()
+        query = query.join(Medication.specialties).filter(Specialty.name == specialty)
+    medications, paging = list_page(query, Medication.name, Medication.id)
     
     return jsonify({
         'count': len(medications),
@@ -243,13 +450,15 @@ def get_medications():
                 'side_effects': m.side_effects,
                 'dosing': m.dosing,
                 'contraindications': m.contraindications,
-                'specialty': m.specialty.name if m.specialty else None
+                'specialties': [s.name for s in m.specialties]
             }
             for m in medications
-        ]
+        ],
+        **paging
     })
 
 @api.route('/api/medications/<int:medication_id>', methods=['GET'])
+@conditional_response(record_validator(Medication, 'medication_id', related=('specialties',)))
 def get_medication(medication_id):
     """Get a specific medication by ID"""
     medication = Medication.query.get_or_404(medication_id)
@@ -262,13 +471,14 @@ def get_medication(medication_id):
         'side_effects': medication.side_effects,
         'dosing': medication.dosing,
         'contraindications': medication.contraindications,
-        'specialty': medication.specialty.name if medication.specialty else None
+        'specialties': [s.name for s in medication.specialties]
     })
 
 @api.route('/api/specialties', methods=['GET'])
+@conditional_response(collection_validator(Specialty, Condition, Medication, Guideline))
 def get_specialties():
-    """Get all specialties"""
-    specialties = Specialty.query.all()
+    """Get all specialties (see list_page for paging)"""
+    specialties, paging = list_page(Specialty.query, Specialty.name, Specialty.id)
     
     return jsonify({
         'count': len(specialties),
@@ -282,10 +492,12 @@ def get_specialties():
                 'guideline_count': len(s.guidelines)
             }
             for s in specialties
-        ]
+        ],
+        **paging
     })
 
 @api.route('/api/specialties/<int:specialty_id>', methods=['GET'])
+@conditional_response(record_validator(Specialty, 'specialty_id', related=('conditions', 'medications', 'guidelines')))
 def get_specialty(specialty_id):
     """Get a specific specialty by ID"""
     specialty = Specialty.query.get_or_404(specialty_id)
@@ -300,9 +512,10 @@ def get_specialty(specialty_id):
     })
 
 @api.route('/api/references', methods=['GET'])
+@conditional_response(collection_validator(Reference))
 def get_references():
-    """Get all references"""
-    references = Reference.query.all()
+    """Get all references (see list_page for paging)"""
+    references, paging = list_page(Reference.query, Reference.title, Reference.id)
     
     return jsonify({
         'count': len(references),
@@ -317,18 +530,20 @@ def get_references():
                 'doi': r.doi
             }
             for r in references
-        ]
+        ],
+        **paging
     })
 
 @api.route('/api/guidelines', methods=['GET'])
+@conditional_response(collection_validator(Guideline, Specialty))
 def get_guidelines():
-    """Get all guidelines or filter by specialty"""
+    """Get all guidelines or filter by specialty (see list_page for paging)"""
     specialty = request.args.get('specialty', '')
     
+    query = Guideline.query
     if specialty:
-        guidelines = Guideline.query.join(Specialty).filter(Specialty.name == specialty).all()
-    else:
-        guidelines = Guideline.query.all()
+        query = query.join(Specialty).filter(Specialty.name == specialty)
+    guidelines, paging = list_page(query, Guideline.title, Guideline.id)
     
     return jsonify({
         'count': len(guidelines),
@@ -343,7 +558,8 @@ def get_guidelines():
                 'specialty': g.specialty.name if g.specialty else None
             }
             for g in guidelines
-        ]
+        ],
+        **paging
     })
 
 @api.route('/api/export', methods=['GET'])
@@ -401,7 +617,7 @@ def export_data():
                 'side_effects': m.side_effects,
                 'dosing': m.dosing,
                 'contraindications': m.contraindications,
-                'specialty': m.specialty.name if m.specialty else None
+                'specialties': [s.name for s in m.specialties]
             }
             for m in medications
         ]
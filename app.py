@@ -1,16 +1,27 @@
-from flask import Flask, render_template, request, jsonify, send_file, url_for, redirect, flash
+from flask import Flask, render_template, request, jsonify, send_file, url_for, redirect, flash, abort, Response
+import click
+import hmac
 import json
 import os
 import logging
 from flask_migrate import Migrate
 from flask_login import LoginManager, login_required, current_user
 from datetime import datetime
-from models import db, Condition, Medication, Specialty, Reference, Guideline, User, MedicationRelationship
+from models import (
+    db, Condition, Medication, Specialty, Reference, Guideline, User, MedicationRelationship, backfill_record_terms,
+    rebuild_record_terms
+)
 from utils import safe_json_loads
+from pagination import MAX_PER_PAGE, InvalidCursor, keyset_paginate
 import auth
 from auth import login_manager
 from api import api
-from cache import cache_result, clear_expired_cache
+import cache
+import search as search_index
+import symptoms as symptom_matching
+from cache import (
+    add_cache_tags, cache_response, invalidate_tags, record_validator
+)
 from visualizations import (
     get_specialty_distribution, 
     get_medication_class_distribution,
@@ -50,6 +61,27 @@ logger.info(f"Using database: {app.config['SQLALCHEMY_DATABASE_URI']}")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['CACHE_DIR'] = 'cache'
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'file')
+app.config['CACHE_SQLITE_PATH'] = os.environ.get('CACHE_SQLITE_PATH')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+app.config['CACHE_MEMORY_CAPACITY'] = int(os.environ.get('CACHE_MEMORY_CAPACITY', 512))
+app.config['CACHE_MEMORY_TTL'] = int(os.environ.get('CACHE_MEMORY_TTL', 300))
+app.config['CACHE_SWEEP_INTERVAL'] = int(os.environ.get('CACHE_SWEEP_INTERVAL', 60))
+app.config['CACHE_RECONCILE_INTERVAL'] = int(os.environ.get('CACHE_RECONCILE_INTERVAL', 3600))
+app.config['CACHE_LOCK_TIMEOUT'] = int(os.environ.get('CACHE_LOCK_TIMEOUT', 10))
+# Pre-render detail pages in the background when a worker starts
+app.config['CACHE_WARM_ON_STARTUP'] = os.environ.get('CACHE_WARM_ON_STARTUP', '').lower() in ('1', 'true', 'yes')
+app.config['CACHE_WARM_WORKERS'] = int(os.environ.get('CACHE_WARM_WORKERS', 4))
+app.config['CACHE_WARM_BUDGET'] = int(os.environ.get('CACHE_WARM_BUDGET', 300))
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+# Synonym and abbreviation expansions for search (defaults to data/synonyms.json)
+if os.environ.get('SEARCH_SYNONYMS_FILE'):
+    app.config['SEARCH_SYNONYMS_FILE'] = os.environ['SEARCH_SYNONYMS_FILE']
+# Size limits of the search result cache (entries, and approximate bytes of cached hits)
+app.config['SEARCH_CACHE_ENTRIES'] = int(os.environ.get('SEARCH_CACHE_ENTRIES', 1024))
+app.config['SEARCH_CACHE_BYTES'] = int(os.environ.get('SEARCH_CACHE_BYTES', 16 * 1024 * 1024))
+# Bearer token that lets a Prometheus scraper read /metrics without logging in
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 
 # Initialize the database
 db.init_app(app)
@@ -62,17 +94,26 @@ app.register_blueprint(auth.auth, url_prefix='/auth')
 # Initialize login manager
 login_manager.init_app(app)
 
+# Initialize cache tiers and the background expiry sweeper
+cache.init_app(app)
+
+# Fill the term tables of a database created before they existed
+with app.app_context():
+    try:
+        with db.engine.begin() as connection:
+            backfill_record_terms(connection)
+    except Exception as e:
+        logger.error(f"Could not backfill the term tables: {str(e)}")
+
+# Initialize the search and symptom indexes
+search_index.init_app(app)
+symptom_matching.init_app(app)
+
 # Ensure directories exist
 os.makedirs('data', exist_ok=True)
 os.makedirs('cache', exist_ok=True)
 os.makedirs('exports', exist_ok=True)
 
-@app.before_request
-def before_request_func():
-    """Clear expired cache before each request"""
-    clear_expired_cache()
-    return None
-
 def seed_database():
     """Seed the database with initial data"""
     with app.app_context():
@@ -144,7 +185,8 @@ def index():
     return render_template('index.html', conditions=conditions, medications=medications, specialties=specialties)
 
 @app.route('/search')
-@cache_result(expiration=300)  # Cache results for 5 minutes
+@cache_response(expiration=86400,  # Cache for 1 day; invalidated when any searched record changes
+                tags=('conditions', 'medications', 'specialties', 'references', 'guidelines'))
 def search():
     """Search for conditions, medications, and specialties"""
     query = request.args.get('q', '')
@@ -152,12 +194,14 @@ def search():
     specialty = request.args.get('specialty', 'all')
     medication_class = request.args.get('class', 'all')
     
+    # Filter options for the search form, from the in-memory search index
+    all_facets = search_index.memory_index.facet_counts()
+    all_specialties = sorted(value for value, _ in all_facets['specialty'])
+    all_medication_classes = sorted(value for value, _ in all_facets['medication_class'])
+    
     if not query:
-        # Get filter options for the search form
-        specialties = Specialty.query.order_by(Specialty.name).all()
-        medication_classes = db.session.query(Medication.class_name).distinct().order_by(Medication.class_name).all()
-        return render_template('search.html', results=None, query=None, 
-                              specialties=specialties, medication_classes=medication_classes,
+        return render_template('search.html', results=None, query=None, facets=None,
+                              specialties=all_specialties, medication_classes=all_medication_classes,
                               selected_category=category, selected_specialty=specialty, 
                               selected_class=medication_class)
     
@@ -177,46 +221,30 @@ def search():
     if medication_class != 'all':
         medication_query = medication_query.filter(Medication.class_name == medication_class)
     
-    # Search in conditions
-    if category in ['all', 'conditions']:
-        conditions = condition_query.filter(Condition.name.ilike(f'%{query}%') | 
-                                          Condition.description.ilike(f'%{query}%')).all()
-    else:
-        conditions = []
-    
-    # Search in medications with enhanced description search
-    if category in ['all', 'medications']:
-        medications = medication_query.filter(
-            Medication.name.ilike(f'%{query}%') | 
-            Medication.class_name.ilike(f'%{query}%') |
-            Medication.description.ilike(f'%{query}%') |
-            Medication.uses.ilike(f'%{query}%') |
-            Medication.dosing.ilike(f'%{query}%')
-        ).all()
-    else:
-        medications = []
-    
-    # Search in specialties
-    if category in ['all', 'specialties']:
-        specialties_results = specialty_query.filter(Specialty.name.ilike(f'%{query}%') | 
-                                           Specialty.description.ilike(f'%{query}%')).all()
-    else:
-        specialties_results = []
-    
-    # Search in references
-    if category in ['all', 'references']:
-        references = reference_query.filter(Reference.title.ilike(f'%{query}%') | 
-                                          Reference.authors.ilike(f'%{query}%')).all()
-    else:
-        references = []
-    
-    # Search in guidelines
-    if category in ['all', 'guidelines']:
-        guidelines = guideline_query.filter(Guideline.title.ilike(f'%{query}%') | 
-                                          Guideline.organization.ilike(f'%{query}%') |
-                                          Guideline.summary.ilike(f'%{query}%')).all()
-    else:
-        guidelines = []
+    # Find matching records in the full-text index, best match first
+    categories = {'conditions': 'condition', 'medications': 'medication', 'specialties': 'specialty',
+                  'references': 'reference', 'guidelines': 'guideline'}
+    searched = [entity_type for name, entity_type in categories.items() if category in ['all', name]]
+    hits = search_index.search(query, searched)
+    
+    # Retry misspelled searches with the closest condition and medication name words
+    corrected_query = None
+    if hits is not None and not any(hits.values()):
+        corrected_query = search_index.correct_query(query)
+        if corrected_query:
+            hits = search_index.search(corrected_query, searched)
+    
+    def matches(category_name, base_query):
+        entity_type = categories[category_name]
+        if entity_type not in searched:
+            return []
+        return search_index.ranked_records(base_query, entity_type, None if hits is None else hits[entity_type])
+    
+    conditions = matches('conditions', condition_query)
+    medications = matches('medications', medication_query)
+    specialties_results = matches('specialties', specialty_query)
+    references = matches('references', reference_query)
+    guidelines = matches('guidelines', guideline_query)
     
     # Combine results
     results = {
@@ -227,26 +255,28 @@ def search():
         'guidelines': guidelines
     }
     
-    # Get filter options for the search form
-    all_specialties = Specialty.query.order_by(Specialty.name).all()
-    all_medication_classes = db.session.query(Medication.class_name).distinct().order_by(Medication.class_name).all()
+    # Count the facet values of the results in one pass over the in-memory index
+    facets = search_index.memory_index.facet_counts(
+        (categories[category_name], record.id) for category_name, records in results.items() for record in records
+    )
+    facets = {facet: dict(values) for facet, values in facets.items()}
     
     # Log search query with filters
     logger.info(f"Search query: {query} - Category: {category} - Specialty: {specialty} - Class: {medication_class} - " +
                 f"Results: {len(conditions)} conditions, {len(medications)} medications, {len(specialties_results)} specialties, " +
                 f"{len(references)} references, {len(guidelines)} guidelines")
     
-    return render_template('search.html', results=results, query=query,
-                          specialties=all_specialties, medication_classes=all_medication_classes,
+    return render_template('search.html', results=results, query=query, corrected_query=corrected_query,
+                          facets=facets, specialties=all_specialties, medication_classes=all_medication_classes,
                           selected_category=category, selected_specialty=specialty, 
                           selected_class=medication_class)
 
 @app.route('/browse')
 def browse():
-    """Browse all conditions, medications, and specialties"""
+    """Browse all conditions, medications, and specialties, a page at a time by cursor"""
     category = request.args.get('category', 'conditions')
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
+    cursor = request.args.get('cursor')
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), MAX_PER_PAGE)
     specialty_filter = request.args.get('specialty', 'all')
     class_filter = request.args.get('class', 'all')
     
@@ -261,7 +291,7 @@ def browse():
         else:
             query = Condition.query
             
-        items = query.order_by(Condition.name).paginate(page=page, per_page=per_page)
+        items = keyset_paginate(query, Condition.name, Condition.id, per_page, cursor)
         template = 'condition_list.html'
         
     elif category == 'medications':
@@ -276,19 +306,19 @@ def browse():
         if class_filter != 'all':
             query = query.filter(Medication.class_name == class_filter)
             
-        items = query.order_by(Medication.name).paginate(page=page, per_page=per_page)
+        items = keyset_paginate(query, Medication.name, Medication.id, per_page, cursor)
         template = 'medication_list.html'
         
     elif category == 'specialties':
-        items = Specialty.query.order_by(Specialty.name).paginate(page=page, per_page=per_page)
+        items = keyset_paginate(Specialty.query, Specialty.name, Specialty.id, per_page, cursor)
         template = 'specialty_list.html'
         
     elif category == 'references':
-        items = Reference.query.order_by(Reference.title).paginate(page=page, per_page=per_page)
+        items = keyset_paginate(Reference.query, Reference.title, Reference.id, per_page, cursor)
         template = 'reference_list.html'
         
     elif category == 'guidelines':
-        items = Guideline.query.order_by(Guideline.title).paginate(page=page, per_page=per_page)
+        items = keyset_paginate(Guideline.query, Guideline.title, Guideline.id, per_page, cursor)
         template = 'guideline_list.html'
         
     else:
@@ -302,8 +332,15 @@ def browse():
                           specialty_filter=specialty_filter,
                           class_filter=class_filter)
 
+# Related rows shown on each detail page, which its ETag must cover
+CONDITION_PAGE_RELATED = ('specialty', 'medications', 'references')
+MEDICATION_PAGE_RELATED = ('conditions', 'references', 'related_to', 'related_to.related_medication')
+SPECIALTY_PAGE_RELATED = ('conditions', 'medications', 'guidelines')
+
 @app.route('/condition/<int:condition_id>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Condition, 'condition_id', related=CONDITION_PAGE_RELATED))
 def condition_detail(condition_id):
     """Display details for a specific condition"""
     condition = Condition.query.get_or_404(condition_id)
@@ -318,6 +355,10 @@ def condition_detail(condition_id):
     # Get related references
     references = condition.references
     
+    add_cache_tags(f"condition:{condition.id}", f"specialty:{condition.specialty_id}",
+                   *[f"medication:{m.id}" for m in medications],
+                   *[f"reference:{r.id}" for r in references])
+    
     return render_template('condition.html', 
                           condition=condition, 
                           symptoms=symptoms, 
@@ -326,7 +367,9 @@ def condition_detail(condition_id):
                           references=references)
 
 @app.route('/condition/<string:condition_name>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Condition, 'condition_name', column='name', related=CONDITION_PAGE_RELATED))
 def condition_detail_by_name(condition_name):
     """Display details for a specific condition by name"""
     condition = Condition.query.filter_by(name=condition_name).first_or_404()
@@ -341,6 +384,10 @@ def condition_detail_by_name(condition_name):
     # Get related references
     references = condition.references
     
+    add_cache_tags(f"condition:{condition.id}", f"specialty:{condition.specialty_id}",
+                   *[f"medication:{m.id}" for m in medications],
+                   *[f"reference:{r.id}" for r in references])
+    
     return render_template('condition.html', 
                           condition=condition, 
                           symptoms=symptoms, 
@@ -349,7 +396,9 @@ def condition_detail_by_name(condition_name):
                           references=references)
 
 @app.route('/medication/<int:medication_id>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Medication, 'medication_id', related=MEDICATION_PAGE_RELATED))
 def medication_detail(medication_id):
     """Display details for a specific medication"""
     medication = Medication.query.get_or_404(medication_id)
@@ -360,7 +409,7 @@ def medication_detail(medication_id):
     contraindications = safe_json_loads(medication.contraindications, [])
     
     # Get related conditions
-    conditions = medication.conditions
+    conditions = medication.conditions.all()
     
     # Get references
     references = medication.references
@@ -368,6 +417,12 @@ def medication_detail(medication_id):
     # Get related medications
     related_medications = MedicationRelationship.query.filter_by(medication_id=medication_id).all()
     
+    add_cache_tags(f"medication:{medication.id}", f"medication_class:{medication.class_name}",
+                   'medication_relationships',
+                   *[f"condition:{c.id}" for c in conditions],
+                   *[f"reference:{r.id}" for r in references],
+                   *[f"medication:{r.related_medication_id}" for r in related_medications])
+    
     return render_template('medication.html', 
                           medication=medication, 
                           uses=uses, 
@@ -378,7 +433,9 @@ def medication_detail(medication_id):
                           related_medications=related_medications)
 
 @app.route('/medication/<string:medication_name>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Medication, 'medication_name', column='name', related=MEDICATION_PAGE_RELATED))
 def medication_detail_by_name(medication_name):
     """Display details for a specific medication by name"""
     medication = Medication.query.filter_by(name=medication_name).first_or_404()
@@ -389,7 +446,7 @@ def medication_detail_by_name(medication_name):
     contraindications = safe_json_loads(medication.contraindications, [])
     
     # Get related conditions
-    conditions = medication.conditions
+    conditions = medication.conditions.all()
     
     # Get references
     references = medication.references
@@ -397,6 +454,12 @@ def medication_detail_by_name(medication_name):
     # Get related medications
     related_medications = MedicationRelationship.query.filter_by(medication_id=medication.id).all()
     
+    add_cache_tags(f"medication:{medication.id}", f"medication_class:{medication.class_name}",
+                   'medication_relationships',
+                   *[f"condition:{c.id}" for c in conditions],
+                   *[f"reference:{r.id}" for r in references],
+                   *[f"medication:{r.related_medication_id}" for r in related_medications])
+    
     return render_template('medication.html', 
                           medication=medication, 
                           uses=uses, 
@@ -412,7 +475,9 @@ def preview_medication(medication_name):
     return redirect(url_for('medication_detail_by_name', medication_name=medication_name))
 
 @app.route('/specialty/<int:specialty_id>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Specialty, 'specialty_id', related=SPECIALTY_PAGE_RELATED))
 def specialty_detail(specialty_id):
     """Display details for a specific specialty"""
     specialty = Specialty.query.get_or_404(specialty_id)
@@ -420,6 +485,11 @@ def specialty_detail(specialty_id):
     medications = specialty.medications.all()
     guidelines = specialty.guidelines.all()
     
+    add_cache_tags(f"specialty:{specialty.id}",
+                   *[f"condition:{c.id}" for c in conditions],
+                   *[f"medication:{m.id}" for m in medications],
+                   *[f"guideline:{g.id}" for g in guidelines])
+    
     return render_template('specialty.html', 
                           specialty=specialty, 
                           conditions=conditions,
@@ -427,7 +497,9 @@ def specialty_detail(specialty_id):
                           guidelines=guidelines)
 
 @app.route('/specialty/<string:specialty_name>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Specialty, 'specialty_name', column='name', related=SPECIALTY_PAGE_RELATED))
 def specialty_detail_by_name(specialty_name):
     """Display details for a specific specialty by name"""
     specialty = Specialty.query.filter_by(name=specialty_name).first_or_404()
@@ -435,6 +507,11 @@ def specialty_detail_by_name(specialty_name):
     medications = specialty.medications.all()
     guidelines = specialty.guidelines.all()
     
+    add_cache_tags(f"specialty:{specialty.id}",
+                   *[f"condition:{c.id}" for c in conditions],
+                   *[f"medication:{m.id}" for m in medications],
+                   *[f"guideline:{g.id}" for g in guidelines])
+    
     return render_template('specialty.html', 
                           specialty=specialty, 
                           conditions=conditions,
@@ -442,17 +519,23 @@ def specialty_detail_by_name(specialty_name):
                           guidelines=guidelines)
 
 @app.route('/reference/<int:reference_id>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Reference, 'reference_id'))
 def reference_detail(reference_id):
     """Display details for a specific reference"""
     reference = Reference.query.get_or_404(reference_id)
+    add_cache_tags(f"reference:{reference.id}")
     return render_template('reference.html', reference=reference)
 
 @app.route('/guideline/<int:guideline_id>')
-@cache_result(expiration=3600)  # Cache for 1 hour
+@cache_response(expiration=604800,  # Cache for 7 days; invalidated by record tags
+                stale_while_revalidate=86400,  # Then serve stale for up to 1 day while re-rendering
+                validator=record_validator(Guideline, 'guideline_id', related=('specialty',)))
 def guideline_detail(guideline_id):
     """Display details for a specific guideline"""
     guideline = Guideline.query.get_or_404(guideline_id)
+    add_cache_tags(f"guideline:{guideline.id}", f"specialty:{guideline.specialty_id}")
     return render_template('guideline.html', guideline=guideline)
 
 @app.route('/visualizations')
@@ -648,6 +731,11 @@ def page_not_found(e):
     """Handle 404 errors"""
     return render_template('404.html'), 404
 
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    """Handle malformed pagination cursors"""
+    return render_template('error.html', title='Invalid page', message=str(e)), 400
+
 @app.errorhandler(500)
 def server_error(e):
     """Handle 500 errors"""
@@ -708,6 +796,7 @@ def generate_medication_relationships():
     
     # Commit changes
     db.session.commit()
+    invalidate_tags('medication_relationships')
     return f"Generated {len(processed_pairs)} medication relationships"
 
 @app.route('/admin/generate-relationships')
@@ -718,6 +807,80 @@ def admin_generate_relationships():
     flash(result, 'success')
     return redirect(url_for('index'))
 
+@app.route('/admin/cache/stats')
+@login_required
+def admin_cache_stats():
+    """Admin route reporting this worker's cache counters as JSON"""
+    if not current_user.is_admin:
+        abort(403)
+    return jsonify({'pid': os.getpid(), 'backend': cache.backend.name, 'stats': cache.cache_stats.snapshot()})
+
+@app.route('/metrics')
+def metrics():
+    """Cache counters in the Prometheus text format, for admins or holders of METRICS_TOKEN"""
+    token = app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    has_token = bool(token) and hmac.compare_digest(authorization, f"Bearer {token}")
+    if not has_token and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    return Response(cache.cache_stats.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+def cache_warmup_paths():
+    """List the cached detail and aggregate pages the cache warmer should render"""
+    detail_views = [
+        ('condition_detail', 'condition_id', Condition),
+        ('medication_detail', 'medication_id', Medication),
+        ('specialty_detail', 'specialty_id', Specialty),
+        ('reference_detail', 'reference_id', Reference),
+        ('guideline_detail', 'guideline_id', Guideline)
+    ]
+    
+    with app.test_request_context():
+        # The search landing page aggregates every specialty and medication class
+        paths = [url_for('search')]
+        for endpoint, argument, model in detail_views:
+            for (item_id,) in db.session.query(model.id).order_by(model.id):
+                paths.append(url_for(endpoint, **{argument: item_id}))
+    
+    return paths
+
+@app.cli.command('warm-cache')
+@click.option('--workers', type=int, default=None, help='Pages rendered concurrently')
+@click.option('--budget', type=int, default=None, help='Time budget in seconds (0 for no limit)')
+def warm_cache_command(workers, budget):
+    """Pre-render cached detail pages after a deploy"""
+    if workers is not None:
+        cache.cache_warmer.workers = workers
+    if budget is not None:
+        cache.cache_warmer.time_budget = budget
+    
+    def progress(done, total, summary):
+        click.echo(f"\r{done}/{total} pages", nl=done == total)
+    
+    summary = cache.cache_warmer.run(app, cache_warmup_paths(), progress=progress)
+    click.echo(f"Warmed {summary['warmed']} pages, {summary['cached']} already cached, "
+               f"{summary['failed']} failed, {summary['skipped']} skipped in {summary['seconds']}s")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Re-index every searchable record"""
+    with db.engine.begin() as connection:
+        search_index.install_backend(connection)
+        indexed = search_index.rebuild_index(connection)
+    click.echo(f"Indexed {indexed} records with the {search_index.backend.name} search backend")
+
+@app.cli.command('rebuild-term-index')
+def rebuild_term_index_command():
+    """Rebuild the term tables of the JSON list columns (symptoms, uses, contraindications, ...)"""
+    db.create_all()
+    with db.engine.begin() as connection:
+        written = rebuild_record_terms(connection)
+    click.echo(f"Indexed {written} list items")
+
+# Started once per server, not on import (see CacheWarmer.warm_on_startup)
+if app.config['CACHE_WARM_ON_STARTUP']:
+    cache.cache_warmer.warm_on_startup(app, cache_warmup_paths)
+
 if __name__ == '__main__':
     with app.app_context():
         # Create database tables if they don't exist
@@ -744,6 +907,8 @@ if __name__ == '__main__':
             except Exception as e:
                 print(f"Error generating medication relationships: {str(e)}")
     
+    cache.cache_warmer.start_startup_warmup()
+    
     # Get port from environment variable or use default
     port = int(os.environ.get('PORT', 5000))
     
@@ -3,12 +3,35 @@ Caching module for the medical reference app
 
 This module provides caching functionality to improve performance.
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
-import json
+from urllib.parse import urlencode
+from flask import (
+    Response, copy_current_request_context, current_app, g, has_app_context,
+    has_request_context, make_response, request, session
+)
+from werkzeug.http import http_date
+from flask_login import current_user
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import aliased
+from datetime import timezone
+import base64
+import heapq
+import logging
 import os
+import threading
 import time
 import hashlib
 
+from cache_backends import EntryFormatError, FileBackend, create_backend, decode_entry, encode_entry
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are unavailable on this platform; single-flight is per process only
+    fcntl = None
+
 # Cache directory
 CACHE_DIR = 'cache'
 os.makedirs(CACHE_DIR, exist_ok=True)
@@ -16,6 +39,800 @@ os.makedirs(CACHE_DIR, exist_ok=True)
 # Default cache expiration time (in seconds)
 DEFAULT_EXPIRATION = 3600  # 1 hour
 
+# Default in-process memory tier settings
+DEFAULT_MEMORY_CAPACITY = 512  # entries
+DEFAULT_MEMORY_TTL = 300  # 5 minutes
+
+# Default background expiry settings (in seconds)
+DEFAULT_SWEEP_INTERVAL = 60  # 1 minute
+DEFAULT_RECONCILE_INTERVAL = 3600  # 1 hour
+DEFAULT_INVALIDATION_POLL = 1  # 1 second
+
+# Default time (in seconds) a caller waits for another caller computing the same entry
+DEFAULT_LOCK_TIMEOUT = 10
+
+# Default shared tier
+DEFAULT_BACKEND = 'file'
+
+# Default cache warmer settings
+DEFAULT_WARM_WORKERS = 4
+DEFAULT_WARM_BUDGET = 300  # seconds
+
+# Location of the cross-process locks inside CACHE_DIR
+LOCKS_DIR = 'locks'
+
+# Age (in seconds) after which an unused lock file is removed by the sweeper
+LOCK_FILE_MAX_AGE = 3600
+
+logger = logging.getLogger(__name__)
+
+class MemoryCache:
+    """
+    Thread-safe in-process LRU cache used as the first tier in front of the backend
+    
+    Each entry keeps the timestamp at which the result was originally computed, so an
+    entry promoted from the backend expires at the same moment as the stored entry.
+    The memory TTL additionally caps how long an entry may live in this process
+    before the backend (which other workers may have refreshed) is consulted again.
+    """
+    
+    def __init__(self, capacity=DEFAULT_MEMORY_CAPACITY, ttl=DEFAULT_MEMORY_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+    
+    def get(self, key, expiration=DEFAULT_EXPIRATION):
+        """
+        Look up a fresh entry
+        
+        Args:
+            key: Cache key
+            expiration: Expiration time in seconds of the calling cache
+            
+        Returns:
+            tuple: (hit, result)
+        """
+        entry = self.get_entry(key, expiration)
+        if entry is None:
+            return False, None
+        return True, entry[1]
+    
+    def get_entry(self, key, max_age=None):
+        """
+        Look up an entry together with the time it was computed
+        
+        Args:
+            key: Cache key
+            max_age: Maximum age in seconds (None for any age within the memory TTL)
+            
+        Returns:
+            tuple: (timestamp, result), or None if there is no usable entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            timestamp, stored_at, result = entry
+            now = time.time()
+            if (max_age is not None and now - timestamp >= max_age) or now - stored_at >= self.ttl:
+                del self._entries[key]
+                return None
+            
+            self._entries.move_to_end(key)
+            return timestamp, result
+    
+    def set(self, key, result, timestamp=None):
+        """
+        Store an entry, evicting the least recently used entries over capacity
+        
+        Args:
+            key: Cache key
+            result: Value to store
+            timestamp: Time the value was computed (default: now)
+        """
+        if self.capacity <= 0:
+            return
+        
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (timestamp if timestamp is not None else now, now, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        """Remove an entry if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+    
+    def configure(self, capacity=None, ttl=None):
+        """Update capacity and TTL, trimming entries if the capacity shrank"""
+        with self._lock:
+            if capacity is not None:
+                self.capacity = capacity
+            if ttl is not None:
+                self.ttl = ttl
+            while len(self._entries) > max(self.capacity, 0):
+                self._entries.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._entries)
+
+class CacheStats:
+    """
+    Per-function, per-backend cache counters for this process
+    
+    Counters are keyed by the name of the cached function or view (the prefix
+    of its cache keys) and the backend in use. Each worker process keeps its
+    own counters.
+    """
+    
+    COUNTERS = (
+        ('hits', 'Lookups answered with a fresh entry'),
+        ('misses', 'Lookups that computed the result'),
+        ('stale', 'Lookups answered with an expired entry'),
+        ('bytes_read', 'Encoded entry bytes read from the backend'),
+        ('bytes_written', 'Encoded entry bytes written to the backend'),
+        ('serialization_seconds', 'Time spent encoding and decoding entries')
+    )
+    
+    # Lookup status reported by fetch_or_compute -> counter
+    STATUS_COUNTERS = {'HIT': 'hits', 'MISS': 'misses', 'STALE': 'stale'}
+    
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+    
+    def record(self, cache_key, **increments):
+        """
+        Add to the counters of the function a cache key belongs to
+        
+        Args:
+            cache_key: Cache key built by get_cache_key
+            **increments: Counter names and amounts
+        """
+        labels = (get_key_name(cache_key), backend.name)
+        with self._lock:
+            counters = self._counters.get(labels)
+            if counters is None:
+                counters = self._counters[labels] = {name: 0 for name, _ in self.COUNTERS}
+            for name, amount in increments.items():
+                counters[name] += amount
+    
+    def record_status(self, cache_key, status):
+        """Count a lookup by its fetch_or_compute status"""
+        self.record(cache_key, **{self.STATUS_COUNTERS[status]: 1})
+    
+    def snapshot(self):
+        """
+        Return a copy of all counters
+        
+        Returns:
+            list: One dictionary per function and backend, with 'function',
+                'backend' and a key per counter
+        """
+        with self._lock:
+            return [
+                dict(function=function, backend=backend_name, **counters)
+                for (function, backend_name), counters in sorted(self._counters.items())
+            ]
+    
+    def render_prometheus(self, prefix='medref_cache'):
+        """
+        Render all counters in the Prometheus text exposition format
+        
+        Returns:
+            str: Exposition text
+        """
+        stats = self.snapshot()
+        lines = []
+        for name, description in self.COUNTERS:
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for row in stats:
+                labels = f'function="{escape_label(row["function"])}",backend="{escape_label(row["backend"])}"'
+                lines.append(f"{metric}{{{labels}}} {row[name]}")
+        return '\n'.join(lines) + '\n'
+    
+    def reset(self):
+        """Reset all counters"""
+        with self._lock:
+            self._counters.clear()
+
+def escape_label(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class ExpiryIndex:
+    """
+    Min-heap of expiry times for cache entries written or read by this process
+    
+    Lets the sweeper find due entries in O(log n) each instead of listing and
+    parsing the whole cache directory.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._expires = {}
+        self._lock = threading.Lock()
+    
+    def add(self, key, expires_at):
+        """Record (or move) the expiry time of a key"""
+        with self._lock:
+            if self._expires.get(key) == expires_at:
+                return
+            self._expires[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, key))
+    
+    def discard(self, key):
+        """Forget a key; its heap entry is skipped lazily"""
+        with self._lock:
+            self._expires.pop(key, None)
+    
+    def pop_expired(self, now=None):
+        """
+        Remove and return all keys whose expiry time has passed
+        
+        Args:
+            now: Reference time (default: current time)
+            
+        Returns:
+            list: Expired cache keys
+        """
+        now = time.time() if now is None else now
+        expired = []
+        
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._heap)
+                # Skip heap entries superseded by a later write
+                if self._expires.get(key) == expires_at:
+                    del self._expires[key]
+                    expired.append(key)
+        
+        return expired
+    
+    def clear(self):
+        """Forget all keys"""
+        with self._lock:
+            self._heap = []
+            self._expires.clear()
+    
+    def __len__(self):
+        return len(self._expires)
+
+class TagIndex:
+    """
+    Maps dependency tags (e.g. 'condition:42') to the cache keys that depend on them
+    
+    The mapping is kept in memory for this process and mirrored to the backend, so
+    any worker can find and delete the entries written by another. Invalidated tags
+    are also published through the backend's journal, which every worker polls to
+    drop its own memory-tier entries.
+    """
+    
+    def __init__(self):
+        self._keys = {}
+        self._tags = {}
+        self._lock = threading.Lock()
+        self._journal_cursor = None
+    
+    def add(self, key, tags, persist=True, expires_at=None):
+        """
+        Record that a cache key depends on the given tags
+        
+        Args:
+            key: Cache key
+            tags: Iterable of tag strings
+            persist: Also record the key in the backend's tag index
+            expires_at: Hard expiry time of the entry, which the backend's tag
+                index must outlive
+        """
+        tags = list(tags)
+        with self._lock:
+            for tag in tags:
+                self._keys.setdefault(tag, set()).add(key)
+            if tags:
+                self._tags.setdefault(key, set()).update(tags)
+        
+        # Always written, since the backend drops the tags of entries it purges
+        if persist and tags:
+            backend.add_tags(key, tags, expires_at)
+    
+    def discard(self, keys):
+        """
+        Forget cache keys whose entries were removed, e.g. because they expired
+        
+        Args:
+            keys: Iterable of cache keys
+        """
+        with self._lock:
+            for key in keys:
+                for tag in self._tags.pop(key, ()):
+                    tag_keys = self._keys.get(tag)
+                    if tag_keys is not None:
+                        tag_keys.discard(key)
+                        if not tag_keys:
+                            del self._keys[tag]
+    
+    def _pop_local(self, tag):
+        with self._lock:
+            keys = self._keys.pop(tag, set())
+            for key in keys:
+                key_tags = self._tags.get(key)
+                if key_tags is not None:
+                    key_tags.discard(tag)
+                    if not key_tags:
+                        del self._tags[key]
+        return keys
+    
+    def pop(self, tag):
+        """
+        Remove a tag and return every key that depends on it
+        
+        Args:
+            tag: Tag string
+            
+        Returns:
+            set: Cache keys known to this process or recorded in the backend
+        """
+        return self._pop_local(tag) | backend.pop_tag(tag)
+    
+    def publish(self, tags, now=None):
+        """Append invalidated tags to the shared journal"""
+        backend.publish_invalidations(tags, time.time() if now is None else now)
+    
+    def apply_journal(self):
+        """
+        Drop memory-tier entries for tags invalidated by other workers
+        
+        Returns:
+            int: Number of memory entries dropped
+        """
+        self._journal_cursor, tags = backend.poll_invalidations(self._journal_cursor)
+        
+        dropped = 0
+        for tag in tags:
+            for key in self._pop_local(tag):
+                memory_cache.delete(key)
+                dropped += 1
+        
+        notify_invalidation(tags)
+        return dropped
+    
+    def compact_journal(self, keep_after):
+        """
+        Discard journal entries older than keep_after
+        
+        Args:
+            keep_after: Timestamp; older invalidations are discarded
+        """
+        backend.compact_invalidations(keep_after)
+    
+    def clear(self):
+        """Forget all tags known to this process"""
+        with self._lock:
+            self._keys.clear()
+            self._tags.clear()
+        self._journal_cursor = None
+
+class ExpiryScheduler:
+    """
+    Background thread that removes expired cache entries
+    
+    Every sweep interval it drops the entries due in the expiry index. Every
+    reconcile interval it also asks the backend to purge all expired entries, to
+    pick up entries written by other workers or by a previous run, and removes
+    unused lock files. Between sweeps it polls the invalidation journal so tag
+    invalidations reach this worker quickly.
+    """
+    
+    def __init__(self, interval=DEFAULT_SWEEP_INTERVAL, reconcile_interval=DEFAULT_RECONCILE_INTERVAL,
+                 poll_interval=DEFAULT_INVALIDATION_POLL):
+        self.interval = interval
+        self.reconcile_interval = reconcile_interval
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_reconcile = 0
+    
+    def start(self):
+        """Start the sweeper thread if it is not already running"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cache-expiry', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop the sweeper thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+    
+    def run_once(self, now=None):
+        """
+        Perform a single sweep
+        
+        Args:
+            now: Reference time (default: current time)
+            
+        Returns:
+            int: Number of stored entries removed
+        """
+        now = time.time() if now is None else now
+        
+        expired = expiry_index.pop_expired(now)
+        for key in expired:
+            memory_cache.delete(key)
+        tag_index.discard(expired)
+        # The backend keeps entries another worker rewrote with a later expiry
+        removed = backend.expire(expired, now)
+        
+        if self.reconcile_interval and now - self._last_reconcile >= self.reconcile_interval:
+            self._last_reconcile = now
+            removed += clear_expired_cache(now)
+            tag_index.compact_journal(now - memory_cache.ttl)
+            FileLock.remove_unused(now)
+        
+        return removed
+    
+    def _run(self):
+        last_sweep = time.time()
+        while not self._stop.wait(min(self.poll_interval or self.interval, self.interval)):
+            try:
+                tag_index.apply_journal()
+                if time.time() - last_sweep >= self.interval:
+                    last_sweep = time.time()
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"Cache expiry sweep failed: {str(e)}")
+
+class CacheWarmer:
+    """
+    Pre-populates the response cache by requesting pages through the app
+    
+    Pages are fetched with the Flask test client on a bounded pool of worker
+    threads, as an anonymous visitor would see them, so they land under the same
+    cache keys as real requests. Pages already cached are left alone. Pages not
+    started before the time budget runs out are skipped.
+    """
+    
+    # Fraction of the pages between progress log lines
+    PROGRESS_STEP = 0.1
+    
+    def __init__(self, workers=DEFAULT_WARM_WORKERS, time_budget=DEFAULT_WARM_BUDGET):
+        self.workers = workers
+        self.time_budget = time_budget
+        self._thread = None
+        self._startup = None
+    
+    def run(self, app, paths, progress=None):
+        """
+        Request every path once
+        
+        Args:
+            app: Flask application
+            paths: Iterable of URL paths, e.g. '/condition/1'
+            progress: Optional callable(done, total, summary) called after each page
+            
+        Returns:
+            dict: Counts of 'warmed' (rendered and cached), 'cached' (already
+                cached), 'failed' and 'skipped' pages, plus 'total' and 'seconds'
+        """
+        paths = list(paths)
+        started = time.time()
+        deadline = started + self.time_budget if self.time_budget else None
+        summary = {'total': len(paths), 'warmed': 0, 'cached': 0, 'failed': 0, 'skipped': 0, 'seconds': 0}
+        
+        def fetch(path):
+            if deadline is not None and time.time() >= deadline:
+                return 'skipped'
+            response = app.test_client().get(path)
+            if response.status_code != 200:
+                return 'failed'
+            return 'warmed' if response.headers.get('X-Cache') == 'MISS' else 'cached'
+        
+        logger.info(f"Warming {len(paths)} cached pages with {self.workers} workers")
+        next_report = self.PROGRESS_STEP
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix='cache-warm') as executor:
+            futures = {executor.submit(fetch, path): path for path in paths}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    logger.warning(f"Warming {futures[future]} failed: {str(e)}")
+                    outcome = 'failed'
+                summary[outcome] += 1
+                
+                if progress is not None:
+                    progress(done, len(paths), summary)
+                if done >= next_report * len(paths):
+                    next_report += self.PROGRESS_STEP
+                    logger.info(f"Cache warm-up: {done}/{len(paths)} pages")
+        
+        summary['seconds'] = round(time.time() - started, 3)
+        logger.info(
+            f"Cache warm-up finished in {summary['seconds']}s: {summary['warmed']} warmed, "
+            f"{summary['cached']} already cached, {summary['failed']} failed, {summary['skipped']} skipped"
+        )
+        return summary
+    
+    def start(self, app, get_paths):
+        """
+        Run the warm-up on a background thread if one is not already running
+        
+        Args:
+            app: Flask application
+            get_paths: Callable returning the paths to warm; called on the
+                thread inside an app context
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        
+        def run():
+            try:
+                with app.app_context():
+                    paths = get_paths()
+                self.run(app, paths)
+            except Exception as e:
+                logger.error(f"Cache warm-up failed: {str(e)}")
+        
+        self._thread = threading.Thread(target=run, name='cache-warmer', daemon=True)
+        self._thread.start()
+    
+    def warm_on_startup(self, app, get_paths):
+        """
+        Register the warm-up a server process runs once it is serving
+        
+        Nothing starts here, so importing the app from CLI commands, importers
+        or each gunicorn worker does not warm the cache. The server starts the
+        warm-up with start_startup_warmup: the development server directly, and
+        gunicorn from its first worker (see gunicorn_config.py).
+        
+        Args:
+            app: Flask application
+            get_paths: Callable returning the paths to warm (see start)
+        """
+        self._startup = (app, get_paths)
+    
+    def start_startup_warmup(self):
+        """Start the warm-up registered with warm_on_startup, if any"""
+        if self._startup is not None:
+            self.start(*self._startup)
+    
+    def join(self, timeout=None):
+        """Wait for a background warm-up to finish"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+class KeyLocks:
+    """
+    Per-key in-process locks, created on demand and discarded once unused
+    
+    Under gunicorn's gevent workers threading is monkey-patched, so these locks
+    coordinate greenlets as well as threads.
+    """
+    
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+    
+    def acquire(self, key, timeout=0):
+        """
+        Register interest in a key and try to take its lock
+        
+        Every call must be paired with release(), whether or not the lock was taken.
+        
+        Args:
+            key: Cache key
+            timeout: Seconds to wait (0 to try once, None to wait forever)
+            
+        Returns:
+            bool: True if the lock was taken
+        """
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        return self.retry(key, timeout)
+    
+    def retry(self, key, timeout=None):
+        """Wait for the lock of a key previously registered with acquire()"""
+        lock = self._locks[key][0]
+        if timeout == 0:
+            return lock.acquire(blocking=False)
+        return lock.acquire(timeout=-1 if timeout is None else timeout)
+    
+    def release(self, key, acquired):
+        """Release the lock (if taken) and drop interest in a key"""
+        with self._guard:
+            entry = self._locks[key]
+            if acquired:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+class FileLock:
+    """
+    Cross-process exclusive lock on a file in CACHE_DIR/locks
+    
+    Each key has its own lock file, so only callers of the same key wait for each
+    other. Waiting polls a non-blocking flock with short sleeps, so a gevent worker
+    keeps serving other greenlets while it waits. Lock files unused for
+    LOCK_FILE_MAX_AGE are removed by the sweeper (see remove_unused).
+    """
+    
+    POLL_INTERVAL = 0.05
+    
+    def __init__(self, key):
+        key_hash = hashlib.md5(key.encode()).hexdigest()
+        self.path = os.path.join(CACHE_DIR, LOCKS_DIR, f"{key_hash}.lock")
+        self._file = None
+    
+    def acquire(self, timeout=0):
+        """
+        Try to take the lock
+        
+        Args:
+            timeout: Seconds to wait (0 to try once)
+            
+        Returns:
+            bool: True if the lock was taken
+        """
+        if fcntl is None:
+            return True
+        
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        deadline = time.time() + timeout
+        
+        while True:
+            self._file = open(self.path, 'a')
+            if _try_flock(self._file):
+                # The sweeper may have removed the file before we locked it
+                if _is_current(self._file, self.path):
+                    os.utime(self._file.fileno())
+                    return True
+                self._file.close()
+                continue
+            
+            self._file.close()
+            self._file = None
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.POLL_INTERVAL)
+    
+    def release(self):
+        """Release the lock if held"""
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+    
+    @staticmethod
+    def remove_unused(now=None, max_age=LOCK_FILE_MAX_AGE):
+        """
+        Remove lock files that have not been taken for max_age seconds
+        
+        A file is only removed while holding its lock, and acquire() checks that
+        the file it locked is still in place, so removal never lets two callers
+        hold the lock of one key.
+        
+        Args:
+            now: Reference time (default: current time)
+            max_age: Seconds since a lock file was last taken
+            
+        Returns:
+            int: Number of lock files removed
+        """
+        locks_dir = os.path.join(CACHE_DIR, LOCKS_DIR)
+        if fcntl is None or not os.path.isdir(locks_dir):
+            return 0
+        
+        now = time.time() if now is None else now
+        removed = 0
+        with os.scandir(locks_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime > now - max_age:
+                        continue
+                    with open(entry.path, 'a') as f:
+                        if (_try_flock(f) and _is_current(f, entry.path)
+                                and os.fstat(f.fileno()).st_mtime <= now - max_age):
+                            os.remove(entry.path)
+                            removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+def _try_flock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+def _is_current(f, path):
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+# Process-wide memory tier, shared backend and counters
+memory_cache = MemoryCache()
+backend = FileBackend(CACHE_DIR)
+cache_stats = CacheStats()
+
+# Process-wide single-flight locks
+key_locks = KeyLocks()
+lock_timeout = DEFAULT_LOCK_TIMEOUT
+
+# Process-wide expiry index, tag index and sweeper
+expiry_index = ExpiryIndex()
+tag_index = TagIndex()
+expiry_scheduler = ExpiryScheduler()
+
+# Process-wide cache warmer
+cache_warmer = CacheWarmer()
+
+def init_app(app):
+    """
+    Configure the cache from the Flask app config
+    
+    Recognised settings:
+    - CACHE_DIR: Directory for the file backend and cross-process locks
+    - CACHE_BACKEND: Shared tier: 'file', 'memory', 'sqlite' or 'redis'
+    - CACHE_SQLITE_PATH: Database file for the sqlite backend (default: CACHE_DIR/cache.sqlite3)
+    - CACHE_REDIS_URL: Server URL for the redis backend, e.g. redis://localhost:6379/0
+    - CACHE_MEMORY_CAPACITY: Maximum number of entries held in memory (0 disables the tier)
+    - CACHE_MEMORY_TTL: Maximum time in seconds an entry stays in memory
+    - CACHE_SWEEP_INTERVAL: Seconds between background expiry sweeps (0 disables the sweeper)
+    - CACHE_RECONCILE_INTERVAL: Seconds between full purges of expired backend entries
+    - CACHE_INVALIDATION_POLL: Seconds between checks for tags invalidated by other workers
+    - CACHE_LOCK_TIMEOUT: Seconds a caller waits for another caller computing the same entry
+    - CACHE_WARM_WORKERS: Number of pages the cache warmer renders concurrently
+    - CACHE_WARM_BUDGET: Seconds the cache warmer may run (0 for no limit)
+    
+    Args:
+        app: Flask application
+    """
+    global CACHE_DIR, backend, lock_timeout
+    
+    CACHE_DIR = app.config.get('CACHE_DIR', CACHE_DIR)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    backend = create_backend(
+        app.config.get('CACHE_BACKEND', DEFAULT_BACKEND),
+        CACHE_DIR,
+        sqlite_path=app.config.get('CACHE_SQLITE_PATH'),
+        redis_url=app.config.get('CACHE_REDIS_URL')
+    )
+    tag_index.clear()
+    lock_timeout = app.config.get('CACHE_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+    
+    memory_cache.configure(
+        capacity=app.config.get('CACHE_MEMORY_CAPACITY', DEFAULT_MEMORY_CAPACITY),
+        ttl=app.config.get('CACHE_MEMORY_TTL', DEFAULT_MEMORY_TTL)
+    )
+    
+    expiry_scheduler.interval = app.config.get('CACHE_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL)
+    expiry_scheduler.reconcile_interval = app.config.get('CACHE_RECONCILE_INTERVAL', DEFAULT_RECONCILE_INTERVAL)
+    expiry_scheduler.poll_interval = app.config.get('CACHE_INVALIDATION_POLL', DEFAULT_INVALIDATION_POLL)
+    if expiry_scheduler.interval > 0:
+        expiry_scheduler.start()
+    
+    cache_warmer.workers = app.config.get('CACHE_WARM_WORKERS', DEFAULT_WARM_WORKERS)
+    cache_warmer.time_budget = app.config.get('CACHE_WARM_BUDGET', DEFAULT_WARM_BUDGET)
+
 def get_cache_key(func_name, *args, **kwargs):
     """
     Generate a unique cache key based on function name and arguments
@@ -37,12 +854,344 @@ def get_cache_key(func_name, *args, **kwargs):
     # Combine function name and argument hash
     return f"{func_name}_{arg_hash}"
 
-def cache_result(expiration=DEFAULT_EXPIRATION):
+def get_key_name(cache_key):
+    """
+    Return the function name a cache key was built from
+    
+    Args:
+        cache_key: Cache key built by get_cache_key
+        
+    Returns:
+        str: Function name
+    """
+    return cache_key.rsplit('_', 1)[0]
+
+def get_entry(cache_key, max_age=None):
+    """
+    Look up a cache entry in the memory tier, then the backend
+    
+    Args:
+        cache_key: Cache key
+        max_age: Maximum age in seconds (None to accept expired entries still stored)
+        
+    Returns:
+        tuple: (timestamp, result), or None if there is no usable entry
+    """
+    # Serve from the memory tier without touching the backend
+    entry = memory_cache.get_entry(cache_key, max_age)
+    if entry is not None:
+        return entry
+    
+    data = backend.get(cache_key, None if max_age is None else time.time() - max_age)
+    if data is None:
+        return None
+    
+    started = time.perf_counter()
+    try:
+        cache_data, expires_at = decode_entry(data)
+    except EntryFormatError as e:
+        logger.warning(f"Discarding unreadable cache entry {cache_key}: {str(e)}")
+        return None
+    cache_stats.record(
+        cache_key, bytes_read=len(data), serialization_seconds=time.perf_counter() - started
+    )
+    
+    # Check if cache is expired
+    if max_age is not None and time.time() - cache_data['timestamp'] >= max_age:
+        return None
+    
+    # Indexed so the sweeper forgets the entry's tags once it expires
+    expiry_index.add(cache_key, expires_at)
+    tag_index.add(cache_key, cache_data.get('tags', []), persist=False)
+    memory_cache.set(cache_key, cache_data['result'], cache_data['timestamp'])
+    return cache_data['timestamp'], cache_data['result']
+
+def get_cached(cache_key, expiration=DEFAULT_EXPIRATION):
+    """
+    Look up a fresh cache entry in the memory tier, then the backend
+    
+    Args:
+        cache_key: Cache key
+        expiration: Cache expiration time in seconds
+        
+    Returns:
+        tuple: (hit, result)
+    """
+    entry = get_entry(cache_key, expiration)
+    if entry is None:
+        return False, None
+    return True, entry[1]
+
+def set_cached(cache_key, result, expiration=DEFAULT_EXPIRATION, tags=None, stale_while_revalidate=0,
+               journal_cursor=None):
+    """
+    Store a cache entry in the backend and the memory tier
+    
+    A result computed from data that changed while it was being computed must
+    not be cached: the invalidation of its tags may already have run, and
+    nothing would remove it before it expires. Pass the invalidation journal
+    cursor taken before computing the result; the entry is dropped again if any
+    of its tags was invalidated since. The entry is stored before the journal
+    is read, and invalidate_tags publishes before it removes entries, so every
+    invalidation either finds the entry or is seen here.
+    
+    Args:
+        cache_key: Cache key
+        result: JSON-serializable value to store
+        expiration: Cache expiration time in seconds
+        tags: Optional dependency tags used for invalidation
+        stale_while_revalidate: Seconds past expiration the entry may still be served
+        journal_cursor: backend.journal_cursor() from before the result was computed
+    
+    Returns:
+        bool: False if the entry was dropped because its tags were invalidated
+    """
+    tags = sorted(set(tags or ()))
+    cache_data = {
+        'timestamp': time.time(),
+        'tags': tags,
+        'result': result
+    }
+    
+    # Store the hard expiry time with the entry and in the expiry index so that
+    # sweeps never have to read entries
+    expires_at = cache_data['timestamp'] + expiration + stale_while_revalidate
+    started = time.perf_counter()
+    data = encode_entry(cache_data, expires_at)
+    cache_stats.record(
+        cache_key, bytes_written=len(data), serialization_seconds=time.perf_counter() - started
+    )
+    
+    backend.set(cache_key, data)
+    expiry_index.add(cache_key, expires_at)
+    tag_index.add(cache_key, tags, expires_at=expires_at)
+    
+    memory_cache.set(cache_key, result, cache_data['timestamp'])
+    
+    if journal_cursor is not None and tags:
+        _, invalidated = backend.poll_invalidations(journal_cursor)
+        if not set(tags).isdisjoint(invalidated):
+            memory_cache.delete(cache_key)
+            expiry_index.discard(cache_key)
+            tag_index.discard([cache_key])
+            backend.delete(cache_key)
+            return False
+    return True
+
+def fetch_or_compute(cache_key, expiration, compute, stale_while_revalidate=0):
+    """
+    Return a cached entry, computing it at most once across greenlets and workers
+    
+    On a miss only one caller per key (an in-process lock per key plus a
+    cross-process file lock) runs compute. Other callers get the expired entry if
+    one is still stored, or otherwise wait for the first caller to finish and
+    read its result. If the wait exceeds the lock timeout they compute anyway.
+    
+    With stale_while_revalidate, an entry that expired less than that many
+    seconds ago is returned immediately and refreshed in the background.
+    
+    Args:
+        cache_key: Cache key
+        expiration: Cache expiration time in seconds
+        compute: Callable returning (value, entry, tags); entry is what gets
+            cached (None to skip caching) and value is returned to this caller
+        stale_while_revalidate: Seconds past expiration an entry may be served
+        
+    Returns:
+        tuple: (status, result, timestamp) where status is 'HIT', 'STALE' or
+            'MISS'; the result is the cached entry for HIT/STALE and the computed
+            value for MISS, and timestamp is when the result was computed
+    """
+    status, result, timestamp = _fetch_or_compute(cache_key, expiration, compute, stale_while_revalidate)
+    cache_stats.record_status(cache_key, status)
+    return status, result, timestamp
+
+def _fetch_or_compute(cache_key, expiration, compute, stale_while_revalidate):
+    entry = get_entry(cache_key, expiration + stale_while_revalidate)
+    if entry is not None:
+        timestamp, result = entry
+        if time.time() - timestamp < expiration:
+            return 'HIT', result, timestamp
+        
+        schedule_refresh(cache_key, expiration, compute, stale_while_revalidate)
+        return 'STALE', result, timestamp
+    
+    acquired = key_locks.acquire(cache_key)
+    try:
+        if not acquired:
+            # Another greenlet in this process is computing the entry
+            entry = get_entry(cache_key)
+            if entry is not None:
+                return 'STALE', entry[1], entry[0]
+            acquired = key_locks.retry(cache_key, lock_timeout)
+            entry = get_entry(cache_key, expiration)
+            if entry is not None:
+                return 'HIT', entry[1], entry[0]
+        
+        file_lock = FileLock(cache_key)
+        try:
+            if not file_lock.acquire():
+                # Another worker is computing the entry
+                entry = get_entry(cache_key)
+                if entry is not None:
+                    return 'STALE', entry[1], entry[0]
+                file_lock.acquire(lock_timeout)
+            
+            # The entry may have been stored while we were acquiring the locks
+            entry = get_entry(cache_key, expiration)
+            if entry is not None:
+                return 'HIT', entry[1], entry[0]
+            
+            return 'MISS', refresh(cache_key, expiration, compute, stale_while_revalidate), time.time()
+        finally:
+            file_lock.release()
+    finally:
+        key_locks.release(cache_key, acquired)
+
+def refresh(cache_key, expiration, compute, stale_while_revalidate=0):
+    """
+    Run compute and store its entry
+    
+    Returns:
+        The value computed for the caller
+    """
+    journal_cursor = backend.journal_cursor()
+    value, entry, entry_tags = compute()
+    if entry is not None:
+        set_cached(cache_key, entry, expiration, entry_tags, stale_while_revalidate, journal_cursor)
+    return value
+
+# Keys with a background refresh in flight in this process
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def schedule_refresh(cache_key, expiration, compute, stale_while_revalidate=0):
+    """
+    Recompute an entry on a background thread
+    
+    At most one refresh per key runs in this process, and the cross-process file
+    lock keeps other workers from refreshing the same key at the same time. The
+    request or app context of the caller is carried over to the thread.
+    
+    Returns:
+        bool: True if a refresh was started
+    """
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return False
+        _refreshing.add(cache_key)
+    
+    if has_request_context():
+        compute = copy_current_request_context(compute)
+    elif has_app_context():
+        app = current_app._get_current_object()
+        compute_in_app = compute
+        
+        def compute():
+            with app.app_context():
+                return compute_in_app()
+    
+    def run():
+        file_lock = FileLock(cache_key)
+        try:
+            if file_lock.acquire():
+                refresh(cache_key, expiration, compute, stale_while_revalidate)
+        except Exception as e:
+            logger.error(f"Background refresh of {cache_key} failed: {str(e)}")
+        finally:
+            file_lock.release()
+            with _refreshing_lock:
+                _refreshing.discard(cache_key)
+    
+    threading.Thread(target=run, name=f"cache-refresh-{cache_key}", daemon=True).start()
+    return True
+
+# Callables notified of invalidated tags
+_invalidation_listeners = []
+
+def add_invalidation_listener(listener):
+    """
+    Register a callable to be told about invalidated tags
+    
+    The listener is called with a list of tags whenever this process invalidates
+    them and again when they come back through the journal, as do tags
+    invalidated by other workers. It should be idempotent and fast, as it runs on
+    the invalidating request or the expiry scheduler's thread.
+    
+    Args:
+        listener: Callable taking a list of tag strings
+    """
+    _invalidation_listeners.append(listener)
+
+def notify_invalidation(tags):
+    """Pass invalidated tags to every registered listener"""
+    tags = list(tags)
+    if not tags:
+        return
+    for listener in _invalidation_listeners:
+        try:
+            listener(tags)
+        except Exception as e:
+            logger.error(f"Invalidation listener failed: {str(e)}")
+
+def add_cache_tags(*tags):
+    """
+    Attach dependency tags to the response being cached for the current request
+    
+    Views decorated with cache_response call this while rendering to declare the
+    records the page shows, e.g. add_cache_tags(f"condition:{condition.id}").
+    
+    Args:
+        *tags: Tag strings
+    """
+    g.setdefault('cache_tags', set()).update(tag for tag in tags if tag)
+
+def invalidate_tags(*tags):
+    """
+    Drop every cache entry that depends on any of the given tags
+    
+    Removes the entries from the backend and this process's memory tier, and
+    publishes the tags so other workers drop their memory-tier copies.
+    
+    Args:
+        *tags: Tag strings
+        
+    Returns:
+        int: Number of cache entries invalidated
+    """
+    tags = {tag for tag in tags if tag}
+    if not tags:
+        return 0
+    
+    # Publish first, so an entry computed from the old data is either seen by
+    # the removal below or sees the tags in the journal (see set_cached)
+    tag_index.publish(tags)
+    
+    keys = set()
+    for tag in tags:
+        keys |= tag_index.pop(tag)
+    
+    for key in keys:
+        memory_cache.delete(key)
+        expiry_index.discard(key)
+        backend.delete(key)
+    
+    notify_invalidation(tags)
+    
+    return len(keys)
+
+def cache_result(expiration=DEFAULT_EXPIRATION, tags=None, stale_while_revalidate=0):
     """
     Decorator to cache function results
     
+    The key is built from the function arguments only. Use cache_response for
+    Flask views whose output depends on the query string or the current user.
+    
     Args:
         expiration: Cache expiration time in seconds
+        tags: Optional dependency tags used for invalidation
+        stale_while_revalidate: Seconds past expiration an entry is still served
+            while it is refreshed in the background
         
     Returns:
         function: Decorated function
@@ -52,59 +1201,318 @@ def cache_result(expiration=DEFAULT_EXPIRATION):
         def wrapper(*args, **kwargs):
             # Generate cache key
             cache_key = get_cache_key(func.__name__, *args, **kwargs)
-            cache_file = os.path.join(CACHE_DIR, f"{cache_key}.json")
             
-            # Check if cache file exists and is not expired
-            if os.path.exists(cache_file):
-                with open(cache_file, 'r') as f:
-                    cache_data = json.load(f)
+            def compute():
+                result = func(*args, **kwargs)
+                return result, result, tags
+            
+            _, result, _ = fetch_or_compute(cache_key, expiration, compute, stale_while_revalidate)
+            return result
+        return wrapper
+    return decorator
+
+def get_response_cache_key(endpoint):
+    """
+    Generate a cache key for the current request
+    
+    The key covers the request path, the query string with its parameters sorted
+    (so that parameter order does not matter) and the authentication state.
+    
+    Args:
+        endpoint: Name of the view being cached
+        
+    Returns:
+        str: Cache key
+    """
+    query_string = urlencode(sorted(
+        (key, value.strip()) for key, value in request.args.items(multi=True)
+    ))
+    auth_state = f"user:{current_user.get_id()}" if current_user.is_authenticated else 'anonymous'
+    
+    return get_cache_key(endpoint, request.path, query_string, auth_state)
+
+def cache_response(expiration=DEFAULT_EXPIRATION, tags=None, stale_while_revalidate=0, validator=None):
+    """
+    Decorator to cache complete Flask view responses
+    
+    Stores the status code, headers and body bytes, so a hit skips both the
+    database queries and template rendering. Only successful GET/HEAD responses
+    that do not set cookies are cached, and requests with pending flash messages
+    always bypass the cache. Dependency tags come from the tags argument plus any
+    added by the view through add_cache_tags.
+    
+    Every response reports the cache status in X-Cache and the entry's soft
+    (fresh until) and hard (servable until) expiry times in X-Cache-Soft-Expires
+    and X-Cache-Hard-Expires.
+    
+    With a validator (see conditional_response), the ETag and Last-Modified are
+    taken when the response is rendered and stored with it, and conditional
+    requests are answered by comparing against the stored headers, so a hit
+    still makes no queries. The validator only runs on a request when it is
+    conditional and nothing is cached, to answer 304 without rendering.
+    
+    Args:
+        expiration: Cache expiration time in seconds
+        tags: Optional dependency tags shared by every response of the view
+        stale_while_revalidate: Seconds past expiration a response is still served
+            while it is re-rendered in the background
+        validator: Optional callable taking the view arguments and returning
+            (parts, last_modified) or None, as for conditional_response
+        
+    Returns:
+        function: Decorated view function
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return view(*args, **kwargs)
+            
+            cache_key = get_response_cache_key(view.__name__)
+            conditional = validator is not None and bool(request.if_none_match or request.if_modified_since)
+            
+            # Nothing cached to compare against: check the records before rendering
+            if conditional and get_entry(cache_key, expiration + stale_while_revalidate) is None:
+                validators = validator(**kwargs)
+                if validators is not None:
+                    etag, last_modified = response_validators(validators)
+                    if is_not_modified(etag, last_modified):
+                        return set_validators(Response(status=304), etag, last_modified)
+            
+            def compute():
+                # Taken before rendering, so they never describe newer rows than the body
+                validators = validator(**kwargs) if validator is not None else None
+                g.cache_tags = set(tags or ())
+                response = make_response(view(*args, **kwargs))
+                
+                if response.status_code != 200 or response.direct_passthrough \
+                        or 'Set-Cookie' in response.headers:
+                    return response, None, None
+                
+                if validators is not None:
+                    set_validators(response, *response_validators(validators))
                 
-                # Check if cache is expired
-                if time.time() - cache_data['timestamp'] < expiration:
-                    return cache_data['result']
+                return response, {
+                    'status': response.status_code,
+                    'headers': [
+                        [name, value] for name, value in response.headers.items()
+                        if name != 'Content-Length' and not name.startswith('X-Cache')
+                    ],
+                    'body': base64.b64encode(response.get_data()).decode('ascii')
+                }, g.pop('cache_tags', None)
             
-            # Call the function and cache the result
-            result = func(*args, **kwargs)
+            status, result, timestamp = fetch_or_compute(
+                cache_key, expiration, compute, stale_while_revalidate
+            )
             
-            # Save result to cache
-            cache_data = {
-                'timestamp': time.time(),
-                'result': result
-            }
+            if status == 'MISS':
+                response = result
+            else:
+                response = Response(
+                    base64.b64decode(result['body']),
+                    status=result['status'],
+                    headers=result['headers']
+                )
             
-            with open(cache_file, 'w') as f:
-                json.dump(cache_data, f)
+            etag = response.get_etag()[0]
+            if conditional and response.status_code == 200 and etag is not None \
+                    and is_not_modified(etag, response.last_modified):
+                response = set_validators(Response(status=304), etag, response.last_modified)
             
-            return result
+            response.headers['X-Cache'] = status
+            response.headers['X-Cache-Soft-Expires'] = http_date(timestamp + expiration)
+            response.headers['X-Cache-Hard-Expires'] = http_date(timestamp + expiration + stale_while_revalidate)
+            return response
         return wrapper
     return decorator
 
-def clear_cache():
-    """Clear all cached data"""
-    for file in os.listdir(CACHE_DIR):
-        if file.endswith('.json'):
-            os.remove(os.path.join(CACHE_DIR, file))
+def dependency_columns(model):
+    """
+    Get the columns whose values tell whether a row changed
+    
+    Args:
+        model: Model class or alias
+        
+    Returns:
+        list: id, updated_at and version where the model has them, otherwise
+            every column
+    """
+    mapper = inspect(model).mapper
+    keys = [prop.key for prop in mapper.column_attrs]
+    if 'updated_at' in keys:
+        keys = [key for key in ('id', 'updated_at', 'version') if key in keys]
+    return [getattr(model, key) for key in keys]
 
-def clear_expired_cache(expiration=DEFAULT_EXPIRATION):
+def record_validator(model, argument, column='id', related=()):
     """
-    Clear expired cache files
+    Build a validator for a detail view from a record's version and updated_at,
+    and those of the related rows the view shows
+    
+    Related rows are reached through relationship paths such as 'medications'
+    or 'related_to.related_medication'. Their IDs are part of the ETag, so rows
+    added to or removed from a relationship (which does not touch updated_at)
+    change it too. For the same reason such views get no Last-Modified: there
+    is no timestamp that covers membership changes.
     
     Args:
-        expiration: Cache expiration time in seconds
+        model: Model class with an updated_at column (and optionally version)
+        argument: Name of the view argument identifying the record
+        column: Model column the argument is matched against
+        related: Relationship paths of the related rows the view shows
+        
+    Returns:
+        function: Validator for conditional_response
     """
-    current_time = time.time()
+    columns = [model.updated_at] + ([model.version] if hasattr(model, 'version') else [])
+    key_column = getattr(model, column)
     
-    for file in os.listdir(CACHE_DIR):
-        if file.endswith('.json'):
-            cache_file = os.path.join(CACHE_DIR, file)
+    def related_rows(key, path):
+        current = model
+        joins = []
+        for name in path.split('.'):
+            attribute = getattr(current, name)
+            current = aliased(attribute.property.mapper.class_)
+            joins.append(attribute.of_type(current))
+        
+        query = model.query.session.query(*dependency_columns(current)).select_from(model)
+        for join in joins:
+            query = query.join(join)
+        return tuple(tuple(row) for row in query.filter(key_column == key).order_by(*dependency_columns(current)))
+    
+    def validator(**kwargs):
+        row = model.query.with_entities(*columns).filter(key_column == kwargs[argument]).first()
+        if row is None:
+            return None
+        
+        parts = (model.__name__, kwargs[argument]) + tuple(row)
+        for path in related:
+            parts += (path, related_rows(kwargs[argument], path))
+        return parts, None if related else row[0]
+    return validator
+
+def collection_validator(*models):
+    """
+    Build a validator for a list view from the count and latest updated_at of each model
+    
+    List models whose fields the view includes as well as the listed model, so
+    that e.g. renaming a specialty changes the ETag of the condition list.
+    
+    Args:
+        *models: Model classes with an updated_at column
+        
+    Returns:
+        function: Validator for conditional_response
+    """
+    def validator(**kwargs):
+        parts = []
+        last_modified = None
+        for model in models:
+            latest, count = model.query.with_entities(
+                func.max(model.updated_at), func.count(model.id)
+            ).one()
+            parts += [model.__name__, count, latest]
+            if latest is not None and (last_modified is None or latest > last_modified):
+                last_modified = latest
+        return tuple(parts), last_modified
+    return validator
+
+def response_validators(validators):
+    """
+    Turn the result of a validator into response validators
+    
+    The strong ETag is a hash of the endpoint, the parts and the authentication
+    state, and Last-Modified is last_modified truncated to whole seconds.
+    
+    Args:
+        validators: (parts, last_modified) as returned by a validator
+        
+    Returns:
+        tuple: (etag, last_modified as an aware UTC datetime or None)
+    """
+    parts, last_modified = validators
+    auth_state = f"user:{current_user.get_id()}" if current_user.is_authenticated else 'anonymous'
+    etag = hashlib.sha1(repr((request.endpoint, parts, auth_state)).encode()).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, last_modified
+
+def is_not_modified(etag, last_modified):
+    """Check the request's If-None-Match (or, without one, If-Modified-Since) against validators"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return last_modified is not None and request.if_modified_since is not None \
+        and last_modified <= request.if_modified_since
+
+def set_validators(response, etag, last_modified):
+    """Add validators to a 200 or 304 response and make browsers revalidate it"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.vary.add('Cookie')
+    if not response.cache_control:
+        # Make browsers revalidate instead of guessing a freshness lifetime
+        response.cache_control.no_cache = True
+    return response
+
+def conditional_response(validator):
+    """
+    Decorator answering conditional GET requests from record metadata
+    
+    The validator is called with the view arguments and returns (parts,
+    last_modified) or None to let the view handle the request (e.g. to 404);
+    see response_validators for the headers made from them. Requests whose
+    If-None-Match (or, without one, If-Modified-Since) still matches get a 304
+    without running the view; other responses carry both validators. The
+    validator runs on every request, so for cached views pass it to
+    cache_response instead, which stores the validators with the entry.
+    
+    Args:
+        validator: Callable taking the view arguments
+        
+    Returns:
+        function: Decorated view function
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
             
-            try:
-                with open(cache_file, 'r') as f:
-                    cache_data = json.load(f)
-                
-                # Check if cache is expired
-                if current_time - cache_data['timestamp'] > expiration:
-                    os.remove(cache_file)
-            except (json.JSONDecodeError, KeyError, FileNotFoundError):
-                # Remove invalid cache files
-                os.remove(cache_file)
+            validators = validator(**kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+            
+            etag, last_modified = response_validators(validators)
+            if is_not_modified(etag, last_modified):
+                return set_validators(Response(status=304), etag, last_modified)
+            
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+def clear_cache():
+    """Clear all cached data"""
+    memory_cache.clear()
+    expiry_index.clear()
+    tag_index.clear()
+    backend.clear()
+
+def clear_expired_cache(now=None):
+    """
+    Clear expired cache entries
+    
+    Entries carry their expiry time outside the stored value (the file backend
+    uses the modification time, the sqlite backend an indexed column), so this
+    never reads or parses entries. It is run periodically by the expiry scheduler
+    and should not be called per request.
+    
+    Args:
+        now: Reference time (default: current time)
+        
+    Returns:
+        int: Number of cache entries removed
+    """
+    return backend.purge_expired(time.time() if now is None else now)
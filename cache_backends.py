@@ -0,0 +1,1068 @@
+"""
+Cache backends for the medical reference app
+
+This module provides the shared storage tier used by cache.py behind its
+in-process memory tier, and the binary format entries are stored in. A backend
+stores encoded entries, the mapping from dependency tags to cache keys, and the
+journal of invalidated tags that workers poll to keep their memory tiers coherent.
+
+Available backends:
+- file: One entry file per entry in the cache directory (default)
+- memory: A dictionary in this process (single-process deployments and tests)
+- sqlite: A single SQLite file with an index on expiry time
+- redis: A Redis server (or anything speaking the Redis protocol), shared across hosts
+"""
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional; entries are compressed with zlib instead
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are unavailable on this platform; journal compaction may race with publishers
+    fcntl = None
+
+# Locations of the shared tag index and invalidation journal inside the cache directory
+TAGS_DIR = 'tags'
+INVALIDATION_JOURNAL = 'invalidations.log'
+
+# First line of a compacted journal: the number of bytes compacted away before it
+JOURNAL_HEADER_PREFIX = b'#trimmed\t'
+
+# Age (in seconds) after which temporary files abandoned by a crashed writer are removed
+TEMP_FILE_MAX_AGE = 3600
+
+# File name suffixes of entry files in the current and the previous (JSON) format
+ENTRY_SUFFIX = '.entry'
+LEGACY_ENTRY_SUFFIX = '.json'
+
+# Binary entry format: a fixed header followed by the compressed JSON body
+#   magic (4 bytes), codec (1 byte), timestamp (float64), expires_at (float64)
+ENTRY_MAGIC = b'MRC1'
+ENTRY_HEADER = struct.Struct('>4sBdd')
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+COMPRESSION_LEVEL = 6
+
+class EntryFormatError(ValueError):
+    """Raised when stored bytes are not a valid cache entry"""
+
+def encode_entry(entry, expires_at):
+    """
+    Serialize a cache entry into the binary entry format
+    
+    Args:
+        entry: Dictionary with 'timestamp', 'tags' and 'result' keys
+        expires_at: Hard expiry time of the entry
+        
+    Returns:
+        bytes: Header followed by the compressed body
+    """
+    body = json.dumps(
+        {'tags': entry.get('tags', []), 'result': entry['result']},
+        separators=(',', ':')
+    ).encode()
+    
+    if zstandard is not None:
+        codec = CODEC_ZSTD
+        body = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(body)
+    else:
+        codec = CODEC_ZLIB
+        body = zlib.compress(body, COMPRESSION_LEVEL)
+    
+    return ENTRY_HEADER.pack(ENTRY_MAGIC, codec, entry['timestamp'], expires_at) + body
+
+def decode_entry_header(data):
+    """
+    Read the header of an encoded entry without touching the body
+    
+    Args:
+        data: Encoded entry, or at least its first ENTRY_HEADER.size bytes
+        
+    Returns:
+        tuple: (codec, timestamp, expires_at)
+    """
+    if len(data) < ENTRY_HEADER.size:
+        raise EntryFormatError('Cache entry is truncated')
+    
+    magic, codec, timestamp, expires_at = ENTRY_HEADER.unpack_from(data)
+    if magic != ENTRY_MAGIC:
+        raise EntryFormatError('Not a cache entry')
+    
+    return codec, timestamp, expires_at
+
+def decode_entry(data):
+    """
+    Deserialize an entry written by encode_entry
+    
+    Args:
+        data: Encoded entry
+        
+    Returns:
+        tuple: (entry, expires_at) where entry has 'timestamp', 'tags' and 'result' keys
+    """
+    codec, timestamp, expires_at = decode_entry_header(data)
+    body = data[ENTRY_HEADER.size:]
+    
+    if codec == CODEC_ZSTD and zstandard is None:
+        raise EntryFormatError('Cache entry is zstd-compressed but zstandard is not installed')
+    if codec not in (CODEC_ZLIB, CODEC_ZSTD):
+        raise EntryFormatError(f"Unsupported cache entry codec {codec}")
+    
+    try:
+        if codec == CODEC_ZSTD:
+            body = zstandard.ZstdDecompressor().decompress(body)
+        else:
+            body = zlib.decompress(body)
+        entry = json.loads(body)
+    except Exception as e:
+        raise EntryFormatError(f"Corrupt cache entry: {str(e)}") from e
+    
+    entry['timestamp'] = timestamp
+    return entry, expires_at
+
+class CacheBackend:
+    """
+    Base class for cache backends
+
+    Entries are stored as bytes produced by encode_entry; backends read the
+    timestamp and expiry time from the entry header and never decode the body.
+    Journal cursors are opaque values owned by the backend; None means "from the
+    start".
+    """
+
+    name = None
+
+    def get(self, key, min_timestamp=None):
+        """
+        Return the encoded entry for a key, or None
+
+        Entries computed before min_timestamp are treated as missing.
+        """
+        raise NotImplementedError
+
+    def set(self, key, data):
+        """Store an encoded entry until the hard expiry time in its header"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove an entry if present"""
+        raise NotImplementedError
+
+    def expire(self, keys, now):
+        """
+        Remove the given entries if their expiry time has passed
+
+        Returns:
+            int: Number of entries removed
+        """
+        raise NotImplementedError
+
+    def purge_expired(self, now):
+        """
+        Remove every entry whose expiry time has passed, and drop the keys of
+        entries no longer stored from the tag index
+
+        Returns:
+            int: Number of entries removed
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all entries and tags"""
+        raise NotImplementedError
+
+    def add_tags(self, key, tags, expires_at=None):
+        """
+        Record that a key depends on the given tags
+
+        Called after the entry is stored, and again each time it is rewritten,
+        so purge_expired may drop the keys of entries it does not find.
+        expires_at is the entry's hard expiry time, for backends that expire
+        their tag index themselves.
+        """
+        raise NotImplementedError
+
+    def pop_tag(self, tag):
+        """Remove a tag and return the set of keys that depended on it"""
+        raise NotImplementedError
+
+    def publish_invalidations(self, tags, now):
+        """Append invalidated tags to the shared journal"""
+        raise NotImplementedError
+
+    def poll_invalidations(self, cursor):
+        """
+        Read journal entries written since the cursor
+
+        Returns:
+            tuple: (new_cursor, list of invalidated tags)
+        """
+        raise NotImplementedError
+
+    def journal_cursor(self):
+        """Return a cursor at the end of the journal, without reading it"""
+        raise NotImplementedError
+
+    def compact_invalidations(self, keep_after):
+        """Discard journal entries older than keep_after"""
+        raise NotImplementedError
+
+class FileBackend(CacheBackend):
+    """
+    One binary entry file per entry in the cache directory
+
+    Entries are written to a temporary file and renamed into place, so readers
+    never see a partial entry. Each file's modification time is set to the
+    entry's hard expiry time, so expiry checks only read directory metadata, and
+    the timestamp in the entry header lets lookups reject entries that are too
+    old without reading the rest of the file. Tags are kept in one append-only
+    file per tag and the journal is a single append-only file; both are safe to
+    share between the workers of one host. Journal cursors are byte offsets into
+    the uncompacted journal: compaction rewrites the file under an flock that
+    publishers also take, and records the bytes it removed in a header line.
+    """
+
+    name = 'file'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_file(self, key):
+        return os.path.join(self.cache_dir, f"{key}{ENTRY_SUFFIX}")
+
+    def _tag_file(self, tag):
+        tag_hash = hashlib.md5(tag.encode()).hexdigest()
+        return os.path.join(self.cache_dir, TAGS_DIR, f"{tag_hash}.keys")
+
+    def _journal_file(self):
+        return os.path.join(self.cache_dir, INVALIDATION_JOURNAL)
+
+    def get(self, key, min_timestamp=None):
+        try:
+            with open(self._entry_file(key), 'rb') as f:
+                header = f.read(ENTRY_HEADER.size)
+                _, timestamp, _ = decode_entry_header(header)
+                # Too old for the caller; skip reading the body
+                if min_timestamp is not None and timestamp < min_timestamp:
+                    return None
+                return header + f.read()
+        except (FileNotFoundError, EntryFormatError):
+            return None
+
+    def set(self, key, data):
+        _, _, expires_at = decode_entry_header(data)
+        cache_file = self._entry_file(key)
+        temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.utime(temp_file, (expires_at, expires_at))
+        os.replace(temp_file, cache_file)
+
+    def delete(self, key):
+        try:
+            os.remove(self._entry_file(key))
+        except FileNotFoundError:
+            pass
+
+    def expire(self, keys, now):
+        removed = 0
+        for key in keys:
+            cache_file = self._entry_file(key)
+            try:
+                # Another worker may have rewritten the entry with a later expiry
+                if os.stat(cache_file).st_mtime <= now:
+                    os.remove(cache_file)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def purge_expired(self, now):
+        removed = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(ENTRY_SUFFIX):
+                        expired = entry.stat().st_mtime <= now
+                    elif entry.name.endswith('.tmp'):
+                        expired = entry.stat().st_mtime <= now - TEMP_FILE_MAX_AGE
+                    else:
+                        # Entries in the old JSON format are never read again
+                        expired = entry.name.endswith(LEGACY_ENTRY_SUFFIX)
+
+                    if expired:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        self._compact_tags()
+        return removed
+
+    def _compact_tags(self):
+        """Rewrite each tag file without the keys of entries no longer stored"""
+        tags_dir = os.path.join(self.cache_dir, TAGS_DIR)
+        if not os.path.isdir(tags_dir):
+            return
+
+        for name in os.listdir(tags_dir):
+            if not name.endswith('.keys'):
+                continue
+            tag_file = os.path.join(tags_dir, name)
+            try:
+                f = open(tag_file, 'r')
+            except FileNotFoundError:
+                continue
+            with f:
+                # add_tags and pop_tag wait for the lock, so no key is lost
+                if not self._lock_file(f, tag_file):
+                    continue
+                lines = f.readlines()
+                keys = {line.strip() for line in lines if line.strip()}
+                stored = sorted(key for key in keys if os.path.exists(self._entry_file(key)))
+                if not stored:
+                    os.remove(tag_file)
+                elif len(stored) < len(lines):
+                    temp_file = f"{tag_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(temp_file, 'w') as temp:
+                        temp.write(''.join(f"{key}\n" for key in stored))
+                    os.replace(temp_file, tag_file)
+
+    def clear(self):
+        for file in os.listdir(self.cache_dir):
+            if file.endswith((ENTRY_SUFFIX, LEGACY_ENTRY_SUFFIX)):
+                os.remove(os.path.join(self.cache_dir, file))
+
+        tags_dir = os.path.join(self.cache_dir, TAGS_DIR)
+        if os.path.isdir(tags_dir):
+            for file in os.listdir(tags_dir):
+                os.remove(os.path.join(tags_dir, file))
+
+    def add_tags(self, key, tags, expires_at=None):
+        os.makedirs(os.path.join(self.cache_dir, TAGS_DIR), exist_ok=True)
+        for tag in tags:
+            tag_file = self._tag_file(tag)
+            while True:
+                with open(tag_file, 'a') as f:
+                    if self._lock_file(f, tag_file):
+                        f.write(f"{key}\n")
+                        break
+
+    def pop_tag(self, tag):
+        # Removed under the lock, so later appends start a new file
+        tag_file = self._tag_file(tag)
+        while True:
+            try:
+                f = open(tag_file, 'r')
+            except FileNotFoundError:
+                return set()
+            with f:
+                if self._lock_file(f, tag_file):
+                    keys = {line.strip() for line in f if line.strip()}
+                    os.remove(tag_file)
+                    return keys
+
+    def _lock_file(self, f, path):
+        """
+        Lock an open journal or tag file; the lock is released when it is closed
+
+        Returns:
+            bool: False if the file was replaced or removed while this caller
+            waited, in which case it must open the path again
+        """
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _read_journal_header(self, f):
+        """Return the number of bytes compacted away and the header size of an open journal"""
+        line = f.readline()
+        if line.startswith(JOURNAL_HEADER_PREFIX):
+            return int(line[len(JOURNAL_HEADER_PREFIX):]), len(line)
+        f.seek(0)
+        return 0, 0
+
+    def publish_invalidations(self, tags, now):
+        lines = ''.join(f"{now}\t{tag}\n" for tag in tags)
+        while True:
+            with open(self._journal_file(), 'a') as f:
+                if self._lock_file(f, self._journal_file()):
+                    f.write(lines)
+                    return
+
+    def poll_invalidations(self, cursor):
+        try:
+            f = open(self._journal_file(), 'rb')
+        except FileNotFoundError:
+            return cursor, []
+
+        with f:
+            trimmed, header_size = self._read_journal_header(f)
+            # Lines before the cursor may have been compacted away
+            position = max((cursor or 0) - trimmed, 0)
+            f.seek(header_size + position)
+            data = f.read()
+
+        # Only consume complete lines
+        data = data[:data.rfind(b'\n') + 1]
+        tags = [line.partition('\t')[2] for line in data.decode().splitlines()]
+
+        return trimmed + position + len(data), tags
+
+    def journal_cursor(self):
+        try:
+            with open(self._journal_file(), 'rb') as f:
+                trimmed, header_size = self._read_journal_header(f)
+                return trimmed + os.fstat(f.fileno()).st_size - header_size
+        except FileNotFoundError:
+            return 0
+
+    def compact_invalidations(self, keep_after):
+        journal_file = self._journal_file()
+        try:
+            f = open(journal_file, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            # Publishers wait for the lock, so no line is appended to the old file
+            if not self._lock_file(f, journal_file):
+                return
+            trimmed, header_size = self._read_journal_header(f)
+            expired = 0
+            try:
+                for line in f:
+                    if not line.endswith(b'\n') or float(line.split(b'\t', 1)[0]) > keep_after:
+                        break
+                    expired += len(line)
+            except ValueError:
+                return
+            if not expired:
+                return
+
+            f.seek(header_size + expired)
+            temp_file = f"{journal_file}.{os.getpid()}.tmp"
+            with open(temp_file, 'wb') as temp:
+                temp.write(JOURNAL_HEADER_PREFIX + str(trimmed + expired).encode() + b'\n')
+                temp.write(f.read())
+            os.replace(temp_file, journal_file)
+
+class MemoryBackend(CacheBackend):
+    """
+    Entries held in a dictionary in this process
+
+    Suitable for a single worker or for tests; nothing is shared between processes.
+    The journal only reaches the threads of this process.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._entries = {}
+        self._tags = {}
+        self._journal = []
+        self._trimmed = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, min_timestamp=None):
+        with self._lock:
+            item = self._entries.get(key)
+        if item is None:
+            return None
+        data, timestamp, _ = item
+        if min_timestamp is not None and timestamp < min_timestamp:
+            return None
+        return data
+
+    def set(self, key, data):
+        _, timestamp, expires_at = decode_entry_header(data)
+        with self._lock:
+            self._entries[key] = (data, timestamp, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def expire(self, keys, now):
+        removed = 0
+        with self._lock:
+            for key in keys:
+                item = self._entries.get(key)
+                if item is not None and item[2] <= now:
+                    del self._entries[key]
+                    removed += 1
+        return removed
+
+    def purge_expired(self, now):
+        with self._lock:
+            expired = [key for key, (_, _, expires_at) in self._entries.items() if expires_at <= now]
+        removed = self.expire(expired, now)
+
+        with self._lock:
+            for tag in list(self._tags):
+                self._tags[tag].intersection_update(self._entries)
+                if not self._tags[tag]:
+                    del self._tags[tag]
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def add_tags(self, key, tags, expires_at=None):
+        with self._lock:
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+    def pop_tag(self, tag):
+        with self._lock:
+            return self._tags.pop(tag, set())
+
+    def publish_invalidations(self, tags, now):
+        with self._lock:
+            self._journal.extend((now, tag) for tag in tags)
+
+    def poll_invalidations(self, cursor):
+        with self._lock:
+            start = max((cursor or 0) - self._trimmed, 0)
+            return self._trimmed + len(self._journal), [tag for _, tag in self._journal[start:]]
+
+    def journal_cursor(self):
+        with self._lock:
+            return self._trimmed + len(self._journal)
+
+    def compact_invalidations(self, keep_after):
+        with self._lock:
+            expired = 0
+            while expired < len(self._journal) and self._journal[expired][0] <= keep_after:
+                expired += 1
+            del self._journal[:expired]
+            self._trimmed += expired
+
+class ConnectionPool:
+    """
+    Connections shared by the threads (greenlets under gevent) of a process
+
+    A caller checks a connection out for one operation and checks it back in,
+    so connections and their setup are reused across requests. Up to size idle
+    connections are kept; callers beyond that open extra connections, which
+    are closed on check-in. A connection that raised is closed, not reused.
+    """
+
+    def __init__(self, connect, size=8, check=None):
+        self._connect = connect
+        self._check = check
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the with block"""
+        connection = None
+        while connection is None:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._connect()
+            elif self._check is not None and not self._check(connection):
+                connection.close()
+                connection = None
+
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+class SQLiteBackend(CacheBackend):
+    """
+    A single SQLite database file shared by all workers on a host
+
+    Entries are indexed by expiry time, so purging expired entries is an index
+    range delete instead of a directory scan. WAL mode lets readers proceed while
+    another worker writes. Connections are pooled, so the pragmas run once per
+    connection rather than once per thread or greenlet.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS cache_entries ('
+        ' key TEXT PRIMARY KEY, timestamp REAL NOT NULL, expires_at REAL NOT NULL,'
+        ' entry BLOB NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_cache_entries_expires_at ON cache_entries (expires_at)',
+        'CREATE TABLE IF NOT EXISTS cache_tags ('
+        ' tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS cache_invalidations ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, tag TEXT NOT NULL)'
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._pool = ConnectionPool(self._connect)
+
+        with self._pool.connection() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        # Pooled connections move between threads (greenlets under gevent)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def get(self, key, min_timestamp=None):
+        with self._pool.connection() as connection:
+            row = connection.execute(
+                'SELECT entry FROM cache_entries WHERE key = ? AND timestamp >= ?',
+                (key, float('-inf') if min_timestamp is None else min_timestamp)
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def set(self, key, data):
+        _, timestamp, expires_at = decode_entry_header(data)
+        with self._pool.connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache_entries (key, timestamp, expires_at, entry) VALUES (?, ?, ?, ?)',
+                (key, timestamp, expires_at, data)
+            )
+
+    def delete(self, key):
+        with self._pool.connection() as connection:
+            connection.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def expire(self, keys, now):
+        removed = 0
+        with self._pool.connection() as connection:
+            for key in keys:
+                removed += connection.execute(
+                    'DELETE FROM cache_entries WHERE key = ? AND expires_at <= ?', (key, now)
+                ).rowcount
+        return removed
+
+    def purge_expired(self, now):
+        with self._pool.connection() as connection:
+            removed = connection.execute(
+                'DELETE FROM cache_entries WHERE expires_at <= ?', (now,)
+            ).rowcount
+            connection.execute(
+                'DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache_entries)'
+            )
+        return removed
+
+    def clear(self):
+        with self._pool.connection() as connection:
+            connection.execute('DELETE FROM cache_entries')
+            connection.execute('DELETE FROM cache_tags')
+
+    def add_tags(self, key, tags, expires_at=None):
+        with self._pool.connection() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)',
+                [(tag, key) for tag in tags]
+            )
+
+    def pop_tag(self, tag):
+        with self._pool.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                keys = {row[0] for row in connection.execute(
+                    'SELECT key FROM cache_tags WHERE tag = ?', (tag,)
+                )}
+                connection.execute('DELETE FROM cache_tags WHERE tag = ?', (tag,))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return keys
+
+    def publish_invalidations(self, tags, now):
+        with self._pool.connection() as connection:
+            connection.executemany(
+                'INSERT INTO cache_invalidations (timestamp, tag) VALUES (?, ?)',
+                [(now, tag) for tag in tags]
+            )
+
+    def poll_invalidations(self, cursor):
+        with self._pool.connection() as connection:
+            rows = connection.execute(
+                'SELECT id, tag FROM cache_invalidations WHERE id > ? ORDER BY id',
+                (cursor or 0,)
+            ).fetchall()
+        if not rows:
+            return cursor, []
+        return rows[-1][0], [tag for _, tag in rows]
+
+    def journal_cursor(self):
+        # The AUTOINCREMENT sequence keeps counting when compaction deletes rows
+        with self._pool.connection() as connection:
+            row = connection.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'cache_invalidations'"
+            ).fetchone()
+        return row[0] if row else 0
+
+    def compact_invalidations(self, keep_after):
+        with self._pool.connection() as connection:
+            connection.execute(
+                'DELETE FROM cache_invalidations WHERE timestamp <= ?', (keep_after,)
+            )
+
+class RedisError(Exception):
+    """Error reply returned by a Redis server"""
+
+class RedisConnection:
+    """A socket to a Redis server that has been authenticated and selected its database"""
+
+    def __init__(self, host, port, db, password, timeout):
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        try:
+            if password:
+                self.send(('AUTH', password))
+                self.read_reply()
+            if db:
+                self.send(('SELECT', db))
+                self.read_reply()
+        except BaseException:
+            self.close()
+            raise
+
+    def is_alive(self):
+        """Check, without blocking, that the server has not closed an idle connection"""
+        try:
+            self.sock.setblocking(False)
+            # Nothing may be waiting on an idle connection: EOF means it was
+            # closed, and stray data means it is out of step
+            self.sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def send(self, *commands):
+        """Send one or more commands in a single write"""
+        parts = []
+        for args in commands:
+            parts.append(f"*{len(args)}\r\n".encode())
+            for arg in args:
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode()
+                parts.append(f"${len(arg)}\r\n".encode())
+                parts.append(arg + b'\r\n')
+        self.sock.sendall(b''.join(parts))
+
+    def read_reply(self):
+        """Read one reply"""
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by Redis server')
+
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply type {kind!r}")
+
+    def close(self):
+        """Close the socket"""
+        self.reader.close()
+        self.sock.close()
+
+class RedisClient:
+    """
+    Minimal Redis protocol (RESP) client
+
+    Implements only what RedisBackend needs, so the app does not depend on the
+    redis package. Bulk replies are returned as bytes. Connections are shared
+    by the threads (greenlets under gevent) of the process through a small pool,
+    so a request reuses an authenticated connection instead of opening its own.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5, pool_size=8):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._pool = ConnectionPool(self._connect, pool_size, check=RedisConnection.is_alive)
+
+    @classmethod
+    def from_url(cls, url):
+        """Create a client from a redis://[:password@]host[:port][/db] URL"""
+        parsed = urlparse(url)
+        db = parsed.path.lstrip('/')
+        return cls(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=unquote(parsed.password) if parsed.password else None
+        )
+
+    def _connect(self):
+        return RedisConnection(self.host, self.port, self.db, self.password, self.timeout)
+
+    def execute(self, *args):
+        """
+        Send a command and return its reply
+
+        Pooled connections the server closed while idle are replaced before the
+        command is sent. A command that was sent is never resent, since some
+        (RPUSH, INCRBY) are not idempotent; connection errors are raised.
+        """
+        with self._pool.connection() as connection:
+            connection.send(args)
+            return connection.read_reply()
+
+    def transaction(self, *commands):
+        """
+        Run commands atomically with MULTI/EXEC and return their replies
+
+        The whole transaction is written at once on one connection and is never
+        retried.
+        """
+        with self._pool.connection() as connection:
+            connection.send(('MULTI',), *commands, ('EXEC',))
+            # Read every reply, so an error leaves nothing unread on the connection
+            replies, error = [], None
+            for _ in range(len(commands) + 2):
+                try:
+                    replies.append(connection.read_reply())
+                except RedisError as e:
+                    error = error or e
+            if error is not None:
+                raise error
+            return replies[-1]
+
+    def close(self):
+        """Close the idle connections"""
+        self._pool.close()
+
+class RedisBackend(CacheBackend):
+    """
+    Entries stored on a Redis server, shared by workers on any number of hosts
+
+    Redis expires entries itself, so the expiry sweeps only drop the keys of
+    expired entries from the tag sets. Tags are Redis sets that expire with the
+    longest-lived entry in them (EXPIRE NX/GT needs Redis 7), and the journal is
+    a list whose trimmed length is tracked separately so cursors stay valid
+    across compaction.
+    """
+
+    name = 'redis'
+
+    # Journal entries read per round trip when compacting
+    COMPACT_BATCH = 500
+
+    def __init__(self, url, prefix='medref:cache:'):
+        self.client = RedisClient.from_url(url)
+        self.prefix = prefix
+        self._trimmed = 0
+
+    def _key(self, kind, name):
+        return f"{self.prefix}{kind}:{name}"
+
+    def get(self, key, min_timestamp=None):
+        data = self.client.execute('GET', self._key('entry', key))
+        if data is None:
+            return None
+        try:
+            _, timestamp, _ = decode_entry_header(data)
+        except EntryFormatError:
+            return None
+        if min_timestamp is not None and timestamp < min_timestamp:
+            return None
+        return data
+
+    def set(self, key, data):
+        _, _, expires_at = decode_entry_header(data)
+        ttl_ms = max(int((expires_at - time.time()) * 1000), 1)
+        self.client.execute('SET', self._key('entry', key), data, 'PX', ttl_ms)
+
+    def delete(self, key):
+        self.client.execute('DEL', self._key('entry', key))
+
+    def expire(self, keys, now):
+        return 0
+
+    def purge_expired(self, now):
+        # Redis removes expired entries itself; drop their keys from the tag sets
+        cursor = '0'
+        while True:
+            cursor, tag_keys = self.client.execute('SCAN', cursor, 'MATCH', self._key('tag', '*'), 'COUNT', 500)
+            for tag_key in tag_keys:
+                self._prune_tag(tag_key)
+            if cursor == b'0':
+                return 0
+
+    def _prune_tag(self, tag_key):
+        members = self.client.execute('SMEMBERS', tag_key)
+        if not members:
+            return
+        stored = self.client.transaction(*[('EXISTS', self._key('entry', member.decode())) for member in members])
+        missing = [member for member, exists in zip(members, stored) if not exists]
+        if not missing:
+            return
+
+        # An entry stored again between the two reads has already re-added its
+        # key, which SREM would drop; check once more and add those back
+        replies = self.client.transaction(
+            ('SREM', tag_key, *missing),
+            *[('EXISTS', self._key('entry', member.decode())) for member in missing]
+        )
+        restored = [member for member, exists in zip(missing, replies[1:]) if exists]
+        if restored:
+            self.client.execute('SADD', tag_key, *restored)
+
+    def clear(self):
+        cursor = '0'
+        while True:
+            cursor, keys = self.client.execute('SCAN', cursor, 'MATCH', f"{self.prefix}*", 'COUNT', 500)
+            if keys:
+                self.client.execute('DEL', *keys)
+            if cursor == b'0':
+                break
+
+    def add_tags(self, key, tags, expires_at=None):
+        ttl = None if expires_at is None else max(int(expires_at - time.time()) + 1, 1)
+        for tag in tags:
+            tag_key = self._key('tag', tag)
+            if ttl is None:
+                self.client.execute('SADD', tag_key, key)
+            else:
+                # Only ever extend the set's TTL, so it outlives every entry in it
+                self.client.transaction(
+                    ('SADD', tag_key, key), ('EXPIRE', tag_key, ttl, 'NX'), ('EXPIRE', tag_key, ttl, 'GT')
+                )
+
+    def pop_tag(self, tag):
+        tag_key = self._key('tag', tag)
+        members, _ = self.client.transaction(('SMEMBERS', tag_key), ('DEL', tag_key))
+        return {member.decode() for member in members or ()}
+
+    def publish_invalidations(self, tags, now):
+        self.client.execute('RPUSH', self._key('journal', 'entries'), *[f"{now}\t{tag}" for tag in tags])
+
+    def poll_invalidations(self, cursor):
+        # The trimmed count seen by the last poll gives the list index of the
+        # cursor; if compaction changed it meanwhile, read again from the new index
+        trimmed = self._trimmed
+        while True:
+            start = max((cursor or 0) - trimmed, 0)
+            current, entries = self.client.transaction(
+                ('GET', self._key('journal', 'trimmed')),
+                ('LRANGE', self._key('journal', 'entries'), start, -1)
+            )
+            current = int(current or 0)
+            if current == trimmed:
+                break
+            trimmed = current
+        self._trimmed = trimmed
+        return trimmed + start + len(entries), [entry.decode().partition('\t')[2] for entry in entries]
+
+    def journal_cursor(self):
+        trimmed, length = self.client.transaction(
+            ('GET', self._key('journal', 'trimmed')),
+            ('LLEN', self._key('journal', 'entries'))
+        )
+        return int(trimmed or 0) + length
+
+    def compact_invalidations(self, keep_after):
+        # Read from the head in batches, stopping at the first entry to keep
+        expired, done = 0, False
+        while not done:
+            entries = self.client.execute(
+                'LRANGE', self._key('journal', 'entries'), expired, expired + self.COMPACT_BATCH - 1
+            )
+            done = len(entries) < self.COMPACT_BATCH
+            for entry in entries:
+                if float(entry.partition(b'\t')[0]) > keep_after:
+                    done = True
+                    break
+                expired += 1
+        if expired:
+            self.client.transaction(
+                ('LTRIM', self._key('journal', 'entries'), expired, -1),
+                ('INCRBY', self._key('journal', 'trimmed'), expired)
+            )
+
+def create_backend(name, cache_dir, sqlite_path=None, redis_url=None):
+    """
+    Create a cache backend by name
+
+    Args:
+        name: 'file', 'memory', 'sqlite' or 'redis'
+        cache_dir: Cache directory (used by the file backend and as the default
+            location of the SQLite database)
+        sqlite_path: Path of the SQLite database file
+        redis_url: URL of the Redis server
+
+    Returns:
+        CacheBackend: The backend
+    """
+    if name == 'file':
+        return FileBackend(cache_dir)
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(sqlite_path or os.path.join(cache_dir, 'cache.sqlite3'))
+    if name == 'redis':
+        if not redis_url:
+            raise ValueError('CACHE_REDIS_URL is required for the redis cache backend')
+        return RedisBackend(redis_url)
+    raise ValueError(f"Unknown cache backend: {name}")
@@ -0,0 +1,58 @@
+"""
+Shared pytest fixtures
+"""
+import pytest
+from flask import Flask
+from flask_login import LoginManager
+
+import cache
+import models
+import search
+from api import api
+from cache_backends import MemoryBackend
+from models import db
+
+@pytest.fixture
+def make_app():
+    """
+    Factory for apps on an empty database with the API blueprint registered
+
+    Each app gets a memory cache backend and no search backend. The process-wide
+    cache and search backends and the history tracking flag are restored when
+    the test ends.
+
+    The factory takes:
+        seed: Function called in an app context to add the test's rows
+        database_url: SQLAlchemy database URL (default: in-memory SQLite)
+        init: Functions called with the app after seeding, e.g. search.init_app
+        seed_history: Whether seeding records history rows
+        **config: Extra app config settings
+    """
+    saved = cache.backend, search.backend, models.ENABLE_HISTORY_TRACKING, search._pending_backend
+
+    def create(seed, database_url='sqlite://', init=(), seed_history=True, **config):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+        app.config.update(config)
+        db.init_app(app)
+        app.register_blueprint(api, url_prefix='/api')
+        LoginManager(app).user_loader(lambda user_id: None)
+        cache.backend = MemoryBackend()
+        search.backend = search._pending_backend = None
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            models.ENABLE_HISTORY_TRACKING = seed_history
+            try:
+                seed()
+                db.session.commit()
+            finally:
+                models.ENABLE_HISTORY_TRACKING = saved[2]
+
+        for init_extension in init:
+            init_extension(app)
+        return app
+
+    yield create
+    cache.backend, search.backend, models.ENABLE_HISTORY_TRACKING, search._pending_backend = saved
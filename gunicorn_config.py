@@ -2,6 +2,7 @@
 Gunicorn configuration for production deployment
 """
 import os
+import sys
 
 # Server socket
 bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
@@ -24,3 +25,10 @@ errorlog = '-'
 loglevel = 'info'
 accesslog = '-'
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+# Server hooks
+def post_worker_init(worker):
+    """Start the app's cache warm-up from the first worker only, so it runs once per server start"""
+    cache = sys.modules.get('cache')
+    if worker.age == 1 and cache is not None:
+        cache.cache_warmer.start_startup_warmup()
@@ -1,9 +1,14 @@
 from flask_sqlalchemy import SQLAlchemy
+import logging
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from cache import invalidate_tags
+from utils import safe_json_loads
 
 db = SQLAlchemy()
+logger = logging.getLogger(__name__)
 
 # Association tables for many-to-many relationships
 condition_medication = db.Table('condition_medication',
@@ -34,6 +39,50 @@ medication_reference = db.Table('medication_reference',
 # Global flag to disable history creation during database seeding
 ENABLE_HISTORY_TRACKING = True
 
+def queue_cache_invalidation(target, tags):
+    """
+    Queue cache tags to be invalidated once the target's transaction commits
+    
+    Invalidating after commit (rather than during the flush) ensures a concurrent
+    request cannot re-cache a page from the old data after the invalidation,
+    and that rolled back changes invalidate nothing. Requests that read the old
+    data before the commit and store their page after the invalidation are
+    caught by set_cached, which drops entries whose tags were invalidated while
+    they were being computed.
+    """
+    session = object_session(target)
+    if session is None:
+        invalidate_tags(*tags)
+        return
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+def related_cache_tags(target, attribute, prefix):
+    """Build cache tags for related objects added to or removed from a relationship"""
+    history = inspect(target).attrs[attribute].history
+    return {
+        f"{prefix}:{item.id}"
+        for item in list(history.added or ()) + list(history.deleted or ())
+        if item.id is not None
+    }
+
+def column_cache_tags(target, attribute, prefix):
+    """Build cache tags for the current and any previous value of a column"""
+    history = inspect(target).attrs[attribute].history
+    values = list(history.added or ()) + list(history.deleted or ()) + list(history.unchanged or ())
+    return {f"{prefix}:{value}" for value in values if value is not None}
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_cache_after_commit(session):
+    """Invalidate cache entries for everything changed in the committed transaction"""
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        invalidate_tags(*tags)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_cache_invalidation(session):
+    """Discard queued cache invalidations when the transaction is rolled back"""
+    session.info.pop('cache_tags', None)
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
@@ -155,20 +204,36 @@ def create_condition_history(condition, user_id=None, change_type='update'):
     db.session.add(history)
     return history
 
+def condition_cache_tags(condition):
+    """Get the cache tags affected by a change to a condition"""
+    return (
+        {'conditions', f"condition:{condition.id}"}
+        | column_cache_tags(condition, 'specialty_id', 'specialty')
+        | related_cache_tags(condition, 'medications', 'medication')
+        | related_cache_tags(condition, 'references', 'reference')
+    )
+
 @event.listens_for(Condition, 'after_update')
 def condition_after_update(mapper, connection, condition):
-    """Create history record after condition update"""
+    """Invalidate cached pages and create history record after condition update"""
+    queue_cache_invalidation(condition, condition_cache_tags(condition))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_condition_history(condition)
 
 @event.listens_for(Condition, 'after_insert')
 def condition_after_insert(mapper, connection, condition):
-    """Create history record after condition insert"""
+    """Invalidate cached pages and create history record after condition insert"""
+    queue_cache_invalidation(condition, condition_cache_tags(condition))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_condition_history(condition, change_type='create')
 
+@event.listens_for(Condition, 'after_delete')
+def condition_after_delete(mapper, connection, condition):
+    """Invalidate cached pages after condition delete"""
+    queue_cache_invalidation(condition, condition_cache_tags(condition))
+
 class Medication(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -261,20 +326,36 @@ def create_medication_history(medication, user_id=None, change_type='update'):
     db.session.add(history)
     return history
 
+def medication_cache_tags(medication):
+    """Get the cache tags affected by a change to a medication"""
+    return (
+        {'medications', f"medication:{medication.id}"}
+        | column_cache_tags(medication, 'class_name', 'medication_class')
+        | related_cache_tags(medication, 'specialties', 'specialty')
+        | related_cache_tags(medication, 'references', 'reference')
+    )
+
 @event.listens_for(Medication, 'after_update')
 def medication_after_update(mapper, connection, medication):
-    """Create history record after medication update"""
+    """Invalidate cached pages and create history record after medication update"""
+    queue_cache_invalidation(medication, medication_cache_tags(medication))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_medication_history(medication)
 
 @event.listens_for(Medication, 'after_insert')
 def medication_after_insert(mapper, connection, medication):
-    """Create history record after medication insert"""
+    """Invalidate cached pages and create history record after medication insert"""
+    queue_cache_invalidation(medication, medication_cache_tags(medication))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_medication_history(medication, change_type='create')
 
+@event.listens_for(Medication, 'after_delete')
+def medication_after_delete(mapper, connection, medication):
+    """Invalidate cached pages after medication delete"""
+    queue_cache_invalidation(medication, medication_cache_tags(medication))
+
 class MedicationRelationship(db.Model):
     """Model for relationships between medications"""
     __tablename__ = 'medication_relationships'
@@ -301,6 +382,13 @@ class Specialty(db.Model):
     def __repr__(self):
         return f'<Specialty {self.name}>'
 
+@event.listens_for(Specialty, 'after_insert')
+@event.listens_for(Specialty, 'after_update')
+@event.listens_for(Specialty, 'after_delete')
+def specialty_after_change(mapper, connection, specialty):
+    """Invalidate cached pages after a specialty changes"""
+    queue_cache_invalidation(specialty, {'specialties', f"specialty:{specialty.id}"})
+
 class Reference(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -316,6 +404,13 @@ class Reference(db.Model):
     def __repr__(self):
         return f'<Reference {self.title}>'
 
+@event.listens_for(Reference, 'after_insert')
+@event.listens_for(Reference, 'after_update')
+@event.listens_for(Reference, 'after_delete')
+def reference_after_change(mapper, connection, reference):
+    """Invalidate cached pages after a reference changes"""
+    queue_cache_invalidation(reference, {'references', f"reference:{reference.id}"})
+
 class Guideline(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -398,16 +493,232 @@ def create_guideline_history(guideline, user_id=None, change_type='update'):
     db.session.add(history)
     return history
 
+def guideline_cache_tags(guideline):
+    """Get the cache tags affected by a change to a guideline"""
+    return (
+        {'guidelines', f"guideline:{guideline.id}"}
+        | column_cache_tags(guideline, 'specialty_id', 'specialty')
+    )
+
 @event.listens_for(Guideline, 'after_update')
 def guideline_after_update(mapper, connection, guideline):
-    """Create history record after guideline update"""
+    """Invalidate cached pages and create history record after guideline update"""
+    queue_cache_invalidation(guideline, guideline_cache_tags(guideline))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_guideline_history(guideline)
 
 @event.listens_for(Guideline, 'after_insert')
 def guideline_after_insert(mapper, connection, guideline):
-    """Create history record after guideline insert"""
+    """Invalidate cached pages and create history record after guideline insert"""
+    queue_cache_invalidation(guideline, guideline_cache_tags(guideline))
     if not db.session.is_active or not ENABLE_HISTORY_TRACKING:
         return
     create_guideline_history(guideline, change_type='create')
+
+@event.listens_for(Guideline, 'after_delete')
+def guideline_after_delete(mapper, connection, guideline):
+    """Invalidate cached pages after guideline delete"""
+    queue_cache_invalidation(guideline, guideline_cache_tags(guideline))
+
+class ConditionTerm(db.Model):
+    """One item of a condition's symptoms or treatments list, for indexed lookups"""
+    __tablename__ = 'condition_term'
+    __table_args__ = (db.Index('ix_condition_term_field_normalized', 'field', 'normalized'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.String(20), nullable=False)  # 'symptoms' or 'treatments'
+    term = db.Column(db.Text, nullable=False)  # As stored in the JSON list
+    normalized = db.Column(db.String(255), nullable=False)  # Lower-cased, whitespace collapsed
+    
+    def __repr__(self):
+        return f'<ConditionTerm {self.condition_id} {self.field}: {self.term}>'
+
+class MedicationTerm(db.Model):
+    """One item of a medication's uses, side effects or contraindications list, for indexed lookups"""
+    __tablename__ = 'medication_term'
+    __table_args__ = (db.Index('ix_medication_term_field_normalized', 'field', 'normalized'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    medication_id = db.Column(db.Integer, db.ForeignKey('medication.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.String(20), nullable=False)  # 'uses', 'side_effects' or 'contraindications'
+    term = db.Column(db.Text, nullable=False)  # As stored in the JSON list
+    normalized = db.Column(db.String(255), nullable=False)  # Lower-cased, whitespace collapsed
+    
+    def __repr__(self):
+        return f'<MedicationTerm {self.medication_id} {self.field}: {self.term}>'
+
+# JSON list columns mirrored into term tables: model -> (term model, foreign key column, fields)
+TERM_COLUMNS = {
+    Condition: (ConditionTerm, 'condition_id', ('symptoms', 'treatments')),
+    Medication: (MedicationTerm, 'medication_id', ('uses', 'side_effects', 'contraindications'))
+}
+
+def normalize_term(term):
+    """Lower-case a term and collapse its whitespace"""
+    return ' '.join(str(term).lower().split())[:255]
+
+def list_terms(value):
+    """
+    Split a JSON list column into its distinct terms
+    
+    Args:
+        value: Column value; a JSON list, or plain text taken as a single term
+        
+    Returns:
+        list: (term, normalized term) pairs, in list order
+    """
+    if not value:
+        return []
+    items = safe_json_loads(value, value)
+    if not isinstance(items, list):
+        items = [value]
+    
+    terms = {}
+    for item in items:
+        if item is None:
+            continue
+        normalized = normalize_term(item)
+        if normalized:
+            terms.setdefault(normalized, str(item).strip())
+    return [(term, normalized) for normalized, term in terms.items()]
+
+def write_record_terms(connection, model, record, fields):
+    """Replace the term rows of some of a record's JSON list columns, through the flush connection"""
+    term_model, foreign_key, _ = TERM_COLUMNS[model]
+    table = term_model.__table__
+    for field in fields:
+        connection.execute(table.delete().where(table.c[foreign_key] == record.id, table.c.field == field))
+        rows = [
+            {foreign_key: record.id, 'field': field, 'term': term, 'normalized': normalized}
+            for term, normalized in list_terms(getattr(record, field))
+        ]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+def record_terms_after_insert(mapper, connection, record):
+    """Mirror a new record's JSON list columns into its term table"""
+    write_record_terms(connection, mapper.class_, record, TERM_COLUMNS[mapper.class_][2])
+
+def record_terms_after_update(mapper, connection, record):
+    """Mirror the JSON list columns that changed into the record's term table"""
+    state = inspect(record)
+    fields = [field for field in TERM_COLUMNS[mapper.class_][2] if state.attrs[field].history.has_changes()]
+    write_record_terms(connection, mapper.class_, record, fields)
+
+def record_terms_before_delete(mapper, connection, record):
+    """Remove a record's term rows before the record itself"""
+    term_model, foreign_key, _ = TERM_COLUMNS[mapper.class_]
+    table = term_model.__table__
+    connection.execute(table.delete().where(table.c[foreign_key] == record.id))
+
+for model in TERM_COLUMNS:
+    event.listen(model, 'after_insert', record_terms_after_insert)
+    event.listen(model, 'after_update', record_terms_after_update)
+    event.listen(model, 'before_delete', record_terms_before_delete)
+
+def rebuild_model_terms(connection, model):
+    """Rebuild one model's term table from its JSON list columns, returning the number of rows written"""
+    term_model, foreign_key, fields = TERM_COLUMNS[model]
+    table = term_model.__table__
+    connection.execute(table.delete())
+    written = 0
+    for record in model.query.yield_per(500):
+        rows = [
+            {foreign_key: record.id, 'field': field, 'term': term, 'normalized': normalized}
+            for field in fields
+            for term, normalized in list_terms(getattr(record, field))
+        ]
+        if rows:
+            connection.execute(table.insert(), rows)
+            written += len(rows)
+    return written
+
+def rebuild_record_terms(connection):
+    """
+    Rebuild every term table from the JSON list columns
+    
+    Args:
+        connection: SQLAlchemy connection to write through
+        
+    Returns:
+        int: Number of term rows written
+    """
+    return sum(rebuild_model_terms(connection, model) for model in TERM_COLUMNS)
+
+def backfill_record_terms(connection):
+    """
+    Fill the term tables of a database whose records predate them
+    
+    The term tables are only written by the mapper events, so on a database
+    created before they existed with_term would match nothing. Any term table
+    that is missing, or empty while its model has records, is created and
+    rebuilt (as `flask rebuild-term-index` does).
+    
+    Args:
+        connection: SQLAlchemy connection to write through
+        
+    Returns:
+        int: Number of term rows written
+    """
+    written = 0
+    for model, (term_model, _, _) in TERM_COLUMNS.items():
+        table = term_model.__table__
+        if not inspect(connection).has_table(model.__tablename__):
+            continue
+        if inspect(connection).has_table(table.name):
+            if connection.execute(db.select(table.c.id).limit(1)).first() is not None:
+                continue
+        else:
+            table.create(connection)
+        if connection.execute(db.select(model.id).limit(1)).first() is None:
+            continue
+        logger.warning(f"Term table {table.name} is missing or empty; rebuilding it from {model.__tablename__}")
+        written += rebuild_model_terms(connection, model)
+    return written
+
+def term_record_ids(model, field, term, prefix=False):
+    """
+    Select the IDs of the records with a JSON list column item equal to a term
+    
+    Looks the term up in the model's term table, through its index on
+    (field, normalized), rather than scanning the JSON text.
+    
+    Args:
+        model: Condition or Medication
+        field: JSON list column name (e.g. 'contraindications')
+        term: Item to look for (case and spacing are ignored)
+        prefix: Also match items that start with term
+        
+    Returns:
+        Select: Subquery of record IDs
+        
+    Raises:
+        ValueError: If the column is not mirrored into a term table
+    """
+    term_model, foreign_key, fields = TERM_COLUMNS[model]
+    if field not in fields:
+        raise ValueError(f"{model.__name__}.{field} has no term table")
+    
+    normalized = normalize_term(term)
+    condition = term_model.normalized == normalized
+    if prefix:
+        # A range, so the lookup stays an index scan
+        condition = db.and_(term_model.normalized >= normalized, term_model.normalized < normalized + '\uffff')
+    return db.select(getattr(term_model, foreign_key)).where(term_model.field == field, condition)
+
+def with_term(model, field, term, prefix=False):
+    """
+    Query the records with a JSON list column item equal to a term (see term_record_ids)
+    
+    Args:
+        model: Condition or Medication
+        field: JSON list column name (e.g. 'contraindications')
+        term: Item to look for (case and spacing are ignored)
+        prefix: Also match items that start with term
+        
+    Returns:
+        Query: Query over model
+    """
+    return model.query.filter(model.id.in_(term_record_ids(model, field, term, prefix)))
@@ -0,0 +1,139 @@
+"""
+Keyset pagination for the medical reference app
+
+Pages are found by seeking past the sort key of the last row shown rather than
+by skipping rows with OFFSET, so every page costs the same however deep it is,
+and the total is only counted when a caller asks for it. Positions are handed
+to clients as opaque cursor tokens.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from sqlalchemy import and_, or_
+import binascii
+import json
+
+# Default and maximum page sizes
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor token cannot be decoded"""
+
+def encode_cursor(values):
+    """
+    Encode a position as an opaque cursor token
+
+    Args:
+        values: JSON-serialisable list of values
+
+    Returns:
+        str: URL-safe token
+    """
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """
+    Decode a cursor token made by encode_cursor
+
+    Args:
+        token: Cursor token
+
+    Returns:
+        list: The encoded values
+
+    Raises:
+        InvalidCursor: If the token is malformed
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {token}") from e
+    if not isinstance(values, list):
+        raise InvalidCursor(f"Invalid cursor: {token}")
+    return values
+
+class KeysetPage:
+    """
+    One page of a keyset-paginated query
+
+    Attributes:
+        items: Records on the page
+        next_cursor: Cursor of the following page (None on the last page)
+        prev_cursor: Cursor of the preceding page (None on the first page)
+        total: Number of records across all pages (None unless requested)
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+def keyset_paginate(query, sort_column, id_column, per_page=DEFAULT_PER_PAGE, cursor=None, with_total=False):
+    """
+    Fetch one page of a query ordered by (sort_column, id_column)
+
+    Args:
+        query: Query with any filters applied (any ordering is replaced)
+        sort_column: Column the records are listed by (must not be NULL)
+        id_column: Unique column that breaks ties
+        per_page: Maximum number of records on the page
+        cursor: Cursor token from a previous page (None for the first page)
+        with_total: Also count the records across all pages
+
+    Returns:
+        KeysetPage: The page
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    direction, sort_value, id_value = 'next', None, None
+    if cursor:
+        values = decode_cursor(cursor)
+        if (len(values) != 3 or values[0] not in ('next', 'prev')
+                or isinstance(values[1], bool) or not isinstance(values[1], (str, int, float))
+                or isinstance(values[2], bool) or not isinstance(values[2], int)):
+            raise InvalidCursor(f"Invalid cursor: {cursor}")
+        direction, sort_value, id_value = values
+
+    page_query = query
+    if cursor and direction == 'next':
+        page_query = page_query.filter(or_(
+            sort_column > sort_value, and_(sort_column == sort_value, id_column > id_value)
+        ))
+        page_query = page_query.order_by(sort_column, id_column)
+    elif cursor:
+        page_query = page_query.filter(or_(
+            sort_column < sort_value, and_(sort_column == sort_value, id_column < id_value)
+        ))
+        page_query = page_query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        page_query = page_query.order_by(sort_column, id_column)
+
+    # One extra row tells whether there is another page in this direction
+    rows = page_query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    def position(direction, row):
+        return encode_cursor([direction, getattr(row, sort_column.key), getattr(row, id_column.key)])
+
+    has_next = more if direction == 'next' else bool(cursor)
+    has_prev = bool(cursor) if direction == 'next' else more
+    total = query.order_by(None).count() if with_total else None
+    return KeysetPage(
+        rows,
+        position('next', rows[-1]) if has_next and rows else None,
+        position('prev', rows[0]) if has_prev and rows else None,
+        total
+    )
@@ -0,0 +1,1369 @@
+"""
+Search module for the medical reference app
+
+This module keeps two indexes of conditions, medications, specialties,
+guidelines and references in step with the database:
+- A full-text index in the database (see search_backends.py), used by app.search
+  to find the records it renders
+- An in-process inverted index holding every record's API representation, which
+  answers api.search without touching the database and cuts its snippets
+- An in-process sorted name index answering api.autocomplete
+- An in-process trigram index of condition and medication name words, used to
+  correct misspelled queries that find nothing
+
+Both app.search and api.search keep their hits in a result cache keyed on the
+canonical form of the query, which is dropped whenever indexed data changes.
+"""
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+import cache
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+from models import db, Condition, Medication, Specialty, Reference, Guideline
+from search_backends import FIELD_WEIGHTS, SEARCH_FIELDS, LikeBackend, QueryTerm, create_search_backend
+from utils import safe_json_loads
+
+# Searchable entity types: model and the columns indexed in each index field
+SEARCH_TYPES = {
+    'condition': (Condition, {
+        'name': ('name',), 'keywords': ('symptoms',), 'body': ('description', 'treatments')
+    }),
+    'medication': (Medication, {
+        'name': ('name',), 'keywords': ('class_name', 'uses'), 'body': ('description', 'dosing')
+    }),
+    'specialty': (Specialty, {
+        'name': ('name',), 'keywords': (), 'body': ('description',)
+    }),
+    'guideline': (Guideline, {
+        'name': ('title',), 'keywords': ('organization',), 'body': ('summary',)
+    }),
+    'reference': (Reference, {
+        'name': ('title',), 'keywords': ('authors', 'publication'), 'body': ()
+    })
+}
+
+# Model class -> entity type
+MODEL_TYPES = {model: entity_type for entity_type, (model, _) in SEARCH_TYPES.items()}
+
+# Columns returned by api.search for each entity type (plus 'specialty' where present)
+RESULT_COLUMNS = {
+    'condition': ('id', 'name', 'description', 'symptoms', 'treatments'),
+    'medication': ('id', 'name', 'class_name', 'uses', 'side_effects', 'dosing', 'contraindications'),
+    'specialty': ('id', 'name', 'description'),
+    'reference': ('id', 'title', 'url', 'authors', 'publication', 'year', 'doi'),
+    'guideline': ('id', 'title', 'organization', 'publication_year', 'summary', 'url')
+}
+
+# Long text columns api.search can return as snippets around the query's matches instead
+SNIPPET_COLUMNS = {
+    'condition': ('description', 'symptoms', 'treatments'),
+    'medication': ('uses', 'side_effects', 'dosing', 'contraindications'),
+    'specialty': ('description',),
+    'reference': (),
+    'guideline': ('summary',)
+}
+
+# Default search backend ('auto' picks tsvector columns on PostgreSQL, FTS5 otherwise)
+DEFAULT_SEARCH_BACKEND = 'auto'
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    """Split text into lower-case word terms"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+logger = logging.getLogger(__name__)
+
+# Default synonym and abbreviation file: a JSON object of term -> list of expansions
+DEFAULT_SYNONYMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'synonyms.json')
+
+class SynonymTable:
+    """
+    Precompiled query expansions for medical synonyms and abbreviations
+
+    Keys and expansions are stored as tuples of words, so parsing a query is a
+    dictionary lookup per word (trying the longest keys first) rather than a
+    scan of the table. A word covered by a key is matched exactly, as typed, or
+    by any of the key's expansions.
+    """
+
+    def __init__(self, expansions=None):
+        self._expansions = {}
+        self._longest = 0
+        for key, values in (expansions or {}).items():
+            words = tuple(tokenize(key))
+            if not words:
+                continue
+            alternatives = [tuple(tokenize(value)) for value in values]
+            self._expansions[words] = tuple(dict.fromkeys(
+                alternative for alternative in alternatives if alternative and alternative != words
+            ))
+            self._longest = max(self._longest, len(words))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a synonym file
+
+        Args:
+            path: JSON file of term -> list of expansions
+
+        Returns:
+            SynonymTable: The compiled table (empty if the file does not exist)
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def parse(self, words):
+        """
+        Group query words into clauses, expanding synonyms and abbreviations
+
+        Args:
+            words: Lower-case query words
+
+        Returns:
+            list: Clauses (tuples of alternatives, each a tuple of QueryTerm);
+                words without expansions are single prefix terms
+        """
+        clauses = []
+        position = 0
+        while position < len(words):
+            for length in range(min(self._longest, len(words) - position), 0, -1):
+                key = tuple(words[position:position + length])
+                if key in self._expansions:
+                    clauses.append(
+                        (tuple(QueryTerm(word, False) for word in key),) +
+                        tuple(tuple(QueryTerm(word, True) for word in expansion) for expansion in self._expansions[key])
+                    )
+                    position += length
+                    break
+            else:
+                clauses.append(((QueryTerm(words[position], True),),))
+                position += 1
+        return clauses
+
+    def __len__(self):
+        return len(self._expansions)
+
+# BM25 parameters: term frequency saturation, and length normalisation per index field
+BM25_K1 = 1.2
+BM25_B = {'name': 0.3, 'keywords': 0.75, 'body': 0.75}
+
+# Score multiplier for query terms that match only as the start of a longer word
+PREFIX_MATCH_WEIGHT = 0.8
+
+# Position of each entity type in merged result lists, where scores tie
+TYPE_ORDER = {entity_type: position for position, entity_type in enumerate(SEARCH_TYPES)}
+
+def rank_key(entity_type, entity_id, score):
+    """Get the sort key of a hit in merged result lists (lower ranks first)"""
+    return (-score, TYPE_ORDER[entity_type], entity_id)
+
+# Record stored in the inverted index
+IndexedDocument = namedtuple(
+    'IndexedDocument', 'entity_type entity_id field_terms field_lengths payload specialties facets texts positions'
+)
+
+# Default seconds between attempts to install a search backend that could not be installed
+DEFAULT_BACKEND_RETRY = 60
+
+# Default size limits of the search result cache
+DEFAULT_QUERY_CACHE_ENTRIES = 1024
+DEFAULT_QUERY_CACHE_BYTES = 16 * 1024 * 1024
+
+# Approximate memory taken by one cached hit: its key, score and dictionary slot
+CACHED_HIT_BYTES = 120
+
+class QueryCache:
+    """
+    Thread-safe LRU cache of search results keyed on canonical queries
+
+    Callers key entries on canonical_clauses(), so searches that differ only in
+    case, punctuation, spacing or word order share an entry. Each entry keeps
+    the data version it was computed at, and is a miss (and dropped) once the
+    caller's version has moved on. The cache is bounded both by its number of
+    entries and by the approximate size of the hits they hold; cached values
+    are shared, so callers must not modify them.
+    """
+
+    def __init__(self, max_entries=DEFAULT_QUERY_CACHE_ENTRIES, max_bytes=DEFAULT_QUERY_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key, version):
+        """
+        Look up the results of a search
+
+        Args:
+            key: Cache key
+            version: Current data version
+
+        Returns:
+            tuple: (hit, value)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def set(self, key, version, value, hit_count):
+        """
+        Store the results of a search, evicting the least recently used entries over the limits
+
+        Args:
+            key: Cache key
+            version: Data version the results were computed at
+            value: Results
+            hit_count: Number of hits in the results, to estimate their size
+        """
+        size = CACHED_HIT_BYTES * (hit_count + 1)
+        with self._lock:
+            if self.max_entries <= 0 or size > self.max_bytes:
+                return
+            self._pop(key)
+            self._entries[key] = (version, size, value)
+            self._bytes += size
+            self._trim()
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _trim(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+    def configure(self, max_entries=None, max_bytes=None):
+        """Update the size limits, trimming entries if they shrank"""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._trim()
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def size(self):
+        """Approximate size of the cached hits, in bytes"""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+# Default length of a snippet, in characters
+DEFAULT_SNIPPET_LENGTH = 160
+
+# Marks text cut from either end of a snippet
+SNIPPET_ELLIPSIS = '\u2026'
+
+def snippet_window(text, spans, length):
+    """
+    Choose the part of a text to show as a snippet
+
+    Args:
+        text: Column text
+        spans: Sorted (start, end) offsets of the matches in text
+        length: Maximum snippet length
+
+    Returns:
+        tuple: (start, end) offsets of the window covering the most matches,
+            with the context around them split evenly and cut at spaces
+    """
+    if len(text) <= length:
+        return 0, len(text)
+
+    start = 0
+    if spans:
+        # The run of matches that fits in the window and has the most of them
+        best, best_count = 0, 0
+        for first, (first_start, _) in enumerate(spans):
+            count = sum(1 for _, end in spans[first:] if end <= first_start + length)
+            if count > best_count:
+                best, best_count = first, count
+        covered_start, covered_end = spans[best][0], spans[best + max(best_count, 1) - 1][1]
+        start = max(0, covered_start - max(length - (covered_end - covered_start), 0) // 2)
+    end = min(len(text), start + length)
+    start = max(0, end - length)
+
+    # Don't cut words in half
+    inside = [span for span in spans if span[0] >= start and span[1] <= end]
+    if start > 0:
+        space = text.find(' ', start, inside[0][0] if inside else end)
+        start = start if space == -1 else space + 1
+    if end < len(text):
+        space = text.rfind(' ', inside[-1][1] if inside else start, end)
+        end = end if space == -1 else space
+    return start, end
+
+# Facets counted over search results: entity type, plus the values of record_facets()
+FACETS = ('type', 'specialty', 'medication_class', 'organization')
+
+class InvertedIndex:
+    """
+    In-process inverted index over every searchable record
+
+    Each index field has its own posting lists (term -> {document key: term
+    frequency}), and a sorted vocabulary turns a term prefix into the terms it
+    covers with two binary searches. Documents also keep the record's API
+    payload and specialty names, so a search and its filters never need the
+    database, and the text of their long columns with the offsets of every
+    word in it, so snippets of the matches are cut without searching the text
+    again. Every word of a query must match a word or word prefix, or one
+    of its synonym expansions (see SynonymTable).
+
+    Matches are scored with BM25F: each field's term frequency is normalised by
+    the field's length relative to its average and weighted by FIELD_WEIGHTS
+    before saturation, and IDF comes from the whole corpus, so scores are
+    comparable across entity types.
+    """
+
+    def __init__(self, query_cache=None):
+        self._postings = {field: {} for field in SEARCH_FIELDS}
+        self._vocabulary = []
+        self._documents = {}
+        self._total_lengths = dict.fromkeys(SEARCH_FIELDS, 0)
+        self._lock = threading.RLock()
+        # Incremented on every change, so cached results can tell they are stale
+        self.version = 0
+        self.query_cache = query_cache
+
+    def add(self, entity_type, entity_id, fields, payload, specialties=None, facets=None, texts=None):
+        """
+        Index (or re-index) a record
+
+        Args:
+            entity_type: Entity type name
+            entity_id: Record ID
+            fields: Index field -> text
+            payload: Value returned for the record by payload()
+            specialties: Specialty names the record can be filtered by (None if
+                the entity type has no specialty)
+            facets: Facet name -> list of the record's values
+            texts: Column name -> text that snippets() cuts snippets from
+        """
+        key = (entity_type, entity_id)
+        field_terms = {field: Counter(tokenize(fields.get(field, ''))) for field in SEARCH_FIELDS}
+        field_lengths = {field: sum(terms.values()) for field, terms in field_terms.items()}
+        texts = {column: text for column, text in (texts or {}).items() if text}
+        positions = {}
+        for column, text in texts.items():
+            for match in TOKEN_PATTERN.finditer(text):
+                positions.setdefault(match.group().lower(), []).append((column, match.start(), match.end()))
+
+        with self._lock:
+            self._remove(key)
+            self.version += 1
+            self._documents[key] = IndexedDocument(
+                entity_type, entity_id, field_terms, field_lengths, payload,
+                None if specialties is None else frozenset(specialties),
+                tuple((facet, value) for facet, values in (facets or {}).items() for value in values if value),
+                texts, positions
+            )
+            for field, terms in field_terms.items():
+                self._total_lengths[field] += field_lengths[field]
+                postings = self._postings[field]
+                for term, frequency in terms.items():
+                    if term not in postings:
+                        postings[term] = {}
+                        if not self._has_term(term, skip_field=field):
+                            insort(self._vocabulary, term)
+                    postings[term][key] = frequency
+
+    def remove(self, entity_type, entity_id):
+        """Remove a record if it is indexed"""
+        with self._lock:
+            self._remove((entity_type, entity_id))
+
+    def _remove(self, key):
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        self.version += 1
+
+        for field, terms in document.field_terms.items():
+            self._total_lengths[field] -= document.field_lengths[field]
+            postings = self._postings[field]
+            for term in terms:
+                postings[term].pop(key, None)
+                if not postings[term]:
+                    del postings[term]
+                    if not self._has_term(term):
+                        del self._vocabulary[bisect_left(self._vocabulary, term)]
+
+    def _has_term(self, term, skip_field=None):
+        return any(term in postings for field, postings in self._postings.items() if field != skip_field)
+
+    def expand(self, prefix):
+        """Return the indexed terms starting with prefix"""
+        with self._lock:
+            start = bisect_left(self._vocabulary, prefix)
+            end = bisect_left(self._vocabulary, prefix + '\uffff', start)
+            return self._vocabulary[start:end]
+
+    def search(self, query, types=None, specialty=None):
+        """
+        Find the records matching a query, grouped by entity type
+
+        Args:
+            query: Search text; a blank query matches every record
+            types: Entity types to search (default: all)
+            specialty: Only return records of this specialty (entity types
+                without a specialty are not filtered)
+
+        Returns:
+            dict: Entity type -> list of (id, score), best match first
+                (blank queries list records by ID)
+        """
+        types = list(SEARCH_TYPES if types is None else types)
+        results = {entity_type: [] for entity_type in types}
+        for (entity_type, entity_id), score in self._matches(query, types, specialty):
+            results[entity_type].append((entity_id, score))
+
+        for hits in results.values():
+            hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return results
+
+    def top(self, query, types=None, specialty=None, limit=20, offset=0, with_facets=False, after=None,
+            term_scores=None):
+        """
+        Find one page of the best matches across all entity types
+
+        Only the first offset + limit matches are ordered, using a heap, so the
+        cost grows with the page depth rather than the number of matches. With
+        after, the page starts just past a hit from an earlier page instead,
+        so the cost no longer grows with depth at all.
+
+        Args:
+            query: Search text; a blank query matches every record
+            types: Entity types to search (default: all)
+            specialty: Only return records of this specialty
+            limit: Maximum number of results
+            offset: Number of results to skip
+            with_facets: Also count the facet values of every match
+            after: (entity_type, id, score) of the hit before the page
+            term_scores: Dict the scores of each query term are kept in, to
+                share them with other searches (see top_many)
+
+        Returns:
+            tuple: (total number of matches, list of (entity_type, id, score)),
+                best match first; ties (and blank queries) are ordered by
+                entity type, then ID. With with_facets, the facet counts of
+                all matches (see facet_counts) are appended.
+        """
+        types = list(SEARCH_TYPES if types is None else types)
+        matches = self._matches(query, types, specialty, term_scores)
+
+        candidates = matches
+        if after is not None:
+            start = rank_key(*after)
+            candidates = [match for match in matches if rank_key(*match[0], match[1]) > start]
+        page = heapq.nsmallest(
+            offset + limit, candidates,
+            key=lambda match: rank_key(*match[0], match[1])
+        )[offset:]
+        page = [(entity_type, entity_id, score) for (entity_type, entity_id), score in page]
+        if with_facets:
+            return len(matches), page, self.facet_counts(key for key, _ in matches)
+        return len(matches), page
+
+    def top_many(self, searches):
+        """
+        Find the best matches of several searches in one pass over the index
+
+        The searches run under a single hold of the index lock, so they all see
+        the same index, and the scores of a term are computed once however many
+        of the searches use it.
+
+        Args:
+            searches: List of (query, types, specialty, limit) (see top)
+
+        Returns:
+            list: (total number of matches, list of (entity_type, id, score))
+                of each search, in the order given
+        """
+        term_scores = {}
+        with self._lock:
+            return [
+                self.top(query, types, specialty, limit, term_scores=term_scores)
+                for query, types, specialty, limit in searches
+            ]
+
+    def facet_counts(self, keys=None):
+        """
+        Count the facet values of a set of records in one pass
+
+        Args:
+            keys: Iterable of (entity_type, id) (default: every record); keys
+                that are not indexed are skipped
+
+        Returns:
+            dict: Facet name -> list of (value, count), most frequent first,
+                then by value
+        """
+        counts = {facet: Counter() for facet in FACETS}
+        with self._lock:
+            documents = self._documents.values() if keys is None else (
+                self._documents.get(key) for key in keys
+            )
+            for document in documents:
+                if document is None:
+                    continue
+                counts['type'][document.entity_type] += 1
+                for facet, value in document.facets:
+                    counts[facet][value] += 1
+
+        return {
+            facet: sorted(values.items(), key=lambda item: (-item[1], item[0]))
+            for facet, values in counts.items()
+        }
+
+    def _matches(self, query, types, specialty, term_scores=None):
+        terms = tokenize(query)
+        types = set(types)
+
+        with self._lock:
+            if terms:
+                scores = self._query_scores(terms, term_scores)
+            elif not query.strip():
+                scores = dict.fromkeys(self._documents, 0.0)
+            else:
+                scores = {}
+
+            matches = []
+            for key, score in scores.items():
+                document = self._documents[key]
+                if document.entity_type not in types:
+                    continue
+                if specialty and document.specialties is not None and specialty not in document.specialties:
+                    continue
+                matches.append((key, score))
+        return matches
+
+    def _query_scores(self, terms, term_scores):
+        # Scores of every match of the query, shared through the result cache
+        clauses = canonical_clauses(terms)
+        if self.query_cache is None:
+            return self._score(clauses, term_scores)
+
+        key = ('memory', clauses)
+        hit, scores = self.query_cache.get(key, self.version)
+        if not hit:
+            scores = self._score(clauses, term_scores)
+            self.query_cache.set(key, self.version, scores, len(scores))
+        return scores
+
+    def _score(self, clauses, term_scores=None):
+        term_scores = {} if term_scores is None else term_scores
+        count = len(self._documents)
+        average_lengths = {
+            field: (total / count if count else 0) or 1 for field, total in self._total_lengths.items()
+        }
+
+        scores = None
+        for clause in clauses:
+            # A clause scores its best alternative, and an alternative the sum of its terms
+            clause_scores = {}
+            for alternative in clause:
+                alternative_scores = None
+                for term in alternative:
+                    if term not in term_scores:
+                        term_scores[term] = self._score_term(term, count, average_lengths)
+                    scored = term_scores[term]
+                    if alternative_scores is None:
+                        alternative_scores = scored
+                    else:
+                        alternative_scores = {
+                            key: score + scored[key] for key, score in alternative_scores.items()
+                            if key in scored
+                        }
+                for key, score in alternative_scores.items():
+                    if score > clause_scores.get(key, 0.0):
+                        clause_scores[key] = score
+
+            # Every clause must match
+            if scores is None:
+                scores = clause_scores
+            else:
+                scores = {key: score + clause_scores[key] for key, score in scores.items() if key in clause_scores}
+            if not scores:
+                break
+        return scores or {}
+
+    def _score_term(self, term, count, average_lengths):
+        # Weighted, length-normalised frequency of the term in each document;
+        # a document matching several expansions of a prefix counts its best one
+        frequencies = {}
+        for expanded in self.expand(term.text) if term.prefix else [term.text]:
+            match_weight = 1.0 if expanded == term.text else PREFIX_MATCH_WEIGHT
+            expanded_frequencies = {}
+            for field, postings in self._postings.items():
+                weight = FIELD_WEIGHTS[field]
+                b = BM25_B[field]
+                for key, frequency in postings.get(expanded, {}).items():
+                    length = self._documents[key].field_lengths[field]
+                    normalised = frequency / (1 - b + b * length / average_lengths[field])
+                    expanded_frequencies[key] = expanded_frequencies.get(key, 0.0) + weight * normalised
+            for key, frequency in expanded_frequencies.items():
+                frequencies[key] = max(frequencies.get(key, 0.0), match_weight * frequency)
+
+        idf = math.log(1 + (count - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+        return {key: idf * frequency / (BM25_K1 + frequency) for key, frequency in frequencies.items()}
+
+    def snippets(self, entity_type, entity_id, query, length=DEFAULT_SNIPPET_LENGTH):
+        """
+        Cut snippets of a record's texts around the words matching a query
+
+        Args:
+            entity_type: Entity type name
+            entity_id: Record ID
+            query: Search text; its words match as in a search (word prefixes
+                and synonym expansions included)
+            length: Maximum length of each snippet, in characters
+
+        Returns:
+            dict: Column name -> {'text': snippet, 'highlights': list of
+                [start, end] offsets of the matches in the snippet}, for the
+                columns with a match; if no column has one, the start of the
+                first text. Empty if the record is not indexed.
+        """
+        document = self._documents.get((entity_type, entity_id))
+        if document is None or not document.texts:
+            return {}
+
+        query_terms = [term for clause in parse_query(tokenize(query)) for alternative in clause for term in alternative]
+        spans = {}
+        for word, word_positions in document.positions.items():
+            if any(word == term.text or term.prefix and word.startswith(term.text) for term in query_terms):
+                for column, start, end in word_positions:
+                    spans.setdefault(column, []).append((start, end))
+        if not spans:
+            column = next(iter(document.texts))
+            spans = {column: []}
+
+        snippets = {}
+        for column, column_spans in spans.items():
+            text = document.texts[column]
+            column_spans.sort()
+            start, end = snippet_window(text, column_spans, length)
+            prefix = SNIPPET_ELLIPSIS if start > 0 else ''
+            offset = len(prefix) - start
+            snippets[column] = {
+                'text': prefix + text[start:end] + (SNIPPET_ELLIPSIS if end < len(text) else ''),
+                'highlights': [
+                    [span_start + offset, span_end + offset] for span_start, span_end in column_spans
+                    if span_start >= start and span_end <= end
+                ]
+            }
+        return snippets
+
+    def payload(self, entity_type, entity_id):
+        """Return the payload stored for a record, or None if it is not indexed"""
+        document = self._documents.get((entity_type, entity_id))
+        return None if document is None else document.payload
+
+    def clear(self):
+        """Remove every document"""
+        with self._lock:
+            self._postings = {field: {} for field in SEARCH_FIELDS}
+            self._vocabulary = []
+            self._documents.clear()
+            self._total_lengths = dict.fromkeys(SEARCH_FIELDS, 0)
+            self.version += 1
+
+    def __len__(self):
+        return len(self._documents)
+
+# Default and maximum number of autocomplete suggestions
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 25
+
+# Suggestion for an autocomplete name
+Suggestion = namedtuple('Suggestion', 'key label kind entity_id')
+
+class NameIndex:
+    """
+    Sorted index of record names for prefix autocomplete
+
+    Every name is stored under its normalised text and under the text from each
+    later word onwards, in two sorted arrays, so 'fail' finds 'Heart Failure'.
+    A lookup is two binary searches and a scan of the suggestions returned;
+    names that start with the prefix come before names with a later word that
+    does. Suggestions of kind 'medication_class' are shared by every medication
+    in the class and returned once.
+    """
+
+    def __init__(self):
+        self._names = []
+        self._words = []
+        self._records = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def normalise(text):
+        """Lower-case text and collapse its whitespace (keeping a trailing space)"""
+        text = text.lower().lstrip()
+        return ' '.join(text.split()) + (' ' if text[-1:].isspace() else '')
+
+    def add(self, entity_type, entity_id, labels):
+        """
+        Index (or re-index) the names of a record
+
+        Args:
+            entity_type: Entity type name
+            entity_id: Record ID
+            labels: List of (kind, name); kind is the entity type for the
+                record's own name
+        """
+        with self._lock:
+            self._remove((entity_type, entity_id))
+            entries = []
+            for kind, label in labels:
+                if not label:
+                    continue
+                key = self.normalise(label).rstrip()
+                entries.append((self._names, Suggestion(key, label, kind, entity_id)))
+                for word in list(TOKEN_PATTERN.finditer(key))[1:]:
+                    entries.append((self._words, Suggestion(key[word.start():], label, kind, entity_id)))
+
+            for array, entry in entries:
+                insort(array, entry)
+            self._records[(entity_type, entity_id)] = entries
+
+    def remove(self, entity_type, entity_id):
+        """Remove the names of a record if they are indexed"""
+        with self._lock:
+            self._remove((entity_type, entity_id))
+
+    def _remove(self, key):
+        for array, entry in self._records.pop(key, ()):
+            del array[bisect_left(array, entry)]
+
+    def suggest(self, prefix, limit=DEFAULT_SUGGESTIONS):
+        """
+        Find the names starting with a prefix, or with a later word that does
+
+        Args:
+            prefix: Typed text
+            limit: Maximum number of suggestions
+
+        Returns:
+            list: Suggestion tuples, names starting with the prefix first, each
+                group in alphabetical order
+        """
+        prefix = self.normalise(prefix)
+        if not prefix.strip() or limit <= 0:
+            return []
+
+        suggestions = []
+        seen = set()
+        with self._lock:
+            for array in (self._names, self._words):
+                start = bisect_left(array, (prefix,))
+                end = bisect_left(array, (prefix + '\uffff',), start)
+                for entry in array[start:end]:
+                    # Medication classes are shared; other names are one per record
+                    identity = (entry.kind, entry.label if entry.kind == 'medication_class' else entry.entity_id)
+                    if identity in seen:
+                        continue
+                    if len(suggestions) >= limit:
+                        return suggestions
+                    seen.add(identity)
+                    suggestions.append(entry)
+        return suggestions
+
+    def clear(self):
+        """Remove every name"""
+        with self._lock:
+            self._names = []
+            self._words = []
+            self._records.clear()
+
+# Entity types whose names are matched with typo tolerance
+FUZZY_TYPES = ('condition', 'medication')
+
+# Share of a word's trigrams a candidate correction must have
+MIN_TRIGRAM_SIMILARITY = 0.3
+
+def max_edits(word):
+    """Return the number of typos tolerated in a word of this length"""
+    return 1 if len(word) <= 4 else 2 if len(word) <= 8 else 3
+
+def trigrams(word):
+    """Get the character trigrams of a word, padded so short words have some"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    """
+    Count the insertions, deletions, substitutions and adjacent transpositions
+    turning a into b (optimal string alignment)
+
+    Args:
+        a: First word
+        b: Second word
+        limit: Stop early once the distance is known to exceed this
+
+    Returns:
+        int: The distance, or limit + 1 if it exceeds limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a[i - 1] != b[j - 1])
+            )
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return min(current[-1], limit + 1)
+
+class TrigramIndex:
+    """
+    Character trigram index over the words of record names, for typo tolerance
+
+    Candidate corrections for a word are the indexed words sharing enough of its
+    trigrams, found through the posting lists of those trigrams only; the
+    candidates are then re-ranked by edit distance. Words are reference-counted
+    by the records whose names contain them.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._words = Counter()
+        self._records = {}
+        self._lock = threading.RLock()
+
+    def add(self, entity_type, entity_id, name):
+        """Index (or re-index) the words of a record's name"""
+        words = set(tokenize(name or ''))
+        with self._lock:
+            self._remove((entity_type, entity_id))
+            self._records[(entity_type, entity_id)] = words
+            for word in words:
+                if not self._words[word]:
+                    for trigram in trigrams(word):
+                        self._postings.setdefault(trigram, set()).add(word)
+                self._words[word] += 1
+
+    def remove(self, entity_type, entity_id):
+        """Remove the words of a record's name if they are indexed"""
+        with self._lock:
+            self._remove((entity_type, entity_id))
+
+    def _remove(self, key):
+        for word in self._records.pop(key, ()):
+            self._words[word] -= 1
+            if self._words[word]:
+                continue
+            del self._words[word]
+            for trigram in trigrams(word):
+                self._postings[trigram].discard(word)
+                if not self._postings[trigram]:
+                    del self._postings[trigram]
+
+    def correct(self, word):
+        """
+        Find the indexed word closest to a misspelled one
+
+        Args:
+            word: Lower-case word
+
+        Returns:
+            str: The closest word within max_edits(word) edits (fewest edits,
+                then most shared trigrams, then most used), or None
+        """
+        word_trigrams = trigrams(word)
+        with self._lock:
+            shared = Counter()
+            for trigram in word_trigrams:
+                shared.update(self._postings.get(trigram, ()))
+
+            best = None
+            limit = max_edits(word)
+            for candidate, count in shared.items():
+                similarity = count / len(word_trigrams | trigrams(candidate))
+                if similarity < MIN_TRIGRAM_SIMILARITY:
+                    continue
+                distance = edit_distance(word, candidate, limit)
+                if distance > limit:
+                    continue
+                rank = (distance, -similarity, -self._words[candidate], candidate)
+                if best is None or rank < best[0]:
+                    best = (rank, candidate)
+        return None if best is None else best[1]
+
+    def clear(self):
+        """Remove every word"""
+        with self._lock:
+            self._postings.clear()
+            self._words.clear()
+            self._records.clear()
+
+# Process-wide database search backend, set by init_app
+backend = None
+
+# Configured backend that could not be installed yet, while searches scan the
+# tables instead, and when install_pending_backend next tries it
+_pending_backend = None
+_retry_at = 0
+backend_retry = DEFAULT_BACKEND_RETRY
+
+# Process-wide synonym table, loaded once (init_app reloads it from SEARCH_SYNONYMS_FILE)
+synonyms = SynonymTable.load(DEFAULT_SYNONYMS_FILE)
+
+# Process-wide search result cache
+query_cache = QueryCache()
+
+# Process-wide in-memory indexes and the app they load records from
+memory_index = InvertedIndex(query_cache)
+name_index = NameIndex()
+trigram_index = TrigramIndex()
+_app = None
+
+def init_app(app):
+    """
+    Load the in-memory index and make sure the database index is complete
+
+    Recognised settings:
+    - SEARCH_BACKEND: 'auto', 'fts5', 'postgres' or 'like'
+    - SEARCH_SYNONYMS_FILE: JSON file of synonym and abbreviation expansions
+    - SEARCH_CACHE_ENTRIES, SEARCH_CACHE_BYTES: Size limits of the search
+      result cache (0 entries disables it)
+    - SEARCH_BACKEND_RETRY: Seconds between attempts to install a backend
+      that could not be installed, e.g. before the model tables exist
+
+    Args:
+        app: Flask application
+    """
+    global backend, synonyms, backend_retry, _app, _pending_backend
+
+    _app = app
+    backend_retry = app.config.get('SEARCH_BACKEND_RETRY', DEFAULT_BACKEND_RETRY)
+    synonyms_file = app.config.get('SEARCH_SYNONYMS_FILE', DEFAULT_SYNONYMS_FILE)
+    try:
+        synonyms = SynonymTable.load(synonyms_file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load search synonyms from {synonyms_file}: {str(e)}")
+        synonyms = SynonymTable()
+    query_cache.clear()
+    query_cache.configure(
+        max_entries=app.config.get('SEARCH_CACHE_ENTRIES', DEFAULT_QUERY_CACHE_ENTRIES),
+        max_bytes=app.config.get('SEARCH_CACHE_BYTES', DEFAULT_QUERY_CACHE_BYTES)
+    )
+    with app.app_context():
+        try:
+            build_memory_index()
+        except Exception as e:
+            # The model tables may not exist yet; records are added as they are created
+            logger.warning(f"Could not build the in-memory search index: {str(e)}")
+
+        backend = LikeBackend(SEARCH_TYPES)
+        _pending_backend = create_search_backend(
+            app.config.get('SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND),
+            db.engine.dialect.name,
+            SEARCH_TYPES
+        )
+        install_pending_backend()
+
+def install_backend(connection):
+    """
+    Install the configured search backend and switch searches over to it
+
+    Args:
+        connection: SQLAlchemy connection to create the index structures through
+    """
+    global backend, _pending_backend
+
+    configured = _pending_backend or backend
+    configured.install(connection)
+    backend, _pending_backend = configured, None
+
+def install_pending_backend():
+    """
+    Install the configured search backend if it is not in use yet, and complete its index
+
+    Until the backend can be installed (e.g. the model tables do not exist
+    yet), searches scan the tables with LikeBackend and this is retried every
+    backend_retry seconds, so the index is picked up once it can be built (or
+    once `flask rebuild-search-index` has built it).
+
+    Returns:
+        bool: Whether the configured backend is in use
+    """
+    global _retry_at
+
+    if _pending_backend is None:
+        return True
+    _retry_at = time.time() + backend_retry
+    name = _pending_backend.name
+    try:
+        with db.engine.begin() as connection:
+            install_backend(connection)
+    except Exception as e:
+        logger.warning(f"Could not install the {name} search index, scanning tables instead: {str(e)}")
+        return False
+
+    try:
+        with db.engine.begin() as connection:
+            indexed = backend.count(connection)
+            if indexed is not None and indexed != count_records():
+                rebuild_index(connection)
+    except Exception as e:
+        # The model tables may not exist yet; records are indexed as they are created
+        logger.warning(f"Could not build the {name} search index: {str(e)}")
+    return True
+
+def count_records():
+    """Return the number of searchable records"""
+    return sum(model.query.count() for model, _ in SEARCH_TYPES.values())
+
+def rebuild_index(connection):
+    """
+    Re-index every searchable record
+
+    Args:
+        connection: SQLAlchemy connection to write the index through
+
+    Returns:
+        int: Number of records indexed
+    """
+    backend.clear(connection)
+    indexed = 0
+    for entity_type, (model, _) in SEARCH_TYPES.items():
+        for record in model.query.yield_per(500):
+            backend.upsert(connection, entity_type, record.id, document_fields(entity_type, record))
+            indexed += 1
+
+    logger.info(f"Indexed {indexed} records for search")
+    return indexed
+
+def column_text(value):
+    """Get the indexable text of a column value, flattening JSON lists"""
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith('['):
+        items = safe_json_loads(value, None)
+        if isinstance(items, list):
+            return ' '.join(str(item) for item in items)
+    return str(value)
+
+def document_fields(entity_type, record):
+    """
+    Build the index fields of a record
+
+    Args:
+        entity_type: Entity type name
+        record: Model instance
+
+    Returns:
+        dict: Index field -> text
+    """
+    _, fields = SEARCH_TYPES[entity_type]
+    return {
+        field: ' '.join(column_text(getattr(record, column)) for column in fields[field])
+        for field in SEARCH_FIELDS
+    }
+
+def parse_query(terms):
+    """Parse query words into clauses with the process-wide synonym table (see SynonymTable.parse)"""
+    return synonyms.parse(terms)
+
+def canonical_clauses(terms):
+    """
+    Parse query words into their canonical clauses
+
+    Every clause must match whatever its position, so sorting the clauses and
+    dropping repeats leaves the matches unchanged; queries differing only in
+    case, punctuation, spacing or word order get the same clauses. Words are
+    not stemmed, as the in-memory index matches words and prefixes as typed.
+
+    Args:
+        terms: Lower-case query words
+
+    Returns:
+        tuple: Sorted distinct clauses (see SynonymTable.parse)
+    """
+    return tuple(sorted(set(parse_query(terms))))
+
+def search(query, types=None):
+    """
+    Find the records matching a query
+
+    Args:
+        query: Search text; every word must match a word or word prefix, or
+            one of its synonym expansions
+        types: Entity types to search (default: all)
+
+    Returns:
+        dict: Entity type -> list of (id, score), best match first, or None if
+            the query is blank (every record matches)
+    """
+    if not query.strip():
+        return None
+
+    types = list(SEARCH_TYPES if types is None else types)
+    terms = tokenize(query)
+    if not terms:
+        return {entity_type: [] for entity_type in types}
+    clauses = canonical_clauses(terms)
+
+    if _pending_backend is not None and time.time() >= _retry_at:
+        install_pending_backend()
+
+    # Changes this session has flushed but not committed are only visible to it
+    if db.session.info.get('search_index_changed'):
+        return backend.search(db.session.connection(), clauses, types)
+
+    # The in-memory index is reloaded after every committed change, so its
+    # version is the version of the data
+    key = ('backend', backend.name, clauses, tuple(sorted(types)))
+    hit, hits = query_cache.get(key, memory_index.version)
+    if not hit:
+        hits = backend.search(db.session.connection(), clauses, types)
+        query_cache.set(key, memory_index.version, hits, sum(len(type_hits) for type_hits in hits.values()))
+    return hits
+
+def correct_query(query):
+    """
+    Correct the misspelled words of a query that found nothing
+
+    Words that match an indexed word, or the start of one, are kept; others are
+    replaced by the closest word in a condition or medication name.
+
+    Args:
+        query: Search text
+
+    Returns:
+        str: The corrected query, or None if no word was corrected
+    """
+    terms = tokenize(query)
+    corrected = [term if memory_index.expand(term) else trigram_index.correct(term) or term for term in terms]
+    return ' '.join(corrected) if corrected != terms else None
+
+def ranked_records(base_query, entity_type, hits, limit=None, offset=0):
+    """
+    Load the records of a search hit list that pass the filters of a query
+
+    Args:
+        base_query: Query over the entity's model, with any filters applied
+        entity_type: Entity type name
+        hits: List of (id, score) from search, or None for all records in ID order
+        limit: Maximum number of records (None for no limit)
+        offset: Number of matching records to skip
+
+    Returns:
+        list: Model instances, best match first
+    """
+    model, _ = SEARCH_TYPES[entity_type]
+    if hits is None:
+        query = base_query.order_by(model.id).offset(offset)
+        return (query if limit is None else query.limit(limit)).all()
+
+    ranks = {entity_id: rank for rank, (entity_id, _) in enumerate(hits)}
+    allowed = [entity_id for (entity_id,) in base_query.with_entities(model.id).filter(model.id.in_(list(ranks)))]
+    page = sorted(allowed, key=ranks.get)[offset:None if limit is None else offset + limit]
+
+    records = {record.id: record for record in base_query.filter(model.id.in_(page))}
+    return [records[entity_id] for entity_id in page if entity_id in records]
+
+def result_payload(entity_type, record):
+    """
+    Build the api.search representation of a record
+
+    Args:
+        entity_type: Entity type name
+        record: Model instance
+
+    Returns:
+        dict: Column values, plus the specialty name for types that have one
+    """
+    payload = {column: getattr(record, column) for column in RESULT_COLUMNS[entity_type]}
+    specialties = record_specialties(entity_type, record)
+    if specialties is not None:
+        payload['specialty'] = specialties[0] if specialties else None
+    return payload
+
+def record_texts(entity_type, record):
+    """Get the snippet texts of a record: its SNIPPET_COLUMNS, with JSON lists joined by semicolons"""
+    texts = {}
+    for column in SNIPPET_COLUMNS[entity_type]:
+        value = getattr(record, column)
+        items = safe_json_loads(value, None) if isinstance(value, str) and value.startswith('[') else None
+        texts[column] = '; '.join(str(item) for item in items) if isinstance(items, list) else str(value or '')
+    return texts
+
+def record_specialties(entity_type, record):
+    """Get the names of a record's specialties (None if its type has no specialty)"""
+    if entity_type == 'medication':
+        return [specialty.name for specialty in record.specialties]
+    if entity_type in ('condition', 'guideline'):
+        return [record.specialty.name] if record.specialty else []
+    return None
+
+def record_labels(entity_type, record):
+    """Get the (kind, name) autocomplete labels of a record"""
+    if entity_type == 'reference':
+        return []
+    labels = [(entity_type, record.title if entity_type == 'guideline' else record.name)]
+    if entity_type == 'medication':
+        labels.append(('medication_class', record.class_name))
+    return labels
+
+def record_facets(entity_type, record):
+    """
+    Get the facet values of a record
+
+    Specialties count under their own name, and records of other types under
+    their specialties; medications also count under their class and guidelines
+    under their organization.
+
+    Args:
+        entity_type: Entity type name
+        record: Model instance
+
+    Returns:
+        dict: Facet name -> list of values
+    """
+    facets = {'specialty': [record.name] if entity_type == 'specialty' else
+              record_specialties(entity_type, record) or []}
+    if entity_type == 'medication':
+        facets['medication_class'] = [record.class_name]
+    if entity_type == 'guideline':
+        facets['organization'] = [record.organization]
+    return facets
+
+def add_to_memory_index(entity_type, record):
+    """Index a loaded record in the in-memory indexes"""
+    memory_index.add(
+        entity_type, record.id, document_fields(entity_type, record),
+        result_payload(entity_type, record), record_specialties(entity_type, record),
+        record_facets(entity_type, record), record_texts(entity_type, record)
+    )
+    name_index.add(entity_type, record.id, record_labels(entity_type, record))
+    if entity_type in FUZZY_TYPES:
+        trigram_index.add(entity_type, record.id, record.name)
+
+def build_memory_index():
+    """
+    Load every searchable record into the in-memory indexes
+
+    Returns:
+        int: Number of records indexed
+    """
+    started = time.time()
+    memory_index.clear()
+    name_index.clear()
+    trigram_index.clear()
+    for entity_type, (model, _) in SEARCH_TYPES.items():
+        for record in model.query.yield_per(500):
+            add_to_memory_index(entity_type, record)
+
+    logger.info(f"Loaded {len(memory_index)} records into the in-memory search index in {time.time() - started:.2f}s")
+    return len(memory_index)
+
+def refresh_memory_index(tags):
+    """
+    Reload the records named by invalidated cache tags into the in-memory indexes
+
+    The model events in models.py invalidate a tag like 'condition:42' whenever
+    a record changes, in this worker after commit and in every other worker
+    through the invalidation journal. Records that no longer exist are removed.
+    Changing a specialty also reloads the records that show its name.
+
+    Args:
+        tags: Invalidated tag strings
+    """
+    records = set()
+    for tag in tags:
+        entity_type, _, entity_id = tag.partition(':')
+        if entity_type in SEARCH_TYPES and entity_id.isdigit():
+            records.add((entity_type, int(entity_id)))
+    if not records or _app is None:
+        return
+
+    # Use a session of our own: this may run inside another session's after_commit
+    with _app.app_context(), Session(db.engine) as session:
+        for entity_type, entity_id in records:
+            record = session.get(SEARCH_TYPES[entity_type][0], entity_id)
+            if record is None:
+                memory_index.remove(entity_type, entity_id)
+                name_index.remove(entity_type, entity_id)
+                trigram_index.remove(entity_type, entity_id)
+                continue
+
+            add_to_memory_index(entity_type, record)
+            if entity_type == 'specialty':
+                for dependent_type in ('condition', 'medication', 'guideline'):
+                    for dependent in getattr(record, f"{dependent_type}s"):
+                        add_to_memory_index(dependent_type, dependent)
+
+def mark_index_changed(record):
+    """Note that a record's session has index changes other sessions cannot see yet"""
+    session = object_session(record)
+    if session is not None:
+        session.info['search_index_changed'] = True
+
+def index_record(mapper, connection, record):
+    """Re-index a searchable record after it is inserted or updated"""
+    if backend is not None:
+        entity_type = MODEL_TYPES[mapper.class_]
+        backend.upsert(connection, entity_type, record.id, document_fields(entity_type, record))
+        mark_index_changed(record)
+
+def unindex_record(mapper, connection, record):
+    """Remove a searchable record from the index after it is deleted"""
+    if backend is not None:
+        backend.delete(connection, MODEL_TYPES[mapper.class_], record.id)
+        mark_index_changed(record)
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def forget_index_changes(session):
+    """Cache searches again once a session's index changes are committed or rolled back"""
+    session.info.pop('search_index_changed', None)
+
+for model in MODEL_TYPES:
+    event.listen(model, 'after_insert', index_record)
+    event.listen(model, 'after_update', index_record)
+    event.listen(model, 'after_delete', unindex_record)
+
+cache.add_invalidation_listener(refresh_memory_index)
@@ -0,0 +1,277 @@
+"""
+Search backends for the medical reference app
+
+This module provides the full-text indexes search.py answers searches from. An
+index holds one document per searchable record, with the record's text grouped
+into a name, a keywords and a body field. Backends write through the SQLAlchemy
+connection they are given, so index updates made from model events commit or
+roll back together with the change that caused them.
+
+Available backends:
+- fts5: An FTS5 virtual table in the application's SQLite database
+- postgres: Generated tsvector columns with GIN indexes on a PostgreSQL database
+- like: No index; scans the model tables with ILIKE (any database)
+"""
+from collections import namedtuple
+from sqlalchemy import and_, or_, text
+
+# Index fields, in the order they are stored
+SEARCH_FIELDS = ('name', 'keywords', 'body')
+
+# Relative weight of a match in each index field
+FIELD_WEIGHTS = {'name': 10.0, 'keywords': 4.0, 'body': 1.0}
+
+# Lower-case query word; prefix terms also match longer words starting with it
+QueryTerm = namedtuple('QueryTerm', 'text prefix')
+
+class SearchBackend:
+    """
+    Base class for search backends
+
+    Backends are created with the searchable entity types: a mapping of type
+    name to (model, {field: column names}). Searches take the query already
+    parsed into clauses and return, for each requested type, the matching
+    record IDs with a relevance score, best match first.
+
+    A clause is a tuple of alternatives and an alternative a tuple of QueryTerm.
+    A record matches when, for every clause, it matches every term of at least
+    one alternative (a word typed, or its synonym expansions).
+    """
+
+    name = None
+
+    def __init__(self, search_types):
+        self.search_types = search_types
+
+    def install(self, connection):
+        """Create the index structures if they do not exist"""
+
+    def count(self, connection):
+        """Return the number of indexed documents (None if the backend keeps no index)"""
+        return None
+
+    def upsert(self, connection, entity_type, entity_id, fields):
+        """Index (or re-index) a record from its field texts"""
+
+    def delete(self, connection, entity_type, entity_id):
+        """Remove a record from the index"""
+
+    def clear(self, connection):
+        """Remove every document"""
+
+    def search(self, connection, clauses, types):
+        """
+        Find the records matching every clause
+
+        Args:
+            connection: SQLAlchemy connection
+            clauses: Non-empty list of query clauses
+            types: Entity types to search
+
+        Returns:
+            dict: Entity type -> list of (id, score), best match first
+        """
+        raise NotImplementedError
+
+class FTS5Backend(SearchBackend):
+    """
+    Index stored in an SQLite FTS5 virtual table
+
+    The rowid of a document encodes its entity type and record ID, so updates
+    and deletes are rowid lookups rather than scans. Documents are ranked with
+    FTS5's bm25() using FIELD_WEIGHTS.
+    """
+
+    name = 'fts5'
+    table = 'search_index'
+
+    def __init__(self, search_types):
+        super().__init__(search_types)
+        self._type_codes = {entity_type: code for code, entity_type in enumerate(search_types)}
+        self._types = list(search_types)
+
+    def _rowid(self, entity_type, entity_id):
+        return entity_id * len(self._types) + self._type_codes[entity_type]
+
+    def install(self, connection):
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            f"USING fts5({', '.join(SEARCH_FIELDS)}, tokenize='porter unicode61 remove_diacritics 2')"
+        ))
+
+    def count(self, connection):
+        return connection.execute(text(f"SELECT COUNT(*) FROM {self.table}")).scalar()
+
+    def upsert(self, connection, entity_type, entity_id, fields):
+        rowid = self._rowid(entity_type, entity_id)
+        connection.execute(text(f"DELETE FROM {self.table} WHERE rowid = :rowid"), {'rowid': rowid})
+        connection.execute(
+            text(f"INSERT INTO {self.table} (rowid, {', '.join(SEARCH_FIELDS)}) "
+                 f"VALUES (:rowid, {', '.join(':' + field for field in SEARCH_FIELDS)})"),
+            dict(fields, rowid=rowid)
+        )
+
+    def delete(self, connection, entity_type, entity_id):
+        connection.execute(
+            text(f"DELETE FROM {self.table} WHERE rowid = :rowid"),
+            {'rowid': self._rowid(entity_type, entity_id)}
+        )
+
+    def clear(self, connection):
+        connection.execute(text(f"DELETE FROM {self.table}"))
+
+    def search(self, connection, clauses, types):
+        # Terms are \w+ tokens, so quoting them is enough to keep FTS5 syntax out
+        match = ' AND '.join(
+            '(' + ' OR '.join(
+                '(' + ' AND '.join(f'"{term.text}"' + '*' * term.prefix for term in alternative) + ')'
+                for alternative in clause
+            ) + ')'
+            for clause in clauses
+        )
+        weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in SEARCH_FIELDS)
+        rows = connection.execute(
+            text(f"SELECT rowid, bm25({self.table}, {weights}) AS rank FROM {self.table} "
+                 f"WHERE {self.table} MATCH :match ORDER BY rank"),
+            {'match': match}
+        )
+
+        results = {entity_type: [] for entity_type in types}
+        for rowid, rank in rows:
+            entity_type = self._types[rowid % len(self._types)]
+            if entity_type in results:
+                # bm25() is lower for better matches
+                results[entity_type].append((rowid // len(self._types), -rank))
+        return results
+
+class PostgresBackend(SearchBackend):
+    """
+    Index kept by PostgreSQL in a generated tsvector column on each model table
+
+    The column concatenates the record's fields with weights A (name), B
+    (keywords) and D (body) and is maintained by the database itself, so upserts
+    and deletes are no-ops. A GIN index on the column answers matches, and
+    results are ranked with ts_rank using FIELD_WEIGHTS. Requires PostgreSQL 12
+    or later.
+    """
+
+    name = 'postgres'
+    column = 'search_vector'
+    config = 'english'
+
+    # Index field -> tsvector weight label
+    FIELD_LABELS = {'name': 'A', 'keywords': 'B', 'body': 'D'}
+
+    def _vector(self, fields):
+        parts = []
+        for field in SEARCH_FIELDS:
+            if not fields[field]:
+                continue
+            document = " || ' ' || ".join(f"coalesce(\"{column}\", '')" for column in fields[field])
+            parts.append(f"setweight(to_tsvector('{self.config}', {document}), '{self.FIELD_LABELS[field]}')")
+        return ' || '.join(parts)
+
+    def _rank_weights(self):
+        # ts_rank takes the weights of labels {D, C, B, A}, each at most 1
+        top = max(FIELD_WEIGHTS.values())
+        labels = {label: FIELD_WEIGHTS[field] / top for field, label in self.FIELD_LABELS.items()}
+        return '{' + ', '.join(str(labels.get(label, 0)) for label in 'DCBA') + '}'
+
+    def install(self, connection):
+        for model, fields in self.search_types.values():
+            table = model.__table__.name
+            connection.execute(text(
+                f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS {self.column} tsvector '
+                f"GENERATED ALWAYS AS ({self._vector(fields)}) STORED"
+            ))
+            connection.execute(text(
+                f'CREATE INDEX IF NOT EXISTS ix_{table}_{self.column} ON "{table}" USING GIN ({self.column})'
+            ))
+
+    def search(self, connection, clauses, types):
+        # Terms are \w+ tokens, so quoting them is enough to keep tsquery syntax out
+        query = ' & '.join(
+            '(' + ' | '.join(
+                '(' + ' & '.join(f"'{term.text}'" + ':*' * term.prefix for term in alternative) + ')'
+                for alternative in clause
+            ) + ')'
+            for clause in clauses
+        )
+        results = {}
+        for entity_type in types:
+            model, _ = self.search_types[entity_type]
+            rows = connection.execute(
+                text(f"SELECT id, ts_rank(CAST('{self._rank_weights()}' AS real[]), {self.column}, q) AS rank "
+                     f'FROM "{model.__table__.name}", to_tsquery(\'{self.config}\', :query) AS q '
+                     f"WHERE {self.column} @@ q ORDER BY rank DESC, id"),
+                {'query': query}
+            )
+            results[entity_type] = [(entity_id, rank) for entity_id, rank in rows]
+        return results
+
+class LikeBackend(SearchBackend):
+    """
+    Scans the model tables with ILIKE on every search
+
+    Works on any database and needs no index, so it is the fallback when no
+    full-text engine is available. Scores count the fields a record matches in,
+    weighted by FIELD_WEIGHTS.
+    """
+
+    name = 'like'
+
+    def search(self, connection, clauses, types):
+        results = {}
+        for entity_type in types:
+            model, fields = self.search_types[entity_type]
+            columns = [getattr(model, column) for field_columns in fields.values() for column in field_columns]
+
+            # Exact terms are matched as substrings too; there are no word boundaries to test
+            query = model.query.filter(*[
+                or_(*[
+                    and_(*[or_(*[column.ilike(f"%{term.text}%") for column in columns]) for term in alternative])
+                    for alternative in clause
+                ])
+                for clause in clauses
+            ])
+
+            scored = []
+            for record in query:
+                score = 0.0
+                for field, field_columns in fields.items():
+                    values = ' '.join(str(getattr(record, column) or '') for column in field_columns).lower()
+                    score += FIELD_WEIGHTS[field] * sum(
+                        max(sum(term.text in values for term in alternative) for alternative in clause)
+                        for clause in clauses
+                    )
+                scored.append((record.id, score))
+            results[entity_type] = sorted(scored, key=lambda hit: (-hit[1], hit[0]))
+        return results
+
+def create_search_backend(name, dialect, search_types):
+    """
+    Create a search backend by name
+
+    Args:
+        name: 'fts5', 'postgres', 'like' or 'auto' to pick the best backend for the
+            database (postgres on PostgreSQL, fts5 on SQLite, otherwise like)
+        dialect: SQLAlchemy dialect name of the application database
+        search_types: Searchable entity types (see SearchBackend)
+
+    Returns:
+        SearchBackend: The backend
+    """
+    if name == 'auto':
+        name = {'postgresql': 'postgres', 'sqlite': 'fts5'}.get(dialect, 'like')
+
+    if name == 'fts5':
+        if dialect != 'sqlite':
+            raise ValueError('The fts5 search backend requires an SQLite database')
+        return FTS5Backend(search_types)
+    if name == 'postgres':
+        if dialect != 'postgresql':
+            raise ValueError('The postgres search backend requires a PostgreSQL database')
+        return PostgresBackend(search_types)
+    if name == 'like':
+        return LikeBackend(search_types)
+    raise ValueError(f"Unknown search backend: {name}")
@@ -19,6 +19,44 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Autocomplete suggestions while typing
+    const searchSuggestions = document.getElementById('searchSuggestions');
+    let suggestTimer = null;
+    
+    if (searchInput && searchSuggestions) {
+        searchInput.addEventListener('input', function() {
+            clearTimeout(suggestTimer);
+            const query = searchInput.value;
+            
+            if (query.trim().length === 0) {
+                searchSuggestions.innerHTML = '';
+                return;
+            }
+            
+            suggestTimer = setTimeout(() => fetchSuggestions(query), 100);
+        });
+    }
+    
+    function fetchSuggestions(query) {
+        fetch(`/api/api/autocomplete?q=${encodeURIComponent(query)}`)
+            .then(response => response.json())
+            .then(data => {
+                // Ignore answers to text that has since changed
+                if (data.query !== searchInput.value) {
+                    return;
+                }
+                searchSuggestions.innerHTML = '';
+                data.suggestions.forEach(suggestion => {
+                    const option = document.createElement('option');
+                    option.value = suggestion.label;
+                    searchSuggestions.appendChild(option);
+                });
+            })
+            .catch(error => {
+                console.error('Error fetching suggestions:', error);
+            });
+    }
+    
     if (closeSearchResults) {
         closeSearchResults.addEventListener('click', function() {
             searchResults.style.display = 'none';
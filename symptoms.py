@@ -0,0 +1,251 @@
+"""
+Symptom matching module for the medical reference app
+
+This module keeps an in-process index of the symptoms of every condition and
+ranks conditions by how many of a patient's symptoms they share. Symptoms and
+specialties are stored as bitsets over condition rows (Python integers, one bit
+per condition), so matching a list of symptoms against every condition is a
+handful of whole-bitset operations rather than a loop over conditions.
+"""
+from collections import namedtuple
+from sqlalchemy.orm import Session
+import cache
+import logging
+import threading
+import time
+
+from models import db, Condition
+from utils import safe_json_loads
+
+# Default and maximum number of conditions returned by match()
+DEFAULT_MATCHES = 20
+MAX_MATCHES = 100
+
+logger = logging.getLogger(__name__)
+
+# Condition ranked by match()
+SymptomMatch = namedtuple('SymptomMatch', 'condition_id name specialty_id matched symptom_count matched_symptoms')
+
+def normalise_symptom(symptom):
+    """Lower-case a symptom name and collapse its whitespace"""
+    return ' '.join(str(symptom).lower().split())
+
+def bit_positions(bits):
+    """Yield the positions of the set bits of an integer, lowest first"""
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+class SymptomIndex:
+    """
+    Bitset index of condition symptoms
+
+    Every condition gets a row number, and every distinct symptom a bitset with
+    the bits of the rows of the conditions that list it; specialties have a
+    bitset of their conditions' rows too. match() adds the bitsets of the
+    queried symptoms into a bit-sliced counter, so after one pass per symptom
+    the counter holds the overlap of every condition at once. Only rows with a
+    non-zero overlap (that pass the specialty filter) are read back out.
+    """
+
+    def __init__(self):
+        self._symptom_rows = {}
+        self._symptom_names = {}
+        self._specialty_rows = {}
+        self._rows = {}
+        self._conditions = {}
+        self._free_rows = []
+        self._next_row = 0
+        self._lock = threading.RLock()
+
+    def add(self, condition_id, name, specialty_id, symptoms):
+        """
+        Index (or re-index) a condition
+
+        Args:
+            condition_id: Condition ID
+            name: Condition name
+            specialty_id: Specialty ID (or None)
+            symptoms: List of symptom names
+        """
+        normalised = {}
+        for symptom in symptoms:
+            key = normalise_symptom(symptom)
+            if key:
+                normalised.setdefault(key, str(symptom).strip())
+
+        with self._lock:
+            self._remove(condition_id)
+            row = self._free_rows.pop() if self._free_rows else self._next_row
+            self._next_row = max(self._next_row, row + 1)
+            bit = 1 << row
+
+            self._rows[row] = condition_id
+            self._conditions[condition_id] = (row, name, specialty_id, tuple(normalised))
+            for key, label in normalised.items():
+                self._symptom_rows[key] = self._symptom_rows.get(key, 0) | bit
+                self._symptom_names.setdefault(key, label)
+            self._specialty_rows[specialty_id] = self._specialty_rows.get(specialty_id, 0) | bit
+
+    def remove(self, condition_id):
+        """Remove a condition if it is indexed"""
+        with self._lock:
+            self._remove(condition_id)
+
+    def _remove(self, condition_id):
+        indexed = self._conditions.pop(condition_id, None)
+        if indexed is None:
+            return
+
+        row, _, specialty_id, symptoms = indexed
+        bit = 1 << row
+        for key in symptoms:
+            self._symptom_rows[key] &= ~bit
+            if not self._symptom_rows[key]:
+                del self._symptom_rows[key]
+                del self._symptom_names[key]
+        self._specialty_rows[specialty_id] &= ~bit
+        if not self._specialty_rows[specialty_id]:
+            del self._specialty_rows[specialty_id]
+        del self._rows[row]
+        self._free_rows.append(row)
+
+    def symptoms(self):
+        """Return the indexed symptom names, in alphabetical order"""
+        with self._lock:
+            return sorted(self._symptom_names.values(), key=str.lower)
+
+    def known(self, symptom):
+        """Return whether any indexed condition lists a symptom"""
+        return normalise_symptom(symptom) in self._symptom_rows
+
+    def match(self, symptoms, specialty_id=None, limit=DEFAULT_MATCHES):
+        """
+        Rank the conditions sharing any of a list of symptoms
+
+        Args:
+            symptoms: Symptom names (case and spacing are ignored)
+            specialty_id: Only rank conditions of this specialty
+            limit: Maximum number of conditions
+
+        Returns:
+            tuple: (number of matching conditions, list of SymptomMatch), most
+                symptoms matched first, then the conditions whose own symptoms
+                are best covered, then by name
+        """
+        keys = list(dict.fromkeys(normalise_symptom(symptom) for symptom in symptoms))
+
+        with self._lock:
+            # Bit-sliced counter: bit r of planes[k] is bit k of row r's overlap
+            planes = []
+            candidates = 0
+            for key in keys:
+                carry = self._symptom_rows.get(key, 0)
+                candidates |= carry
+                for position, plane in enumerate(planes):
+                    if not carry:
+                        break
+                    planes[position], carry = plane ^ carry, plane & carry
+                if carry:
+                    planes.append(carry)
+
+            if specialty_id is not None:
+                candidates &= self._specialty_rows.get(specialty_id, 0)
+
+            matches = []
+            for row in bit_positions(candidates):
+                matched = sum(((plane >> row) & 1) << position for position, plane in enumerate(planes))
+                condition_id = self._rows[row]
+                _, name, condition_specialty_id, condition_symptoms = self._conditions[condition_id]
+                matches.append(SymptomMatch(
+                    condition_id, name, condition_specialty_id, matched, len(condition_symptoms),
+                    [self._symptom_names[key] for key in keys if self._symptom_rows.get(key, 0) >> row & 1]
+                ))
+
+        matches.sort(key=lambda match: (-match.matched, -match.matched / match.symptom_count, match.name))
+        return len(matches), matches[:limit]
+
+    def clear(self):
+        """Remove every condition"""
+        with self._lock:
+            self._symptom_rows.clear()
+            self._symptom_names.clear()
+            self._specialty_rows.clear()
+            self._rows.clear()
+            self._conditions.clear()
+            self._free_rows = []
+            self._next_row = 0
+
+    def __len__(self):
+        return len(self._conditions)
+
+# Process-wide symptom index and the app it loads conditions from
+symptom_index = SymptomIndex()
+_app = None
+
+def init_app(app):
+    """
+    Load the symptom index
+
+    Args:
+        app: Flask application
+    """
+    global _app
+
+    _app = app
+    with app.app_context():
+        try:
+            build_symptom_index()
+        except Exception as e:
+            # The condition table may not exist yet; conditions are added as they are created
+            logger.warning(f"Could not build the symptom index: {str(e)}")
+
+def add_to_symptom_index(condition):
+    """Index a loaded condition"""
+    symptoms = safe_json_loads(condition.symptoms, [])
+    symptom_index.add(
+        condition.id, condition.name, condition.specialty_id,
+        symptoms if isinstance(symptoms, list) else []
+    )
+
+def build_symptom_index():
+    """
+    Load every condition into the symptom index
+
+    Returns:
+        int: Number of conditions indexed
+    """
+    started = time.time()
+    symptom_index.clear()
+    for condition in Condition.query.yield_per(500):
+        add_to_symptom_index(condition)
+
+    logger.info(f"Loaded {len(symptom_index)} conditions into the symptom index in {time.time() - started:.2f}s")
+    return len(symptom_index)
+
+def refresh_symptom_index(tags):
+    """
+    Reload the conditions named by invalidated 'condition:<id>' cache tags
+
+    Args:
+        tags: Invalidated tag strings
+    """
+    condition_ids = set()
+    for tag in tags:
+        entity_type, _, entity_id = tag.partition(':')
+        if entity_type == 'condition' and entity_id.isdigit():
+            condition_ids.add(int(entity_id))
+    if not condition_ids or _app is None:
+        return
+
+    # Use a session of our own: this may run inside another session's after_commit
+    with _app.app_context(), Session(db.engine) as session:
+        for condition_id in condition_ids:
+            condition = session.get(Condition, condition_id)
+            if condition is None:
+                symptom_index.remove(condition_id)
+            else:
+                add_to_symptom_index(condition)
+
+cache.add_invalidation_listener(refresh_symptom_index)
@@ -0,0 +1,972 @@
+"""
+Test script for the caching module
+"""
+import os
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask, request
+from flask_login import LoginManager
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+
+import cache
+import gunicorn_config
+from cache import (
+    CacheWarmer, ExpiryIndex, MemoryCache, add_cache_tags, cache_response, cache_result,
+    collection_validator, conditional_response, expiry_scheduler, invalidate_tags,
+    record_validator, tag_index
+)
+from cache_backends import (
+    ENTRY_HEADER, ENTRY_SUFFIX, FileBackend, MemoryBackend, RedisBackend, RedisError, SQLiteBackend,
+    decode_entry, decode_entry_header, encode_entry
+)
+
+def cache_files(cache_dir):
+    """List the entry files in a cache directory"""
+    return [file for file in os.listdir(cache_dir) if file.endswith(ENTRY_SUFFIX)]
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Point the file backend at a temporary directory with an empty memory tier, restoring both afterwards"""
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(cache, 'backend', FileBackend(str(tmp_path)))
+    cache.memory_cache.clear()
+    cache.tag_index.clear()
+    yield str(tmp_path)
+    cache.memory_cache.clear()
+    cache.tag_index.clear()
+
+def test_sweeps_forget_tags_of_expired_entries(cache_dir):
+    """Test that expired entries leave neither the memory nor the backend tag index"""
+    now = time.time()
+    for i in range(300):
+        cache.set_cached(f"search:{i}", i, expiration=1, tags=['conditions', 'medications', f"query:{i}"])
+    cache.set_cached('kept', 'kept', expiration=3600, tags=['conditions'])
+
+    cache.ExpiryScheduler(reconcile_interval=1).run_once(now + 10)
+    assert tag_index._keys == {'conditions': {'kept'}}
+    tags_dir = os.path.join(cache_dir, 'tags')
+    assert [open(os.path.join(tags_dir, name)).read() for name in os.listdir(tags_dir)] == ['kept\n']
+    assert cache.invalidate_tags('conditions') == 1
+
+def test_file_locks_are_per_key(cache_dir):
+    """Test that only callers of the same key wait, and that unused lock files are removed"""
+    keys = [f"page:{i}" for i in range(200)]
+    held = [cache.FileLock(key) for key in keys]
+    assert all(lock.acquire() for lock in held)
+    assert not cache.FileLock(keys[0]).acquire()
+
+    # Held locks are kept; released ones go once unused for long enough
+    for lock in held[1:]:
+        lock.release()
+    assert cache.FileLock.remove_unused(time.time()) == 0
+    assert cache.FileLock.remove_unused(time.time() + 2 * cache.LOCK_FILE_MAX_AGE) == len(keys) - 1
+    assert not cache.FileLock(keys[0]).acquire()
+    held[0].release()
+
+    lock = cache.FileLock(keys[1])
+    assert lock.acquire()
+    assert not cache.FileLock(keys[1]).acquire()
+    lock.release()
+
+def test_memory_cache_lru_eviction():
+    """Test that the memory tier evicts the least recently used entry"""
+    memory = MemoryCache(capacity=2, ttl=60)
+    memory.set('a', 1)
+    memory.set('b', 2)
+
+    # Touch 'a' so that 'b' becomes the eviction candidate
+    assert memory.get('a') == (True, 1)
+    memory.set('c', 3)
+
+    assert memory.get('b') == (False, None)
+    assert memory.get('a') == (True, 1)
+    assert memory.get('c') == (True, 3)
+    assert len(memory) == 2
+
+def test_memory_cache_expiry():
+    """Test that memory entries honour both the cache expiration and the memory TTL"""
+    memory = MemoryCache(capacity=10, ttl=60)
+    memory.set('old', 'value', timestamp=time.time() - 120)
+    assert memory.get('old', expiration=60) == (False, None)
+
+    memory = MemoryCache(capacity=10, ttl=0)
+    memory.set('key', 'value')
+    assert memory.get('key') == (False, None)
+
+def test_cache_result_serves_hits_from_memory(cache_dir):
+    """Test that a memory hit does not touch the file tier"""
+    calls = []
+
+    @cache_result(expiration=60)
+    def render(item_id):
+        calls.append(item_id)
+        return f"page {item_id}"
+
+    assert render(1) == "page 1"
+
+    # Remove the file tier; the memory tier must still answer
+    for file in cache_files(cache_dir):
+        os.remove(os.path.join(cache_dir, file))
+
+    assert render(1) == "page 1"
+    assert calls == [1]
+
+def test_expiry_index_skips_superseded_entries():
+    """Test that rewriting a key moves its expiry time"""
+    index = ExpiryIndex()
+    index.add('a', 10)
+    index.add('b', 20)
+    index.add('a', 30)
+
+    assert index.pop_expired(now=25) == ['b']
+    assert index.pop_expired(now=35) == ['a']
+    assert len(index) == 0
+
+def test_expiry_sweep_removes_only_expired_files(cache_dir):
+    """Test that the background sweep removes expired entries without parsing files"""
+
+    @cache_result(expiration=60)
+    def render(item_id):
+        return f"page {item_id}"
+
+    render(1)
+    assert len(cache_files(cache_dir)) == 1
+
+    # Nothing is due yet
+    assert expiry_scheduler.run_once(now=time.time()) == 0
+    assert len(cache_files(cache_dir)) == 1
+
+    # Past the expiry time the file and the memory entry are dropped
+    assert expiry_scheduler.run_once(now=time.time() + 120) == 1
+    assert cache_files(cache_dir) == []
+    assert len(cache.memory_cache) == 0
+
+def create_test_app():
+    """Create a minimal Flask app with a response-cached search view"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+    app.calls = []
+
+    @app.route('/search')
+    @cache_response(expiration=60)
+    def search():
+        app.calls.append(request.args.get('q'))
+        return f"results for {request.args.get('q')}", 200, {'X-Custom': 'yes'}
+
+    @app.route('/missing')
+    @cache_response(expiration=60)
+    def missing():
+        app.calls.append('missing')
+        return 'not found', 404
+
+    return app
+
+def test_cache_response_keys_on_query_string(cache_dir):
+    """Test that different query strings get different cached responses"""
+    app = create_test_app()
+    client = app.test_client()
+
+    first = client.get('/search?q=asthma&category=all')
+    assert first.headers['X-Cache'] == 'MISS'
+    assert client.get('/search?q=gout').data == b"results for gout"
+
+    # Parameter order does not change the key
+    second = client.get('/search?category=all&q=asthma')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.data == b"results for asthma"
+    assert second.headers['X-Custom'] == 'yes'
+    assert app.calls == ['asthma', 'gout']
+
+def test_cache_response_skips_errors(cache_dir):
+    """Test that non-200 responses are not cached"""
+    app = create_test_app()
+    client = app.test_client()
+
+    assert client.get('/missing').status_code == 404
+    assert client.get('/missing').status_code == 404
+    assert app.calls == ['missing', 'missing']
+
+def test_invalidate_tags_drops_dependent_entries(cache_dir):
+    """Test that invalidating a tag removes only the entries that depend on it"""
+    calls = []
+
+    @cache_result(expiration=60, tags=['condition:1'])
+    def condition_page():
+        calls.append('condition')
+        return 'condition'
+
+    @cache_result(expiration=60, tags=['medication:2'])
+    def medication_page():
+        calls.append('medication')
+        return 'medication'
+
+    condition_page()
+    medication_page()
+    assert invalidate_tags('condition:1') == 1
+
+    condition_page()
+    medication_page()
+    assert calls == ['condition', 'medication', 'condition']
+    assert cache.backend.poll_invalidations(None)[1] == ['condition:1']
+
+def test_results_invalidated_while_computing_are_not_cached(cache_dir):
+    """Test that a result computed from data that changed meanwhile is not cached"""
+    versions = ['old', 'new']
+
+    @cache_result(expiration=60, tags=['condition:1'])
+    def condition_page():
+        # Read the data, then another request changes it and invalidates the tag
+        page = versions[0]
+        if page == 'old':
+            versions.pop(0)
+            invalidate_tags('condition:1')
+        return page
+
+    assert condition_page() == 'old'
+    assert condition_page() == 'new'
+    assert condition_page() == 'new'
+
+    # Entries whose tags were not invalidated are kept
+    cursor = cache.backend.journal_cursor()
+    invalidate_tags('medication:2')
+    assert cache.set_cached('page', 'cached', tags=['condition:1'], journal_cursor=cursor)
+    assert cache.get_cached('page') == (True, 'cached')
+    assert not cache.set_cached('page', 'cached', tags=['medication:2'], journal_cursor=cursor)
+    assert cache.get_cached('page') == (False, None)
+
+def test_invalidation_journal_reaches_other_workers(cache_dir):
+    """Test that journal entries drop memory-tier copies held by another process"""
+    cache.memory_cache.set('page', 'cached')
+    tag_index.add('page', ['specialty:3'], persist=False)
+
+    # Simulate another worker invalidating the tag
+    tag_index.publish(['specialty:3'])
+
+    assert tag_index.apply_journal() == 1
+    assert cache.memory_cache.get('page') == (False, None)
+
+def test_cache_response_collects_view_tags(cache_dir):
+    """Test that tags added while rendering are attached to the cached response"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+    calls = []
+
+    @app.route('/condition/<int:condition_id>')
+    @cache_response(expiration=60)
+    def condition_detail(condition_id):
+        calls.append(condition_id)
+        add_cache_tags(f"condition:{condition_id}")
+        return f"condition {condition_id}"
+
+    client = app.test_client()
+    client.get('/condition/42')
+    assert client.get('/condition/42').headers['X-Cache'] == 'HIT'
+
+    invalidate_tags('condition:42')
+    assert client.get('/condition/42').headers['X-Cache'] == 'MISS'
+    assert calls == [42, 42]
+
+def test_single_flight_computes_once(cache_dir):
+    """Test that concurrent misses for the same key run the function once"""
+    calls = []
+    results = []
+
+    @cache_result(expiration=60)
+    def slow_page():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'page'
+
+    threads = [threading.Thread(target=lambda: results.append(slow_page())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ['page'] * 5
+
+def test_single_flight_serves_stale_while_computing(cache_dir):
+    """Test that callers get the expired entry while another caller recomputes"""
+    started = threading.Event()
+    results = []
+
+    @cache_result(expiration=1)
+    def slow_page():
+        version = len(results)
+        if version:
+            started.set()
+            time.sleep(0.3)
+        return f"version {version}"
+
+    results.append(slow_page())
+    time.sleep(1.1)
+    cache.memory_cache.clear()
+
+    leader = threading.Thread(target=lambda: results.append(slow_page()))
+    leader.start()
+    started.wait()
+    results.append(slow_page())
+    leader.join()
+
+    assert results == ['version 0', 'version 0', 'version 1']
+
+def test_stale_while_revalidate_refreshes_in_background(cache_dir):
+    """Test that an expired entry is served immediately and refreshed in the background"""
+    calls = []
+
+    @cache_result(expiration=1, stale_while_revalidate=60)
+    def page():
+        calls.append(1)
+        return f"version {len(calls)}"
+
+    assert page() == 'version 1'
+    time.sleep(1.1)
+
+    # Served stale without waiting for the refresh
+    assert page() == 'version 1'
+    for _ in range(50):
+        if len(calls) == 2 and cache.get_cached(cache.get_cache_key('page'), 1)[0]:
+            break
+        time.sleep(0.05)
+
+    assert page() == 'version 2'
+    assert len(calls) == 2
+
+def test_cache_response_reports_expiry_windows(cache_dir):
+    """Test that responses carry the soft and hard expiry headers"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+
+    @app.route('/specialty')
+    @cache_response(expiration=60, stale_while_revalidate=3600)
+    def specialty():
+        return 'specialty'
+
+    response = app.test_client().get('/specialty')
+    soft = parsedate_to_datetime(response.headers['X-Cache-Soft-Expires'])
+    hard = parsedate_to_datetime(response.headers['X-Cache-Hard-Expires'])
+    assert (hard - soft).total_seconds() == 3600
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough of the Redis protocol for RedisBackend"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RedisError):
+            return f"-{value}\r\n".encode()
+        if isinstance(value, str):
+            return f"+{value}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b''.join(self.encode(item) for item in value)
+        return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+    COMMANDS = {
+        'GET', 'SET', 'DEL', 'EXISTS', 'EXPIRE', 'TTL', 'SREM', 'SADD', 'SMEMBERS', 'RPUSH', 'LRANGE', 'LLEN',
+        'LTRIM', 'INCRBY', 'SCAN'
+    }
+
+    def run(self, name, *args):
+        data = self.server.data
+        self.server.commands.append([name, *args])
+        if name == 'GET':
+            return data.get(args[0])
+        if name == 'SET':
+            data[args[0]] = args[1]
+            return 'OK'
+        if name == 'DEL':
+            for key in args:
+                self.server.ttls.pop(key, None)
+            return sum(data.pop(key, None) is not None for key in args)
+        if name == 'EXISTS':
+            return sum(key in data for key in args)
+        if name == 'EXPIRE':
+            ttl, current = int(args[1]), self.server.ttls.get(args[0])
+            if args[0] not in data or (b'NX' in args[2:] and current is not None) \
+                    or (b'GT' in args[2:] and (current is None or ttl <= current)):
+                return 0
+            self.server.ttls[args[0]] = ttl
+            return 1
+        if name == 'TTL':
+            return self.server.ttls.get(args[0], -1) if args[0] in data else -2
+        if name == 'SREM':
+            members = data.get(args[0], set())
+            removed = len(members & set(args[1:]))
+            members.difference_update(args[1:])
+            return removed
+        if name == 'SADD':
+            data.setdefault(args[0], set()).update(args[1:])
+            return len(args) - 1
+        if name == 'SMEMBERS':
+            return sorted(data.get(args[0], ()))
+        if name == 'RPUSH':
+            data.setdefault(args[0], []).extend(args[1:])
+            return len(data[args[0]])
+        if name == 'LRANGE':
+            items = data.get(args[0], [])
+            return items[int(args[1]):len(items) if args[2] == b'-1' else int(args[2]) + 1]
+        if name == 'LLEN':
+            return len(data.get(args[0], []))
+        if name == 'LTRIM':
+            data[args[0]] = data.get(args[0], [])[int(args[1]):]
+            return 'OK'
+        if name == 'INCRBY':
+            data[args[0]] = str(int(data.get(args[0], 0)) + int(args[1])).encode()
+            return int(data[args[0]])
+        if name == 'SCAN':
+            prefix = args[2].rstrip(b'*')
+            return [b'0', [key for key in data if key.startswith(prefix)]]
+        raise ValueError(name)
+
+    def handle(self):
+        self.server.connections.append(self.request)
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            name = args[0].decode().upper()
+            if name == 'MULTI':
+                queued, reply = [], 'OK'
+            elif name == 'EXEC':
+                if any(command is None for command in queued):
+                    reply = RedisError('EXECABORT Transaction discarded because of previous errors.')
+                else:
+                    with self.server.lock:
+                        reply = [self.run(*command) for command in queued]
+                queued = None
+            elif queued is not None:
+                # Like Redis, unknown commands are rejected when queued and abort the transaction
+                known = name in self.COMMANDS
+                queued.append([name] + args[1:] if known else None)
+                reply = 'QUEUED' if known else RedisError(f"ERR unknown command '{name}'")
+            else:
+                with self.server.lock:
+                    reply = self.run(name, *args[1:])
+            self.wfile.write(self.encode(reply))
+
+def start_fake_redis():
+    """Start a local Redis protocol stand-in and return its URL"""
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedisHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.commands = []
+    server.ttls = {}
+    server.connections = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{server.server_address[1]}/0", server
+
+def make_entry(result, expires_at, timestamp=None):
+    """Encode an entry the way set_cached does"""
+    timestamp = time.time() if timestamp is None else timestamp
+    return encode_entry({'timestamp': timestamp, 'tags': [], 'result': result}, expires_at)
+
+def check_backend(backend):
+    """Exercise the entry, tag and journal operations every backend must support"""
+    now = time.time()
+    data = make_entry({'page': 1}, now + 60, timestamp=now)
+
+    backend.set('fresh', data)
+    backend.set('expired', make_entry({'page': 1}, now + 1, timestamp=now))
+    assert backend.get('fresh') == data
+    assert backend.get('fresh', min_timestamp=now + 1) is None
+    assert backend.get('missing') is None
+
+    backend.add_tags('fresh', ['condition:1'])
+    backend.add_tags('expired', ['condition:1', 'specialty:2'])
+    assert backend.pop_tag('condition:1') == {'fresh', 'expired'}
+    assert backend.pop_tag('condition:1') == set()
+
+    # Purging drops the keys of entries no longer stored from the tag index
+    backend.set('old', make_entry({'page': 2}, now + 60, timestamp=now))
+    backend.add_tags('old', ['guideline:5'])
+    backend.add_tags('fresh', ['guideline:5', 'guideline:6'])
+    backend.delete('old')
+    backend.purge_expired(now)
+    assert backend.pop_tag('guideline:5') == {'fresh'}
+    assert backend.pop_tag('guideline:6') == {'fresh'}
+
+    backend.delete('fresh')
+    assert backend.get('fresh') is None
+
+    backend.set('fresh', data)
+    backend.clear()
+    assert backend.get('fresh') is None
+
+def check_backend_journal(backend):
+    """Exercise the invalidation journal, including compaction"""
+    now = time.time()
+    backend.publish_invalidations(['condition:1', 'medication:2'], now - 100)
+    cursor, tags = backend.poll_invalidations(None)
+    assert tags == ['condition:1', 'medication:2']
+
+    backend.publish_invalidations(['specialty:3'], now)
+    backend.compact_invalidations(now - 50)
+    cursor, tags = backend.poll_invalidations(cursor)
+    assert tags == ['specialty:3']
+    assert backend.poll_invalidations(cursor)[1] == []
+
+    # A cursor taken without reading the journal sees only later invalidations
+    cursor = backend.journal_cursor()
+    assert backend.poll_invalidations(cursor)[1] == []
+    backend.publish_invalidations(['reference:4'], now)
+    assert backend.poll_invalidations(cursor)[1] == ['reference:4']
+
+def test_memory_backend():
+    """Test the in-process backend"""
+    check_backend(MemoryBackend())
+    check_backend_journal(MemoryBackend())
+
+def test_file_backend(tmp_path):
+    """Test the file backend and its mtime-based expiry"""
+    backend = FileBackend(str(tmp_path))
+    check_backend(backend)
+    check_backend_journal(backend)
+
+    now = time.time()
+    backend.set('a', make_entry(1, now + 10))
+    backend.set('b', make_entry(2, now + 100))
+    assert backend.expire(['a', 'b'], now + 50) == 1
+    assert backend.purge_expired(now + 200) == 1
+    assert cache_files(backend.cache_dir) == []
+
+def test_file_journal_compaction_keeps_cursors_and_lines(tmp_path):
+    """Test that compaction by one worker loses no lines and keeps other workers' cursors"""
+    publisher, reader = FileBackend(str(tmp_path)), FileBackend(str(tmp_path))
+    now = time.time()
+    publisher.publish_invalidations(['condition:1', 'condition:2'], now - 100)
+    cursor, tags = reader.poll_invalidations(None)
+    publisher.publish_invalidations(['condition:3'], now)
+
+    publisher.compact_invalidations(now - 50)
+    cursor, tags = reader.poll_invalidations(cursor)
+    assert tags == ['condition:3']
+    publisher.publish_invalidations(['condition:4'], now)
+    publisher.compact_invalidations(now - 50)
+    cursor, tags = reader.poll_invalidations(cursor)
+    assert tags == ['condition:4']
+
+    # Lines published while another worker compacts are all kept
+    def publish(worker):
+        for i in range(200):
+            publisher.publish_invalidations([f"medication:{worker}:{i}"], now)
+
+    threads = [threading.Thread(target=publish, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        publisher.compact_invalidations(now - 50)
+    for thread in threads:
+        thread.join()
+    tags = reader.poll_invalidations(cursor)[1]
+    assert len(tags) == 800 and len(set(tags)) == 800
+
+def test_entry_format_round_trip():
+    """Test that entries survive encoding and that the header alone gives the expiry"""
+    now = time.time()
+    entry = {'timestamp': now, 'tags': ['condition:1'], 'result': '<html>' + 'rendered ' * 500}
+    data = encode_entry(entry, now + 60)
+
+    assert len(data) < len(entry['result']) / 10
+    assert decode_entry_header(data[:ENTRY_HEADER.size])[1:] == (now, now + 60)
+    assert decode_entry(data) == (entry, now + 60)
+
+def test_partial_and_legacy_entries_are_misses(cache_dir):
+    """Test that damaged entry files and files in the old format are treated as misses"""
+    key = cache.get_cache_key('page')
+    cache.set_cached(key, 'page', expiration=60)
+    cache.memory_cache.clear()
+    assert cache.get_cached(key, 60) == (True, 'page')
+
+    cache.memory_cache.clear()
+    cache_file = os.path.join(cache_dir, f"{key}{ENTRY_SUFFIX}")
+    data = open(cache_file, 'rb').read()
+    with open(cache_file, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert cache.get_cached(key, 60) == (False, None)
+
+    # Files in the old JSON format are dropped by the next purge
+    open(os.path.join(cache_dir, 'old.json'), 'w').write('{}')
+    cache.clear_expired_cache(time.time())
+    assert not os.path.exists(os.path.join(cache_dir, 'old.json'))
+
+def test_sqlite_backend(tmp_path):
+    """Test the SQLite backend and its indexed expiry"""
+    backend = SQLiteBackend(str(tmp_path / 'cache.sqlite3'))
+    check_backend(backend)
+    check_backend_journal(backend)
+
+    now = time.time()
+    for i in range(5):
+        backend.set(f"key{i}", make_entry(i, now + i * 10))
+    assert backend.expire(['key0', 'key4'], now + 15) == 1
+    assert backend.purge_expired(now + 25) == 2
+    assert decode_entry(backend.get('key3'))[0]['result'] == 3
+
+    # Entries written on one thread are visible to connections on others
+    results = []
+    thread = threading.Thread(target=lambda: results.append(backend.get('key3')))
+    thread.start()
+    thread.join()
+    assert decode_entry(results[0])[0]['result'] == 3
+
+def test_redis_backend():
+    """Test the Redis backend against a local protocol stand-in"""
+    url, server = start_fake_redis()
+    backend = RedisBackend(url)
+    check_backend(backend)
+    check_backend_journal(backend)
+
+    # Tag sets expire no earlier than the longest-lived entry in them
+    backend.add_tags('long', ['condition:9'], time.time() + 3600)
+    backend.add_tags('short', ['condition:9'], time.time() + 60)
+    backend.add_tags('longer', ['condition:9'], time.time() + 7200)
+    assert 7190 <= backend.client.execute('TTL', backend._key('tag', 'condition:9')) <= 7201
+
+    # Polls and compaction read only the entries they need
+    now = time.time()
+    backend, other = RedisBackend(url, prefix='medref:test:'), RedisBackend(url, prefix='medref:test:')
+    other.publish_invalidations([f"condition:{i}" for i in range(1200)], now - 100)
+    cursor = backend.poll_invalidations(None)[0]
+    other.publish_invalidations(['medication:1'], now)
+    del server.commands[:]
+    assert backend.poll_invalidations(cursor)[1] == ['medication:1']
+    assert [command[2] for command in server.commands if command[0] == 'LRANGE'] == [b'1200']
+
+    other.compact_invalidations(now - 50)
+    assert [command[2] for command in server.commands if command[0] == 'LRANGE'][1:] == [b'0', b'500', b'1000']
+    other.publish_invalidations(['medication:2'], now)
+    cursor, tags = backend.poll_invalidations(cursor + 1)
+    assert tags == ['medication:2']
+    assert backend.poll_invalidations(cursor)[1] == []
+
+def test_redis_connections_are_pooled():
+    """Test that threads share connections, and that a closed one is replaced without resending"""
+    url, server = start_fake_redis()
+    backend = RedisBackend(url)
+    for i in range(10):
+        thread = threading.Thread(target=backend.publish_invalidations, args=([f"condition:{i}"], time.time()))
+        thread.start()
+        thread.join()
+    assert len(server.connections) == 1
+
+    # The server drops the idle connection; the next command goes out once on a new one
+    server.connections[0].shutdown(socket.SHUT_RDWR)
+    time.sleep(0.05)
+    backend.publish_invalidations(['medication:1'], time.time())
+    assert backend.poll_invalidations(None)[1][-2:] == ['condition:9', 'medication:1']
+    assert len(server.connections) == 2
+
+    # Transactions run on one connection; an error reply leaves it usable elsewhere
+    assert backend.client.transaction(('SADD', 'a', 'x'), ('SMEMBERS', 'a')) == [1, [b'x']]
+    with pytest.raises(RedisError):
+        backend.client.transaction(('SADD', 'a', 'y'), ('BOGUS',))
+    assert backend.client.execute('SMEMBERS', 'a') == [b'x']
+    assert len(server.connections) == 3
+
+def test_sqlite_connections_are_pooled(tmp_path):
+    """Test that the SQLite backend reuses connections across threads"""
+    backend = SQLiteBackend(str(tmp_path / 'cache.sqlite3'))
+    connects = []
+    connect = backend._pool._connect
+    backend._pool._connect = lambda: connects.append(1) or connect()
+    backend.set('key', make_entry(1, time.time() + 60))
+    for _ in range(10):
+        thread = threading.Thread(target=backend.get, args=('key',))
+        thread.start()
+        thread.join()
+    assert connects == []
+
+def test_cache_result_with_sqlite_backend(cache_dir, monkeypatch):
+    """Test that the cache decorators work unchanged on another backend"""
+    monkeypatch.setattr(cache, 'backend', SQLiteBackend(os.path.join(cache_dir, 'cache.sqlite3')))
+    calls = []
+
+    @cache_result(expiration=60, tags=['guideline:7'])
+    def guideline_page():
+        calls.append(1)
+        return 'guideline'
+
+    guideline_page()
+    cache.memory_cache.clear()
+    assert guideline_page() == 'guideline'
+    assert invalidate_tags('guideline:7') == 1
+    guideline_page()
+    assert len(calls) == 2
+
+def test_cache_stats_count_lookups_and_bytes(cache_dir):
+    """Test that lookups and entry traffic are counted per function"""
+    cache.cache_stats.reset()
+
+    @cache_result(expiration=60)
+    def drug_page(drug_id):
+        return f"drug {drug_id}"
+
+    drug_page(1)
+    drug_page(1)
+    cache.memory_cache.clear()
+    drug_page(1)
+
+    stats = cache.cache_stats.snapshot()
+    assert len(stats) == 1
+    row = stats[0]
+    assert (row['function'], row['backend']) == ('drug_page', 'file')
+    assert (row['hits'], row['misses'], row['stale']) == (2, 1, 0)
+    assert row['bytes_written'] > 0 and row['bytes_read'] == row['bytes_written']
+
+    text = cache.cache_stats.render_prometheus()
+    assert '# TYPE medref_cache_hits_total counter' in text
+    assert 'medref_cache_hits_total{function="drug_page",backend="file"} 2' in text
+
+def test_cache_warmer_prerenders_pages(cache_dir):
+    """Test that the warmer caches pages once and honours the time budget"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+    calls = []
+
+    @app.route('/guideline/<int:guideline_id>')
+    @cache_response(expiration=60)
+    def guideline_detail(guideline_id):
+        calls.append(guideline_id)
+        if guideline_id == 3:
+            return 'not found', 404
+        return f"guideline {guideline_id}"
+
+    paths = ['/guideline/1', '/guideline/2', '/guideline/3']
+    progress = []
+    summary = CacheWarmer(workers=2).run(app, paths, progress=lambda done, total, _: progress.append(done))
+    assert (summary['warmed'], summary['cached'], summary['failed']) == (2, 0, 1)
+    assert sorted(progress) == [1, 2, 3]
+
+    # A real visitor now gets the pre-rendered page
+    assert app.test_client().get('/guideline/1').headers['X-Cache'] == 'HIT'
+    assert CacheWarmer().run(app, paths[:2])['cached'] == 2
+    assert CacheWarmer(time_budget=-1).run(app, paths)['skipped'] == 3
+    assert sorted(calls) == [1, 2, 3]
+
+def test_startup_warmup_runs_once_per_server(cache_dir, monkeypatch):
+    """Test that registering the startup warm-up starts nothing, and that gunicorn starts it from its first worker"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app).user_loader(lambda user_id: None)
+    calls = []
+
+    @app.route('/specialty/<int:specialty_id>')
+    @cache_response(expiration=60)
+    def specialty_detail(specialty_id):
+        calls.append(specialty_id)
+        return f"specialty {specialty_id}"
+
+    warmer = CacheWarmer()
+    monkeypatch.setattr(cache, 'cache_warmer', warmer)
+    warmer.warm_on_startup(app, lambda: ['/specialty/1'])
+    assert calls == []
+
+    # Later workers, e.g. ones gunicorn restarts, leave it alone
+    gunicorn_config.post_worker_init(SimpleNamespace(age=2))
+    warmer.join()
+    assert calls == []
+    gunicorn_config.post_worker_init(SimpleNamespace(age=1))
+    warmer.join()
+    assert calls == [1]
+
+def test_conditional_response_answers_304():
+    """Test that matching validators get a 304 without running the view"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    LoginManager(app).user_loader(lambda user_id: None)
+    db = SQLAlchemy(app)
+    calls = []
+
+    class Drug(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String(100))
+        updated_at = db.Column(db.DateTime)
+        version = db.Column(db.Integer, default=1)
+
+    @app.route('/drug/<int:drug_id>')
+    @conditional_response(record_validator(Drug, 'drug_id'))
+    def drug_detail(drug_id):
+        calls.append(drug_id)
+        return Drug.query.get_or_404(drug_id).name
+
+    @app.route('/drugs')
+    @conditional_response(collection_validator(Drug))
+    def drug_list():
+        calls.append('list')
+        return ','.join(drug.name for drug in Drug.query.all())
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(Drug(id=1, name='aspirin', updated_at=datetime(2024, 5, 1, 12, 0, 0, 500)))
+        db.session.commit()
+
+        client = app.test_client()
+        first = client.get('/drug/1')
+        assert first.headers['Last-Modified'] == 'Wed, 01 May 2024 12:00:00 GMT'
+        etag = first.headers['ETag']
+
+        assert client.get('/drug/1', headers={'If-None-Match': etag}).status_code == 304
+        assert client.get('/drug/1', headers={'If-Modified-Since': first.headers['Last-Modified']}).status_code == 304
+        assert client.get('/drug/2').status_code == 404
+        assert calls == [1, 2]
+
+        list_etag = client.get('/drugs').headers['ETag']
+        assert client.get('/drugs', headers={'If-None-Match': list_etag}).status_code == 304
+
+        # A new version changes the record ETag; a new row changes the collection ETag
+        db.session.get(Drug, 1).version = 2
+        db.session.add(Drug(id=2, name='ibuprofen', updated_at=datetime(2024, 4, 1)))
+        db.session.commit()
+        assert client.get('/drug/1', headers={'If-None-Match': etag}).status_code == 200
+        assert client.get('/drugs', headers={'If-None-Match': list_etag}).data == b'aspirin,ibuprofen'
+
+def test_cache_response_stores_validators(cache_dir):
+    """Test that cached responses carry their validators and answer 304 without queries"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    LoginManager(app).user_loader(lambda user_id: None)
+    db = SQLAlchemy(app)
+    calls, statements = [], []
+
+    class Drug(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String(100))
+        updated_at = db.Column(db.DateTime)
+        version = db.Column(db.Integer, default=1)
+
+    @app.route('/drug/<int:drug_id>')
+    @cache_response(expiration=60, validator=record_validator(Drug, 'drug_id'))
+    def drug_detail(drug_id):
+        calls.append(drug_id)
+        add_cache_tags(f"drug:{drug_id}")
+        return Drug.query.get_or_404(drug_id).name
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(Drug(id=1, name='aspirin', updated_at=datetime(2024, 5, 1, 12, 0, 0)))
+        db.session.commit()
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        client = app.test_client()
+
+        # Nothing cached: the validator alone answers a matching conditional request
+        etag = client.get('/drug/1').headers['ETag']
+        cache.clear_cache()
+        del calls[:], statements[:]
+        response = client.get('/drug/1', headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.headers['ETag'] == etag
+        assert calls == [] and len(statements) == 1
+
+        # Cached: hits and conditional hits compare against the stored validators
+        first = client.get('/drug/1')
+        assert first.headers['X-Cache'] == 'MISS' and first.headers['ETag'] == etag
+        del statements[:]
+        hit = client.get('/drug/1')
+        assert hit.headers['X-Cache'] == 'HIT' and hit.headers['ETag'] == etag
+        assert hit.headers['Last-Modified'] == 'Wed, 01 May 2024 12:00:00 GMT'
+        response = client.get('/drug/1', headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.headers['X-Cache'] == 'HIT'
+        response = client.get('/drug/1', headers={'If-Modified-Since': hit.headers['Last-Modified']})
+        assert response.status_code == 304
+        assert statements == [] and calls == [1]
+
+        # A change invalidates the entry, and the new rendering has a new ETag
+        db.session.get(Drug, 1).version = 2
+        db.session.commit()
+        invalidate_tags('drug:1')
+        response = client.get('/drug/1', headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.headers['ETag'] != etag
+        assert client.get('/drug/2', headers={'If-None-Match': etag}).status_code == 404
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+def test_record_validator_covers_related_rows():
+    """Test that changes to the related rows a page shows change its ETag"""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    LoginManager(app).user_loader(lambda user_id: None)
+    db = SQLAlchemy(app)
+
+    disease_drug = db.Table('disease_drug',
+        db.Column('disease_id', db.Integer, db.ForeignKey('disease.id'), primary_key=True),
+        db.Column('drug_id', db.Integer, db.ForeignKey('drug.id'), primary_key=True)
+    )
+
+    class Drug(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String(100))
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    class Disease(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String(100))
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+        drugs = db.relationship('Drug', secondary=disease_drug)
+
+    @app.route('/disease/<int:disease_id>')
+    @conditional_response(record_validator(Disease, 'disease_id', related=('drugs',)))
+    def disease_detail(disease_id):
+        disease = Disease.query.get_or_404(disease_id)
+        return disease.name + ': ' + ','.join(drug.name for drug in disease.drugs)
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Disease(id=1, name='gout', drugs=[Drug(id=1, name='colchicine')]), Drug(id=2, name='allopurinol')])
+        db.session.commit()
+
+        client = app.test_client()
+        first = client.get('/disease/1')
+        assert 'Last-Modified' not in first.headers
+        etag = first.headers['ETag']
+        assert client.get('/disease/1', headers={'If-None-Match': etag}).status_code == 304
+
+        # Renaming a linked row
+        db.session.get(Drug, 1).name = 'colchicine 500 mcg'
+        db.session.commit()
+        response = client.get('/disease/1', headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.data == b'gout: colchicine 500 mcg'
+        etag = response.headers['ETag']
+
+        # Linking a row, which leaves the record's updated_at alone
+        disease = db.session.get(Disease, 1)
+        updated_at = disease.updated_at
+        disease.drugs.append(db.session.get(Drug, 2))
+        db.session.commit()
+        assert disease.updated_at == updated_at
+        response = client.get('/disease/1', headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.data == b'gout: colchicine 500 mcg,allopurinol'
+        assert client.get('/disease/1', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__]))
@@ -0,0 +1,114 @@
+"""
+Test script for keyset pagination
+"""
+import json
+
+import pytest
+
+from models import db, Medication, Reference, Specialty
+from pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_paginate
+
+def seed_pagination_records():
+    """Add specialties, references sharing some titles, and medications"""
+    for name in ['Neurology', 'Cardiology', 'Dermatology', 'Anesthesiology', 'Oncology', 'Urology', 'Pathology']:
+        db.session.add(Specialty(name=name, description=f"{name} description"))
+        db.session.add(Reference(title=f"{name} review"))
+    db.session.add(Reference(title='Cardiology review'))
+    for name in ['Warfarin', 'Lisinopril', 'Atenolol', 'Ramipril', 'Metformin', 'Valproate', 'Enalapril']:
+        contraindications = ['Pregnancy'] if name in ('Warfarin', 'Lisinopril', 'Valproate', 'Enalapril', 'Ramipril') else []
+        db.session.add(Medication(name=name, class_name='Test', dosing='Daily',
+                                  contraindications=json.dumps(contraindications)))
+
+def test_cursor_tokens():
+    """Test that cursors round-trip and malformed tokens are rejected"""
+    token = encode_cursor(['next', 'Heart Failure', 42])
+    assert decode_cursor(token) == ['next', 'Heart Failure', 42]
+    assert '=' not in token and '/' not in token
+
+    for token in ['not a cursor!', encode_cursor({'a': 1})[:-1] + '%', 'e30']:
+        with pytest.raises(InvalidCursor):
+            decode_cursor(token)
+
+def test_keyset_paginate_walks_forwards_and_backwards(make_app):
+    """Test paging through a query in both directions without counting"""
+    app = make_app(seed_pagination_records)
+    with app.app_context():
+        pages = []
+        cursor = None
+        while True:
+            page = keyset_paginate(Specialty.query, Specialty.name, Specialty.id, 3, cursor)
+            pages.append([specialty.name for specialty in page.items])
+            assert page.total is None
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+
+        assert pages == [
+            ['Anesthesiology', 'Cardiology', 'Dermatology'], ['Neurology', 'Oncology', 'Pathology'], ['Urology']
+        ]
+        assert page.has_prev
+
+        previous = keyset_paginate(Specialty.query, Specialty.name, Specialty.id, 3, page.prev_cursor)
+        assert [specialty.name for specialty in previous.items] == pages[1]
+        first = keyset_paginate(Specialty.query, Specialty.name, Specialty.id, 3, previous.prev_cursor)
+        assert [specialty.name for specialty in first.items] == pages[0]
+        assert not first.has_prev and first.has_next
+
+        filtered = Specialty.query.filter(Specialty.name.like('%ology'))
+        page = keyset_paginate(filtered, Specialty.name, Specialty.id, 5, with_total=True)
+        assert page.total == 7
+        with pytest.raises(InvalidCursor):
+            keyset_paginate(Specialty.query, Specialty.name, Specialty.id, 3, encode_cursor(['sideways', 'a', 1]))
+        for values in [['next', [1], 1], ['next', 'a', '1'], ['prev', False, 1]]:
+            with pytest.raises(InvalidCursor):
+                keyset_paginate(Specialty.query, Specialty.name, Specialty.id, 3, encode_cursor(values))
+
+def test_api_list_cursors(make_app):
+    """Test cursor paging on a list endpoint, and that unpaged requests are unchanged"""
+    app = make_app(seed_pagination_records)
+    client = app.test_client()
+
+    data = client.get('/api/api/references').get_json()
+    assert data['count'] == 8 and 'next_cursor' not in data
+
+    # Titles tie on 'Cardiology review', so the ID decides
+    references = []
+    url = '/api/api/references?limit=3&include_total=true'
+    while url:
+        data = client.get(url).get_json()
+        assert data['total'] == 8
+        references += [(reference['title'], reference['id']) for reference in data['references']]
+        url = data['next_cursor'] and f"/api/api/references?limit=3&cursor={data['next_cursor']}&include_total=1"
+    assert references == sorted(references) and len(references) == 8
+
+    data = client.get('/api/api/references?limit=3').get_json()
+    assert 'total' not in data and data['prev_cursor'] is None
+    assert client.get('/api/api/references?cursor=bogus').status_code == 400
+
+    # Well-formed JSON with the wrong value types is rejected, not passed to SQL
+    for values in [['next', {'a': 1}, 1], ['next', None, None], ['prev', 'a', 1.5], ['next', 'a', True]]:
+        assert client.get(f'/api/api/specialties?cursor={encode_cursor(values)}').status_code == 400
+
+def test_api_medication_cursors_with_term_filter(make_app):
+    """Test cursor paging through medications filtered by a list item, forwards and back"""
+    app = make_app(seed_pagination_records)
+    client = app.test_client()
+
+    pages, url = [], '/api/api/medications?contraindication=pregnancy&limit=2&include_total=1'
+    while url:
+        data = client.get(url).get_json()
+        assert data['total'] == 5
+        pages.append([(m['name'], m['id']) for m in data['medications']])
+        url = data['next_cursor'] and (
+            f"/api/api/medications?contraindication=pregnancy&limit=2&include_total=1&cursor={data['next_cursor']}"
+        )
+    medications = [medication for page in pages for medication in page]
+    assert [name for name, _ in medications] == ['Enalapril', 'Lisinopril', 'Ramipril', 'Valproate', 'Warfarin']
+    assert medications == sorted(medications) and [len(page) for page in pages] == [2, 2, 1]
+
+    # Going back from the last page gives the page before it
+    data = client.get(f"/api/api/medications?contraindication=pregnancy&limit=2&cursor={data['prev_cursor']}").get_json()
+    assert [(m['name'], m['id']) for m in data['medications']] == pages[1]
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__]))
@@ -0,0 +1,597 @@
+"""
+Test script for the search module
+"""
+import json
+import os
+import time
+
+import pytest
+from sqlalchemy import event
+
+import search
+from models import db, Condition, Medication, Specialty, Guideline, Reference
+from pagination import encode_cursor
+from search_backends import FTS5Backend
+
+def seed_search_records():
+    """Add a few searchable records"""
+    cardiology = Specialty(name='Cardiology', description='Heart and blood vessels')
+    db.session.add(cardiology)
+    db.session.flush()
+    db.session.add_all([
+        Condition(name='Hypertension', description='Persistently raised arterial blood pressure',
+                  symptoms=json.dumps(['Headache', 'Dizziness']), treatments=json.dumps(['Lisinopril']),
+                  specialty_id=cardiology.id),
+        Condition(name='Heart Failure', description='The heart cannot pump enough blood',
+                  symptoms=json.dumps(['Dyspnea', 'Edema']), treatments=json.dumps(['Diuretics']),
+                  specialty_id=cardiology.id),
+        Medication(name='Lisinopril', class_name='ACE inhibitor', description='Lowers blood pressure',
+                   uses=json.dumps(['Hypertension', 'Heart failure']), dosing='10 mg daily',
+                   specialties=[cardiology]),
+        Guideline(title='Hypertension in adults', organization='ACC/AHA', publication_year=2017,
+                  summary='Blood pressure targets', specialty_id=cardiology.id),
+        Reference(title='Sodium and blood pressure', authors='Smith J', publication='NEJM')
+    ])
+
+def names(records):
+    """Get the display names of a list of records"""
+    return [getattr(record, 'name', None) or record.title for record in records]
+
+def check_search(app):
+    """Exercise a search backend through ranked_records"""
+    with app.app_context():
+        hits = search.search('hypertension')
+        conditions = search.ranked_records(Condition.query, 'condition', hits['condition'])
+        assert names(conditions) == ['Hypertension']
+        assert names(search.ranked_records(Medication.query, 'medication', hits['medication'])) == ['Lisinopril']
+        assert [entity_id for entity_id, _ in hits['guideline']] == [1]
+
+        # Every term must match, and terms match word prefixes
+        hits = search.search('blood press', types=['condition', 'reference'])
+        assert set(hits) == {'condition', 'reference'}
+        assert names(search.ranked_records(Condition.query, 'condition', hits['condition'])) == ['Hypertension']
+        assert len(hits['reference']) == 1
+
+        # Name matches outrank keyword and body matches
+        hits = search.search('hypertension', types=['medication', 'guideline'])
+        assert hits['guideline'][0][1] > hits['medication'][0][1]
+
+        # Abbreviations and synonyms expand inside the index
+        assert names(search.ranked_records(Condition.query, 'condition', search.search('HTN')['condition'])) == [
+            'Hypertension'
+        ]
+        hits = search.search('high blood pressure', types=['condition'])
+        assert names(search.ranked_records(Condition.query, 'condition', hits['condition'])) == ['Hypertension']
+        assert search.search('chf', types=['condition'])['condition'] != []
+
+        # Filters on the base query still apply, and pages are taken after filtering
+        hits = search.search('blood')
+        filtered = Condition.query.filter(Condition.name != 'Heart Failure')
+        assert names(search.ranked_records(filtered, 'condition', hits['condition'])) == ['Hypertension']
+        assert search.search('   ') is None
+        assert search.search('!!!') == {entity_type: [] for entity_type in search.SEARCH_TYPES}
+
+def test_fts5_search(make_app):
+    """Test searching the FTS5 index"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    assert search.backend.name == 'fts5'
+    check_search(app)
+
+def test_like_search(make_app):
+    """Test the ILIKE fallback"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='like')
+    check_search(app)
+
+def test_postgres_search(make_app):
+    """Test the tsvector backend against the PostgreSQL database in TEST_POSTGRES_URL"""
+    database_url = os.environ.get('TEST_POSTGRES_URL')
+    if not database_url:
+        pytest.skip('TEST_POSTGRES_URL is not set')
+
+    app = make_app(seed_search_records, database_url, init=[search.init_app])
+    assert search.backend.name == 'postgres'
+    check_search(app)
+
+def test_backend_installed_after_failed_start(make_app, monkeypatch):
+    """Test that a backend that could not be installed at start is retried, and its index built"""
+    install = FTS5Backend.install
+    failures = []
+
+    def fail_once(backend, connection):
+        if not failures:
+            failures.append(1)
+            raise RuntimeError('no such table: condition')
+        install(backend, connection)
+
+    monkeypatch.setattr(FTS5Backend, 'install', fail_once)
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5', SEARCH_BACKEND_RETRY=60)
+    assert search.backend.name == 'like'
+    with app.app_context():
+        # Searches scan the tables until the next retry is due
+        assert search.search('pump')['condition'] != []
+        assert search.backend.name == 'like'
+
+        monkeypatch.setattr(search, '_retry_at', 0)
+        hits = search.search('pump')['condition']
+        assert search.backend.name == 'fts5' and hits != []
+        with db.engine.begin() as connection:
+            assert search.backend.count(connection) == search.count_records()
+
+def test_fts5_index_follows_model_changes(make_app):
+    """Test that inserts, updates and deletes reach the index with their transaction"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    with app.app_context():
+        condition = Condition.query.filter_by(name='Heart Failure').one()
+        condition.description = 'Reduced ejection fraction'
+        db.session.commit()
+        assert search.search('pump')['condition'] == []
+        assert [entity_id for entity_id, _ in search.search('ejection')['condition']] == [condition.id]
+
+        db.session.add(Medication(name='Furosemide', class_name='Loop diuretic', dosing='40 mg'))
+        db.session.flush()
+        db.session.rollback()
+        assert search.search('furosemide')['medication'] == []
+
+        db.session.delete(Reference.query.one())
+        db.session.commit()
+        assert search.search('sodium')['reference'] == []
+
+def test_inverted_index_prefixes_and_removal():
+    """Test prefix matching, AND semantics and removal in the inverted index"""
+    index = search.InvertedIndex()
+    index.add('condition', 1, {'name': 'Asthma', 'body': 'Airway inflammation'}, {'id': 1}, ['Pulmonology'])
+    index.add('condition', 2, {'name': 'Asthmatic bronchitis'}, {'id': 2}, ['Pulmonology'])
+    index.add('reference', 3, {'name': 'Airway management'}, {'id': 3})
+
+    assert index.expand('asthm') == ['asthma', 'asthmatic']
+    assert [entity_id for entity_id, _ in index.search('asth')['condition']] == [1, 2]
+    assert [entity_id for entity_id, _ in index.search('asthma airway')['condition']] == [1]
+    hits = index.search('airway', specialty='Cardiology')
+    assert [entity_id for entity_id, _ in hits.pop('reference')] == [3]
+    assert hits == {'condition': [], 'medication': [], 'specialty': [], 'guideline': []}
+
+    index.remove('condition', 1)
+    assert index.expand('asthm') == ['asthmatic']
+    assert index.expand('inflam') == []
+    assert len(index) == 2
+
+def test_bm25_ranking_and_merged_pages():
+    """Test BM25F scoring and global pagination across entity types"""
+    index = search.InvertedIndex()
+    index.add('condition', 1, {'name': 'Asthma', 'body': 'Chronic airway disease'}, {'id': 1})
+    index.add('condition', 2, {'name': 'Bronchitis', 'body': 'Airway inflammation, sometimes with asthma'}, {'id': 2})
+    index.add('medication', 1, {'name': 'Salbutamol', 'keywords': 'Asthma'}, {'id': 1})
+    index.add('guideline', 1, {'name': 'Asthma management in adults and children'}, {'id': 1})
+    index.add('reference', 1, {'name': 'Pollen counts'}, {'id': 1})
+
+    # Name beats keywords beats body, and a short name beats a long one
+    total, hits = index.top('asthma')
+    assert total == 4
+    assert [(entity_type, entity_id) for entity_type, entity_id, _ in hits] == [
+        ('condition', 1), ('guideline', 1), ('medication', 1), ('condition', 2)
+    ]
+    assert [score for _, _, score in hits] == sorted((score for _, _, score in hits), reverse=True)
+
+    # Pages come from the merged stream
+    assert index.top('asthma', limit=2, offset=1) == (4, hits[1:3])
+    assert index.top('asthma', types=['condition'], offset=1) == (2, [hits[3]])
+
+    # Rare terms weigh more, and exact words beat prefixes
+    assert index.top('chronic airway')[1][0][:2] == ('condition', 1)
+    index.add('condition', 3, {'name': 'Asthmatic cough'}, {'id': 3})
+    assert index.top('asthma', limit=1)[1][0][:2] == ('condition', 1)
+    assert index.top('asthma')[0] == 5
+
+    # A blank query lists every record by type, then ID
+    assert [hit[:2] for hit in index.top('', limit=3)[1]] == [('condition', 1), ('condition', 2), ('condition', 3)]
+
+def test_synonym_expansion():
+    """Test parsing queries into clauses with the synonym table"""
+    table = search.SynonymTable({
+        'MI': ['Myocardial infarction'], 'heart attack': ['myocardial infarction'], 'afib': ['atrial fibrillation', 'AFib']
+    })
+    exact, prefix = (lambda word: search.QueryTerm(word, False)), (lambda word: search.QueryTerm(word, True))
+
+    assert len(table) == 3
+    assert table.parse(['acute', 'mi']) == [
+        ((prefix('acute'),),),
+        ((exact('mi'),), (prefix('myocardial'), prefix('infarction')))
+    ]
+    assert table.parse(['heart', 'attack', 'heart']) == [
+        ((exact('heart'), exact('attack')), (prefix('myocardial'), prefix('infarction'))),
+        ((prefix('heart'),),)
+    ]
+    assert table.parse(['afib']) == [((exact('afib'),), (prefix('atrial'), prefix('fibrillation')))]
+
+    index = search.InvertedIndex()
+    index.add('condition', 1, {'name': 'Myocardial infarction'}, {'id': 1})
+    index.add('condition', 2, {'name': 'Migraine'}, {'id': 2})
+    index.add('condition', 3, {'name': 'Atrial fibrillation', 'body': 'Irregular rhythm'}, {'id': 3})
+    original, search.synonyms = search.synonyms, table
+    try:
+        # The abbreviation itself is not a prefix of other words
+        assert [entity_id for entity_id, _ in index.search('MI')['condition']] == [1]
+        assert [entity_id for entity_id, _ in index.search('heart attack')['condition']] == [1]
+        assert [entity_id for entity_id, _ in index.search('afib irreg')['condition']] == [3]
+    finally:
+        search.synonyms = original
+
+    # The shipped table loads and covers common abbreviations
+    shipped = search.SynonymTable.load(search.DEFAULT_SYNONYMS_FILE)
+    for abbreviation in ('htn', 'mi', 'afib', 'dvt', 'ssri'):
+        assert len(shipped.parse([abbreviation])[0]) > 1
+    assert len(search.SynonymTable.load('missing.json')) == 0
+
+def test_facet_counts():
+    """Test counting facet values over matches and over every record"""
+    index = search.InvertedIndex()
+    index.add('medication', 1, {'name': 'Lisinopril', 'keywords': 'ACE inhibitor'}, {'id': 1}, ['Cardiology'],
+              {'specialty': ['Cardiology'], 'medication_class': ['ACE inhibitor']})
+    index.add('medication', 2, {'name': 'Enalapril', 'keywords': 'ACE inhibitor'}, {'id': 2},
+              ['Cardiology', 'Nephrology'],
+              {'specialty': ['Cardiology', 'Nephrology'], 'medication_class': ['ACE inhibitor']})
+    index.add('guideline', 1, {'name': 'ACE inhibitors in CKD'}, {'id': 1}, ['Nephrology'],
+              {'specialty': ['Nephrology'], 'organization': ['KDIGO']})
+    index.add('reference', 1, {'name': 'Enalapril trial'}, {'id': 1}, None, {'organization': [None]})
+
+    # Facets cover every match, not just the page
+    total, hits, facets = index.top('ace', with_facets=True, limit=1)
+    assert (total, len(hits)) == (3, 1)
+    assert facets == {
+        'type': [('medication', 2), ('guideline', 1)],
+        'specialty': [('Cardiology', 2), ('Nephrology', 2)],
+        'medication_class': [('ACE inhibitor', 2)],
+        'organization': [('KDIGO', 1)]
+    }
+    assert index.top('enal', with_facets=True)[2]['type'] == [('medication', 1), ('reference', 1)]
+    assert index.top('enal', specialty='Nephrology', with_facets=True)[2]['specialty'] == [
+        ('Cardiology', 1), ('Nephrology', 1)
+    ]
+
+    everything = index.facet_counts()
+    assert everything['specialty'] == [('Cardiology', 2), ('Nephrology', 2)]
+    assert everything['medication_class'] == [('ACE inhibitor', 2)]
+    assert index.facet_counts([('medication', 2), ('condition', 9)])['type'] == [('medication', 1)]
+
+def test_api_search_uses_memory_index(make_app):
+    """Test that /api/search answers from the in-memory index without querying the database"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            data = client.get('/api/api/search?q=blood&specialty=Cardiology').get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert statements == []
+    assert [c['name'] for c in data['results']['conditions']] == ['Hypertension', 'Heart Failure']
+    assert data['results']['medications'][0]['specialty'] == 'Cardiology'
+    assert data['results']['references'][0]['title'] == 'Sodium and blood pressure'
+    assert data['facets']['type'] == [
+        {'value': 'condition', 'count': 2}, {'value': 'guideline', 'count': 1}, {'value': 'medication', 'count': 1},
+        {'value': 'reference', 'count': 1}, {'value': 'specialty', 'count': 1}
+    ]
+    assert data['facets']['specialty'] == [{'value': 'Cardiology', 'count': 5}]
+    assert data['facets']['medication_class'] == [{'value': 'ACE inhibitor', 'count': 1}]
+    assert data['facets']['organization'] == [{'value': 'ACC/AHA', 'count': 1}]
+    htn = client.get('/api/api/search?q=HTN&type=condition').get_json()
+    assert [c['name'] for c in htn['results']['conditions']] == ['Hypertension']
+    assert data['total_results'] == len(data['ranked']) == 6
+    assert data['ranked'][0]['type'] == 'reference'
+    assert [hit['score'] for hit in data['ranked']] == sorted((hit['score'] for hit in data['ranked']), reverse=True)
+
+    page = client.get('/api/api/search?q=blood&limit=2&offset=2').get_json()
+    assert page['total_results'] == 6
+    assert page['ranked'] == data['ranked'][2:4]
+
+    # Cursors continue from the last hit, and give the same stream as offsets
+    ranked = []
+    url = '/api/api/search?q=blood&limit=4'
+    while url:
+        page = client.get(url).get_json()
+        ranked += page['ranked']
+        url = page['next_cursor'] and f"/api/api/search?q=blood&limit=4&cursor={page['next_cursor']}"
+    assert ranked == data['ranked']
+    assert client.get('/api/api/search?q=blood&cursor=WyJ4IiwxLDFd').status_code == 400
+    for bad in ['limit=ten', 'offset=x', 'offset=-1', 'limit=1.5']:
+        assert client.get(f'/api/api/search?q=blood&{bad}').status_code == 400
+    assert client.get('/api/api/search?q=blood&limit=100000').get_json()['limit'] == 100
+    page = client.get('/api/api/search?q=blood&limit=-3').get_json()
+    assert page['limit'] == 1 and len(page['ranked']) == 1
+    for score in [float('nan'), float('inf'), float('-inf'), True]:
+        token = encode_cursor(['condition', 1, score])
+        assert client.get(f'/api/api/search?q=blood&cursor={token}').status_code == 400
+    assert client.get(f"/api/api/search?q=blood&cursor={encode_cursor(['condition', True, 1.0])}").status_code == 400
+
+    started = time.perf_counter()
+    for _ in range(100):
+        search.memory_index.search('hyperten', specialty='Cardiology')
+    assert (time.perf_counter() - started) / 100 < 0.001
+
+def test_name_index_suggestions():
+    """Test prefix suggestions, word-start matches, shared classes and removal"""
+    index = search.NameIndex()
+    index.add('condition', 1, [('condition', 'Heart Failure')])
+    index.add('condition', 2, [('condition', 'Hepatitis  B')])
+    index.add('medication', 1, [('medication', 'Lisinopril'), ('medication_class', 'ACE inhibitor')])
+    index.add('medication', 2, [('medication', 'Enalapril'), ('medication_class', 'ACE inhibitor')])
+
+    assert [s.label for s in index.suggest('he')] == ['Heart Failure', 'Hepatitis  B']
+    assert [s.label for s in index.suggest('HEPATITIS b')] == ['Hepatitis  B']
+    assert [s.label for s in index.suggest('fail')] == ['Heart Failure']
+    assert [(s.label, s.kind) for s in index.suggest('inhib')] == [('ACE inhibitor', 'medication_class')]
+    assert [s.label for s in index.suggest('heart ')] == ['Heart Failure']
+    assert index.suggest('   ') == []
+    assert len(index.suggest('e', limit=1)) == 1
+    assert index.suggest('he', limit=0) == [] and index.suggest('he', limit=-1) == []
+
+    # The limit holds at the boundary between name and word-start matches
+    assert [s.label for s in index.suggest('h', limit=2)] == ['Heart Failure', 'Hepatitis  B']
+    assert [s.label for s in index.suggest('f', limit=1)] == ['Heart Failure']
+    assert [s.label for s in index.suggest('he', limit=1)] == ['Heart Failure']
+
+    index.add('medication', 1, [('medication', 'Lisinopril'), ('medication_class', None)])
+    index.remove('medication', 2)
+    assert index.suggest('ace') == []
+    assert index.suggest('enal') == []
+
+def test_api_autocomplete(make_app):
+    """Test /api/autocomplete, and that it follows commits"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+
+    data = client.get('/api/api/autocomplete?q=hyp').get_json()
+    assert data['suggestions'] == [
+        {'label': 'Hypertension', 'type': 'condition', 'id': 1},
+        {'label': 'Hypertension in adults', 'type': 'guideline', 'id': 1}
+    ]
+    data = client.get('/api/api/autocomplete?q=ace').get_json()
+    assert data['suggestions'] == [{'label': 'ACE inhibitor', 'type': 'medication_class', 'id': None}]
+    assert client.get('/api/api/autocomplete?q=sodium').get_json()['suggestions'] == []
+    assert len(client.get('/api/api/autocomplete?q=h&limit=1').get_json()['suggestions']) == 1
+
+    with app.app_context():
+        Condition.query.filter_by(name='Hypertension').one().name = 'Essential hypertension'
+        db.session.commit()
+    labels = [s['label'] for s in client.get('/api/api/autocomplete?q=hyp').get_json()['suggestions']]
+    assert labels == ['Hypertension in adults', 'Essential hypertension']
+
+    started = time.perf_counter()
+    for _ in range(1000):
+        search.name_index.suggest('hyp')
+    assert (time.perf_counter() - started) / 1000 < 0.0001
+
+def test_trigram_corrections():
+    """Test edit distances and trigram candidate corrections"""
+    assert search.edit_distance('metropolol', 'metoprolol', 3) == 2
+    assert search.edit_distance('asthma', 'athsma', 3) == 2
+    assert search.edit_distance('abcd', 'bacd', 3) == 1
+    assert search.edit_distance('aspirin', 'ibuprofen', 2) == 3
+
+    index = search.TrigramIndex()
+    index.add('medication', 1, 'Metoprolol')
+    index.add('medication', 2, 'Levetiracetam')
+    index.add('medication', 3, 'Metformin')
+    index.add('condition', 1, 'Heart Failure')
+
+    assert index.correct('metropolol') == 'metoprolol'
+    assert index.correct('levitiracetam') == 'levetiracetam'
+    assert index.correct('metfromin') == 'metformin'
+    assert index.correct('failur') == 'failure'
+    assert index.correct('aspirin') is None
+
+    index.remove('medication', 1)
+    assert index.correct('metropolol') is None
+
+def test_search_corrects_typos(make_app):
+    """Test that searches finding nothing are retried with corrected words"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+
+    data = client.get('/api/api/search?q=lisinoprl').get_json()
+    assert data['corrected_query'] == 'lisinopril'
+    assert [m['name'] for m in data['results']['medications']] == ['Lisinopril']
+
+    data = client.get('/api/api/search?q=hypertenson').get_json()
+    assert data['corrected_query'] == 'hypertension'
+    assert data['total_results'] == 3
+    assert client.get('/api/api/search?q=blood').get_json()['corrected_query'] is None
+
+    with app.app_context():
+        # Only condition and medication names are used for corrections
+        assert search.correct_query('heart failre') == 'heart failure'
+        assert search.correct_query('bloood') is None
+        assert search.correct_query('xyzzy') is None
+
+def test_api_search_batch(make_app):
+    """Test that /api/search/batch answers many searches in request order"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+
+    data = client.post('/api/api/search/batch', json={'queries': [
+        {'q': 'blood', 'limit': 2},
+        {'q': 'HTN', 'type': 'condition'},
+        {'q': 'lisinoprl', 'type': 'medication'},
+        {'q': 'blood', 'type': 'reference', 'specialty': 'Cardiology'},
+        {'q': 'xyzzy'}
+    ]}).get_json()
+    assert data['count'] == 5
+    first, htn, typo, references, missing = data['results']
+
+    single = client.get('/api/api/search?q=blood&limit=2').get_json()
+    assert first['total_results'] == single['total_results'] == 6
+    assert first['results'] == single['ranked']
+    assert [c['name'] for c in htn['results']] == ['Hypertension']
+    assert htn['type'] == 'condition' and htn['corrected_query'] is None
+    assert typo['corrected_query'] == 'lisinopril'
+    assert [m['name'] for m in typo['results']] == ['Lisinopril']
+    assert [r['title'] for r in references['results']] == ['Sodium and blood pressure']
+    assert missing['total_results'] == 0 and missing['results'] == []
+
+    # Scores of the same words are shared between searches, and match a single search
+    with app.app_context():
+        batch = search.memory_index.top_many([
+            ('blood pressure', None, None, 10), ('blood', ['condition'], 'Cardiology', 10)
+        ])
+        assert batch == [
+            search.memory_index.top('blood pressure', limit=10),
+            search.memory_index.top('blood', ['condition'], 'Cardiology', limit=10)
+        ]
+
+    for body in [None, {}, {'queries': []}, {'queries': ['blood']}, {'queries': [{'q': 'a', 'type': 'x'}]},
+                 {'queries': [{'q': 'a', 'limit': 0}]}, {'queries': [{'q': 'a'}] * 101}]:
+        assert client.post('/api/api/search/batch', json=body).status_code == 400
+
+def test_snippets():
+    """Test that snippets are cut around the matches, at word boundaries"""
+    text = ('Persistently raised arterial blood pressure that over many years damages the heart, kidneys '
+            'and brain; often causes no symptoms until a stroke or heart attack occurs')
+    index = search.InvertedIndex()
+    index.add('condition', 1, {'name': 'Hypertension', 'body': text}, {'id': 1},
+              texts={'description': text, 'symptoms': 'Headache; Dizziness', 'treatments': ''})
+
+    snippet = index.snippets('condition', 1, 'stroke', length=60)['description']
+    assert snippet['text'] == '\u2026causes no symptoms until a stroke or heart attack occurs'
+    start, end = snippet['highlights'][0]
+    assert snippet['text'][start:end] == 'stroke'
+    assert len(snippet['text']) <= 62
+
+    # Prefixes match, every matching column gets a snippet, and each match is highlighted
+    snippets = index.snippets('condition', 1, 'heart dizz', length=60)
+    assert set(snippets) == {'description', 'symptoms'}
+    assert [snippets['symptoms']['text'][start:end] for start, end in snippets['symptoms']['highlights']] == [
+        'Dizziness'
+    ]
+    description = snippets['description']
+    assert [description['text'][start:end] for start, end in description['highlights']] == ['heart']
+
+    # Records matching outside their texts show the start of the first one
+    assert index.snippets('condition', 1, 'hypertension', length=30) == {
+        'description': {'text': 'Persistently raised arterial\u2026', 'highlights': []}
+    }
+    assert index.snippets('condition', 2, 'stroke') == {}
+    assert search.snippet_window('short', [(0, 5)], 60) == (0, 5)
+
+def test_api_search_snippets(make_app):
+    """Test that searches can return snippets in place of long text columns"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+
+    full = client.get('/api/api/search?q=pump').get_json()
+    data = client.get('/api/api/search?q=pump&snippets=true').get_json()
+    assert [hit['id'] for hit in data['ranked']] == [hit['id'] for hit in full['ranked']]
+    condition = data['results']['conditions'][0]
+    assert condition['name'] == 'Heart Failure'
+    assert 'description' not in condition and 'symptoms' not in condition
+    snippet = condition['snippets']['description']
+    assert [snippet['text'][start:end] for start, end in snippet['highlights']] == ['pump']
+
+    # JSON lists are shown as plain text
+    data = client.get('/api/api/search?q=edema&type=condition&snippets=1').get_json()
+    assert data['ranked'][0]['snippets'] == {'symptoms': {'text': 'Dyspnea; Edema', 'highlights': [[9, 14]]}}
+
+    # Snippets follow corrected queries
+    data = client.get('/api/api/search?q=lisinoprl&type=condition&snippets=1').get_json()
+    assert data['ranked'][0]['snippets']['treatments']['highlights'] == [[0, 10]]
+
+    batch = client.post('/api/api/search/batch', json={'queries': [{'q': 'pump'}], 'snippets': True}).get_json()
+    assert batch['results'][0]['results'][0]['snippets']['description'] == snippet
+
+def test_query_cache():
+    """Test the search result cache's canonical keys, size limits and versions"""
+    assert search.canonical_clauses(search.tokenize('Heart failure')) == search.canonical_clauses(
+        search.tokenize('  failure,  HEART heart ')
+    )
+    assert search.canonical_clauses(['heart']) != search.canonical_clauses(['heart', 'failure'])
+
+    query_cache = search.QueryCache(max_entries=2, max_bytes=10 * search.CACHED_HIT_BYTES)
+    query_cache.set('a', 1, 'A', 1)
+    query_cache.set('b', 1, 'B', 1)
+    assert query_cache.get('a', 1) == (True, 'A')
+    query_cache.set('c', 1, 'C', 1)
+    assert query_cache.get('b', 1) == (False, None)
+    assert query_cache.get('a', 2) == (False, None)
+    assert len(query_cache) == 1 and query_cache.size == 2 * search.CACHED_HIT_BYTES
+
+    # Entries larger than the byte limit are not kept, and large ones push out older ones
+    query_cache.set('huge', 1, 'H', 10)
+    assert query_cache.get('huge', 1) == (False, None)
+    query_cache.set('large', 1, 'L', 8)
+    assert query_cache.get('c', 1) == (False, None)
+    assert query_cache.get('large', 1) == (True, 'L')
+
+    index = search.InvertedIndex(search.QueryCache())
+    index.add('condition', 1, {'name': 'Heart failure'}, {'id': 1})
+    assert index.top('Heart failure') == index.top('failure  heart')
+    assert (index.query_cache.hits, index.query_cache.misses) == (1, 1)
+    index.add('condition', 2, {'name': 'Heart failure with preserved ejection fraction'}, {'id': 2})
+    assert index.top('heart failure')[0] == 2
+
+def test_searches_share_cached_hits(make_app):
+    """Test that repeat searches are answered from the result cache until the data changes"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    client = app.test_client()
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    with app.app_context():
+        hits = search.search('Blood pressure', ['condition', 'reference'])
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            assert search.search('pressure,  BLOOD', ['reference', 'condition']) is hits
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+        assert statements == []
+
+        # Uncommitted changes are seen by their own session only, and are not cached
+        condition = Condition.query.filter_by(name='Heart Failure').one()
+        condition.description = 'Low blood pressure and reduced ejection fraction'
+        db.session.flush()
+        assert len(search.search('blood pressure', ['condition', 'reference'])['condition']) == 2
+        db.session.rollback()
+        assert search.search('blood pressure', ['condition', 'reference']) is hits
+
+        # Commits move the data version on
+        condition.description = 'Low blood pressure and reduced ejection fraction'
+        db.session.commit()
+        assert len(search.search('blood pressure', ['condition', 'reference'])['condition']) == 2
+
+    misses = search.query_cache.misses
+    first = client.get('/api/api/search?q=Heart+Failure').get_json()
+    assert client.get('/api/api/search?q=failure%20%20heart').get_json()['ranked'] == first['ranked']
+    assert search.query_cache.misses == misses + 1
+
+def test_memory_index_follows_commits(make_app):
+    """Test that committed changes, and only those, reach the in-memory index"""
+    app = make_app(seed_search_records, init=[search.init_app], SEARCH_BACKEND='fts5')
+    with app.app_context():
+        condition = Condition.query.filter_by(name='Heart Failure').one()
+        condition.description = 'Reduced ejection fraction'
+        db.session.commit()
+        assert search.memory_index.search('pump')['condition'] == []
+        assert search.memory_index.payload('condition', condition.id)['description'] == 'Reduced ejection fraction'
+
+        db.session.add(Medication(name='Furosemide', class_name='Loop diuretic', dosing='40 mg'))
+        db.session.flush()
+        db.session.rollback()
+        assert search.memory_index.search('furosemide')['medication'] == []
+
+        # Renaming a specialty updates the records that show its name
+        Specialty.query.one().name = 'Cardiovascular medicine'
+        db.session.commit()
+        assert search.memory_index.payload('condition', condition.id)['specialty'] == 'Cardiovascular medicine'
+
+        db.session.delete(Reference.query.one())
+        db.session.commit()
+        assert search.memory_index.search('sodium')['reference'] == []
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__]))
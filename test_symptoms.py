@@ -0,0 +1,79 @@
+"""
+Test script for the symptom matching module
+"""
+import json
+
+import pytest
+
+import symptoms
+from models import db, Condition, Specialty
+
+def seed_symptom_records():
+    """Add a few conditions with their symptoms"""
+    cardiology = Specialty(name='Cardiology')
+    pulmonology = Specialty(name='Pulmonology')
+    db.session.add_all([cardiology, pulmonology])
+    db.session.flush()
+    db.session.add_all([
+        Condition(name='Heart Failure', description='Pump failure', specialty_id=cardiology.id,
+                  symptoms=json.dumps(['Dyspnea', 'Edema', 'Fatigue', 'Orthopnea'])),
+        Condition(name='Angina', description='Chest pain on exertion', specialty_id=cardiology.id,
+                  symptoms=json.dumps(['Chest pain', 'Dyspnea'])),
+        Condition(name='Asthma', description='Reversible airway obstruction', specialty_id=pulmonology.id,
+                  symptoms=json.dumps(['Dyspnea', 'Wheezing', 'Cough'])),
+        Condition(name='Migraine', description='Recurrent headache', symptoms='not json')
+    ])
+
+def test_symptom_index_counts_overlaps():
+    """Test overlap counting, ranking, specialty filters and row reuse"""
+    index = symptoms.SymptomIndex()
+    index.add(1, 'Heart Failure', 1, ['Dyspnea', 'Edema', 'Fatigue', 'Orthopnea'])
+    index.add(2, 'Angina', 1, ['Chest pain', 'Dyspnea'])
+    index.add(3, 'Asthma', 2, ['dyspnea', 'Wheezing', 'Cough'])
+
+    total, matches = index.match(['DYSPNEA', ' chest  pain', 'fatigue', 'edema', 'unknown'])
+    assert total == 3
+    assert [(m.name, m.matched) for m in matches] == [('Heart Failure', 3), ('Angina', 2), ('Asthma', 1)]
+    assert matches[1].matched_symptoms == ['Dyspnea', 'Chest pain']
+
+    # Equal overlaps rank the condition whose own symptoms are best covered first
+    assert [m.name for m in index.match(['dyspnea'])[1]] == ['Angina', 'Asthma', 'Heart Failure']
+    assert [m.name for m in index.match(['dyspnea'], specialty_id=2)[1]] == ['Asthma']
+    assert index.match(['dyspnea'], limit=1)[0] == 3
+
+    # Counts above 1 bit carry across the counter planes
+    index.add(4, 'Everything', None, ['a', 'b', 'c', 'd', 'e', 'f', 'g'])
+    assert index.match(['a', 'b', 'c', 'd', 'e', 'f', 'g'])[1][0].matched == 7
+
+    index.remove(1)
+    assert not index.known('orthopnea')
+    index.add(5, 'Pneumonia', 2, ['Cough', 'Fever'])
+    assert [m.name for m in index.match(['cough'])[1]] == ['Pneumonia', 'Asthma']
+    assert len(index) == 4
+
+def test_api_conditions_by_symptoms(make_app):
+    """Test /api/conditions/by-symptoms, and that it follows commits"""
+    app = make_app(seed_symptom_records, init=[symptoms.init_app])
+    client = app.test_client()
+
+    data = client.get('/api/api/conditions/by-symptoms?symptoms=dyspnea,chest pain&symptom=Rash').get_json()
+    assert data['count'] == 3
+    assert [(c['name'], c['matched'], c['score']) for c in data['conditions']] == [
+        ('Angina', 2, 0.6667), ('Asthma', 1, 0.3333), ('Heart Failure', 1, 0.3333)
+    ]
+    assert data['unknown_symptoms'] == ['Rash']
+
+    with app.app_context():
+        cardiology_id = Specialty.query.filter_by(name='Cardiology').one().id
+    data = client.get(f'/api/api/conditions/by-symptoms?symptoms=dyspnea&specialty_id={cardiology_id}').get_json()
+    assert [c['name'] for c in data['conditions']] == ['Angina', 'Heart Failure']
+    assert client.get('/api/api/conditions/by-symptoms').status_code == 400
+
+    with app.app_context():
+        Condition.query.filter_by(name='Migraine').one().symptoms = json.dumps(['Headache', 'Dyspnea'])
+        db.session.commit()
+    data = client.get('/api/api/conditions/by-symptoms?symptoms=headache').get_json()
+    assert [c['name'] for c in data['conditions']] == ['Migraine']
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__]))
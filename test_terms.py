@@ -0,0 +1,152 @@
+"""
+Test script for the JSON list term tables
+"""
+import json
+
+import pytest
+from sqlalchemy import event
+
+from models import (
+    db, Condition, ConditionTerm, Medication, MedicationTerm, Specialty, backfill_record_terms, list_terms,
+    rebuild_record_terms, with_term
+)
+
+def seed_term_records():
+    """Add a few medications and a condition, seeded without history so they can be deleted again"""
+    cardiology = Specialty(name='Cardiology')
+    db.session.add_all([
+        Medication(name='Lisinopril', class_name='ACE inhibitor', dosing='10 mg', specialties=[cardiology],
+                   uses=json.dumps(['Hypertension', 'Heart failure']),
+                   contraindications=json.dumps(['Pregnancy', 'History of angioedema'])),
+        Medication(name='Warfarin', class_name='Anticoagulant', dosing='5 mg',
+                   uses=json.dumps(['Atrial fibrillation']),
+                   contraindications=json.dumps(['pregnancy ', 'Active bleeding'])),
+        Medication(name='Metformin', class_name='Biguanide', dosing='500 mg',
+                   uses=json.dumps(['Type 2 diabetes']),
+                   contraindications=json.dumps(['Severe renal impairment'])),
+        Condition(name='Hypertension', description='Raised blood pressure',
+                  symptoms=json.dumps(['Headache', 'Headache', 'Nosebleeds']), treatments='Lifestyle changes')
+    ])
+
+def names(records):
+    """Get the names of records, sorted"""
+    return sorted(record.name for record in records)
+
+def test_list_terms():
+    """Test splitting JSON list columns into normalised terms"""
+    assert list_terms(json.dumps(['Dry  cough', 'dry cough', None, ' ', 'Rash'])) == [
+        ('Dry  cough', 'dry cough'), ('Rash', 'rash')
+    ]
+    assert list_terms('Lifestyle changes') == [('Lifestyle changes', 'lifestyle changes')]
+    assert list_terms(None) == []
+    assert list_terms('[]') == []
+
+def test_term_tables_follow_json_columns(make_app):
+    """Test that inserts, updates and deletes keep the term tables in step"""
+    app = make_app(seed_term_records, seed_history=False)
+    with app.app_context():
+        assert names(with_term(Medication, 'contraindications', 'PREGNANCY')) == ['Lisinopril', 'Warfarin']
+        assert names(with_term(Medication, 'contraindications', 'preg')) == []
+        assert names(with_term(Medication, 'contraindications', 'preg', prefix=True)) == ['Lisinopril', 'Warfarin']
+        assert names(with_term(Condition, 'treatments', 'lifestyle changes')) == ['Hypertension']
+        assert ConditionTerm.query.filter_by(field='symptoms').count() == 2
+
+        warfarin = Medication.query.filter_by(name='Warfarin').one()
+        warfarin.contraindications = json.dumps(['Active bleeding'])
+        db.session.commit()
+        assert names(with_term(Medication, 'contraindications', 'pregnancy')) == ['Lisinopril']
+        assert names(with_term(Medication, 'uses', 'atrial fibrillation')) == ['Warfarin']
+
+        # Changes that are rolled back leave no rows behind
+        warfarin.uses = json.dumps(['Pulmonary embolism'])
+        db.session.flush()
+        db.session.rollback()
+        assert names(with_term(Medication, 'uses', 'pulmonary embolism')) == []
+
+        db.session.delete(Medication.query.filter_by(name='Metformin').one())
+        db.session.commit()
+        assert MedicationTerm.query.filter_by(term='Severe renal impairment').count() == 0
+
+        with db.engine.begin() as connection:
+            assert rebuild_record_terms(connection) == MedicationTerm.query.count() + ConditionTerm.query.count()
+
+def test_backfill_existing_database(make_app):
+    """Test that term tables missing or left empty on an older database are filled from the records"""
+    app = make_app(seed_term_records, seed_history=False)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            ConditionTerm.__table__.drop(connection)
+            connection.execute(MedicationTerm.__table__.delete())
+        assert names(with_term(Medication, 'contraindications', 'pregnancy')) == []
+
+        with db.engine.begin() as connection:
+            written = backfill_record_terms(connection)
+        assert written == MedicationTerm.query.count() + ConditionTerm.query.count() > 0
+        assert names(with_term(Medication, 'contraindications', 'pregnancy')) == ['Lisinopril', 'Warfarin']
+        assert names(with_term(Condition, 'symptoms', 'nosebleeds')) == ['Hypertension']
+
+        # Tables that already have rows are left alone
+        with db.engine.begin() as connection:
+            assert backfill_record_terms(connection) == 0
+
+def test_term_lookup_uses_index(make_app):
+    """Test that term lookups are answered through the (field, normalized) index"""
+    app = make_app(seed_term_records, seed_history=False)
+    with app.app_context():
+        plans = []
+
+        def explain(connection, cursor, statement, parameters, context, executemany):
+            if 'medication_term' in statement and statement.lstrip().upper().startswith('SELECT'):
+                plans.append(connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall())
+
+        event.listen(db.engine, 'before_cursor_execute', explain)
+        try:
+            with_term(Medication, 'contraindications', 'pregnancy').all()
+            with_term(Medication, 'contraindications', 'preg', prefix=True).all()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', explain)
+
+        assert len(plans) == 2
+        for plan in plans:
+            assert any('ix_medication_term_field_normalized' in row[-1] for row in plan)
+
+def test_api_term_filters(make_app):
+    """Test filtering list endpoints by list items"""
+    app = make_app(seed_term_records, seed_history=False)
+    client = app.test_client()
+
+    data = client.get('/api/api/conditions?symptom=NOSEBLEEDS').get_json()
+    assert [c['name'] for c in data['conditions']] == ['Hypertension']
+    data = client.get('/api/api/conditions?symptom=head*&treatment=lifestyle%20changes').get_json()
+    assert [c['name'] for c in data['conditions']] == ['Hypertension']
+    assert client.get('/api/api/conditions?symptom=headache&treatment=surgery').get_json()['count'] == 0
+    assert client.get('/api/api/conditions?symptom=fever').get_json()['count'] == 0
+
+    data = client.get('/api/api/medications?contraindication=pregnancy').get_json()
+    assert [m['name'] for m in data['medications']] == ['Lisinopril', 'Warfarin']
+    assert data['medications'][0]['specialties'] == ['Cardiology']
+    data = client.get('/api/api/medications?contraindication=pregnancy&specialty=Cardiology').get_json()
+    assert [m['name'] for m in data['medications']] == ['Lisinopril']
+    assert client.get('/api/api/medications?use=type*&side_effect=nausea').get_json()['count'] == 0
+
+def test_api_medication_detail_is_conditional(make_app):
+    """Test /api/medications/<id>, its ETag, and that the ETag follows its specialties"""
+    app = make_app(seed_term_records, seed_history=False)
+    client = app.test_client()
+
+    response = client.get('/api/api/medications/1')
+    assert response.status_code == 200
+    assert response.get_json()['name'] == 'Lisinopril'
+    assert response.get_json()['specialties'] == ['Cardiology']
+    etag = response.headers['ETag']
+    assert client.get('/api/api/medications/1', headers={'If-None-Match': etag}).status_code == 304
+
+    with app.app_context():
+        db.session.get(Specialty, 1).name = 'Cardiovascular medicine'
+        db.session.commit()
+    response = client.get('/api/api/medications/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.get_json()['specialties'] == ['Cardiovascular medicine']
+    assert client.get('/api/api/medications/99').status_code == 404
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__]))